@@ -29,8 +29,17 @@ import string
 import sys
 import time
 
+from ij import ImagePlus, ImageStack
+from ij.plugin import ChannelSplitter
+from java.lang import Runnable, Runtime, Thread
+from java.util import ArrayList
+from java.util.concurrent import Executors, Semaphore, ThreadFactory, TimeUnit
 from loci.plugins.out import Exporter
 from loci.plugins import LociExporter
+from mpicbg.models import TranslationModel2D
+from mpicbg.stitching.fusion import Fusion
+from net.imglib2.type.numeric.integer import UnsignedByteType, UnsignedShortType
+from net.imglib2.type.numeric.real import FloatType
 plugin = LociExporter()
 
 def tiffextend(imname):
@@ -45,8 +54,10 @@ def savefile(im,imname,plugin,compress='false'):
         attemptcount = 0
         imname = tiffextend(imname)
         print('Saving ',imname,im.width,im.height)
+        starttime = time.time()
         if compress.lower()!='true':
                 IJ.saveAs(im, "tiff",imname)
+                print('Saved',imname,'in',round(time.time()-starttime,1),'seconds')
         else:
                 while attemptcount <5:
                         try:
@@ -54,11 +65,164 @@ def savefile(im,imname,plugin,compress='false'):
                                 exporter = Exporter(plugin, im)
                                 exporter.run()
                                 print('Succeeded after attempt ',attemptcount)
+                                print('Saved',imname,'in',round(time.time()-starttime,1),'seconds')
                                 return
                         except:
                                 attemptcount +=1
                 print('failed 5 times at saving')
 
+# Threads compressing and writing tiles and downsampled images while the script
+# stitches on, and the share of the JVM's heap the images waiting to be written may
+# take up before the script has to wait for them to catch up
+writer_threads = 8
+writer_memory_fraction = 0.25
+writer_memory_mb = max(1,int(Runtime.getRuntime().maxMemory()*writer_memory_fraction/1e6))
+
+class WriterThreads(ThreadFactory):
+        # Daemon threads, so a script that fails part way through isn't kept running
+        # by them; the end of the script waits for them to finish writing
+        def newThread(self,runnable):
+                thread=Thread(runnable)
+                thread.setDaemon(True)
+                return thread
+
+writer_pool = Executors.newFixedThreadPool(writer_threads,WriterThreads())
+writer_memory = Semaphore(writer_memory_mb)
+
+class FileWriter(Runnable):
+        def __init__(self,im,imname,compress,mb):
+                self.im=im
+                self.imname=imname
+                self.compress=compress
+                self.mb=mb
+        def run(self):
+                try:
+                        # The exporter's arg is set per file, so each write needs its own
+                        savefile(self.im,self.imname,LociExporter(),compress=self.compress)
+                finally:
+                        writer_memory.release(self.mb)
+
+def savefile_later(im,imname,compress='false'):
+        # savefile in the writer pool; im mustn't be closed before it's written
+        mb=min(writer_memory_mb,max(1,int(im.width*im.height*im.getBytesPerPixel()/1e6)))
+        writer_memory.acquire(mb)
+        writer_pool.execute(FileWriter(im,imname,compress,mb))
+
+# Longest to wait for an ImageJ command's image or a saved file before moving on
+wait_timeout = 900
+
+def new_image(im,before_id):
+        return im.getID()!=before_id
+
+def sized(width,height):
+        return lambda im,before_id: im.width==int(width) and im.height==int(height)
+
+def run_and_wait(command,options,is_done,timeout=wait_timeout):
+        # Poll until the command's result is the current image, rather than sleeping
+        # for long enough that it usually is
+        before=WindowManager.getCurrentImage()
+        before_id=None
+        if before!=None:
+                before_id=before.getID()
+        starttime=time.time()
+        IJ.run(command,options)
+        while time.time()-starttime<timeout:
+                im=WindowManager.getCurrentImage()
+                if im!=None and is_done(im,before_id):
+                        print(command,'done in',round(time.time()-starttime,1),'seconds')
+                        return im
+                time.sleep(0.1)
+        print('Gave up waiting for',command,'after',timeout,'seconds')
+        return IJ.getImage()
+
+def wait_for_file(filename,timeout=wait_timeout):
+        # A file is written once it's there and its size has stopped changing
+        starttime=time.time()
+        lastsize=-1
+        while time.time()-starttime<timeout:
+                if os.path.exists(filename):
+                        size=os.path.getsize(filename)
+                        if size>0 and size==lastsize:
+                                return
+                        lastsize=size
+                time.sleep(1)
+        print('Gave up waiting for',filename,'after',timeout,'seconds')
+
+# Share of the JVM's heap that the channels fused together in one pass may take up.
+# Every tile of each is held in memory while they're fused, and then each channel's
+# canvas waits in memory until it's been scaled, padded and cropped, so a group is
+# only as many channels as fit, and at least one.
+fusion_memory_fraction = 0.25
+
+def fusion_group_size(tilebytes,tilecount,remaining):
+        # Per channel: its tiles, its canvas in the fused image, and its copy when split
+        perchannel=3*tilebytes*tilecount
+        budget=Runtime.getRuntime().maxMemory()*fusion_memory_fraction
+        return max(1,min(remaining,int(budget/perchannel)))
+
+# Fusion.fuse's number for Linear Blending, as in Grid/Collection stitching
+linear_blending = 0
+
+def read_tile_positions(tileconfig,exclude=[]):
+        # [(file name, x, y)] from a TileConfiguration, leaving out tiles named in exclude
+        positions=[]
+        with open(tileconfig,'r') as infile:
+                for line in infile:
+                        if ';' not in line or line.startswith('#'):
+                                continue
+                        if any([empty in line for empty in exclude]):
+                                continue
+                        name,_,coords=line.split(';')
+                        x,y=coords.strip().strip('()').split(',')[:2]
+                        positions.append((name.strip(),float(x),float(y)))
+        return positions
+
+def fuse_channels(tiledir,positions,presuflist,firstpresuf):
+        # Fuses firstpresuf and as many of the channels after it as fusion_group_size
+        # allows, at the positions registered for permprefix/permsuffix, all in one
+        # call rather than rerunning Grid/Collection stitching per channel.
+        # Returns {(prefix,suffix): fused ImagePlus}.
+        first=presuflist.index(firstpresuf)
+        tile=IJ.openImage(os.path.join(tiledir,positions[0][0].replace(permprefix,firstpresuf[0]).replace(permsuffix,firstpresuf[1])))
+        tilebytes=tile.width*tile.height*tile.getBytesPerPixel()
+        tile.flush()
+        group=presuflist[first:first+fusion_group_size(tilebytes,len(positions),len(presuflist)-first)]
+        print('Fusing',len(positions),'tiles of',group)
+        images=ArrayList()
+        models=ArrayList()
+        for name,x,y in positions:
+                stack=None
+                for thisprefix,thissuffix in group:
+                        tile=IJ.openImage(os.path.join(tiledir,name.replace(permprefix,thisprefix).replace(permsuffix,thissuffix)))
+                        if stack==None:
+                                stack=ImageStack(tile.width,tile.height)
+                                bitdepth=tile.getBitDepth()
+                        stack.addSlice(tile.getProcessor())
+                tileim=ImagePlus(name,stack)
+                tileim.setDimensions(len(group),1,1)
+                images.add(tileim)
+                model=TranslationModel2D()
+                model.set(x,y)
+                models.add(model)
+        if bitdepth==8:
+                targettype=UnsignedByteType()
+        elif bitdepth==16:
+                targettype=UnsignedShortType()
+        else:
+                targettype=FloatType()
+        fused=Fusion.fuse(targettype,images,models,2,False,linear_blending,None,False,False,False)
+        channels=ChannelSplitter.split(fused)
+        fused.flush()
+        return dict(zip(group,channels))
+
+def close_all_but(keep):
+        # Like Close All, but leaves keep open
+        for eachid in WindowManager.getIDList() or []:
+                eachim=WindowManager.getImage(eachid)
+                if eachim!=None and eachim.getID()!=keep.getID():
+                        eachim.changes=False
+                        eachim.close()
+
 top_outfolder = 'output'
 
 if not os.path.exists(top_outfolder):
@@ -160,7 +324,6 @@ if os.path.isdir(subdir):
                 for eachwell in welllist:
                         standard_grid_instructions=["type=["+stitchorder+"] order=[Right & Down                ] grid_size_x="+rows+" grid_size_y="+columns+" tile_overlap="+overlap_pct+" first_file_index_i=0 directory="+subdir+" file_names=",
                         " output_textfile_name=TileConfiguration.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 compute_overlap computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"]
-                        copy_grid_instructions="type=[Positions from file] order=[Defined by TileConfiguration] directory="+subdir+" layout_file=TileConfiguration.registered_copy.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 ignore_z_stage computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"
                         filename=permprefix+'_Well_'+eachwell+'_Site_{i}_'+permsuffix
                         fileoutname='Stitched'+filename.replace("{i}","")
                         IJ.run("Grid/Collection stitching", standard_grid_instructions[0] + filename + standard_grid_instructions[1])
@@ -170,6 +333,8 @@ if os.path.isdir(subdir):
                         if compress.lower()!='true':
                                 savefile(im,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
                         IJ.run("Close All")
+                        positions=read_tile_positions(os.path.join(subdir,'TileConfiguration.registered.txt'),[])
+                        fused={}
                         for eachpresuf in presuflist: # for each channel
                                 thisprefix, thissuffix=eachpresuf
                                 thissuffixnicename = thissuffix.split('.')[0]
@@ -180,43 +345,37 @@ if os.path.isdir(subdir):
                                         os.mkdir(tile_subdir_persuf)
                                 filename=thisprefix+'_Well_'+eachwell+'_Site_{i}_'+thissuffix
                                 fileoutname='Stitched'+filename.replace("{i}","")
-                                with open(os.path.join(subdir, 'TileConfiguration.registered.txt'),'r') as infile:
-                                        with open(os.path.join(subdir, 'TileConfiguration.registered_copy.txt'),'w') as outfile:
-                                                for line in infile:
-                                                        line=line.replace(permprefix,thisprefix)
-                                                        line=line.replace(permsuffix,thissuffix)
-                                                        outfile.write(line)
-
-                                IJ.run("Grid/Collection stitching", copy_grid_instructions)
-                                im=IJ.getImage()
+                                if eachpresuf not in fused:
+                                        fused=fuse_channels(subdir,positions,presuflist,eachpresuf)
+                                im=fused.pop(eachpresuf)
+                                WindowManager.setTempCurrentImage(im)
                                 width = str(int(round(im.width*float(scalingstring))))
                                 height = str(int(round(im.height*float(scalingstring))))
                                 # scale the barcoding and cell painting images to match each other
                                 print("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                IJ.run("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                time.sleep(15)
-                                im2=IJ.getImage()
+                                im2=run_and_wait("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create", new_image)
+                                # Only the scaled copy is needed from here on
+                                im.flush()
                                 #padding to ensure tiles are all the same size (for CellProfiler later on)
                                 print("Canvas Size...", "width="+str(upscaledsize)+" height="+str(upscaledsize)+" position=Top-Left zero")
-                                IJ.run("Canvas Size...", "width="+str(upscaledsize)+" height="+str(upscaledsize)+" position=Top-Left zero")
-                                time.sleep(15)
-                                im3=IJ.getImage()
+                                im3=run_and_wait("Canvas Size...", "width="+str(upscaledsize)+" height="+str(upscaledsize)+" position=Top-Left zero", sized(upscaledsize,upscaledsize))
                                 savefile(im3,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
                                 im=IJ.getImage()
                                 #scaling to make a downsampled image for QC
                                 print("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                im_10=IJ.run("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                im_10=IJ.getImage()
-                                savefile(im_10,os.path.join(downsample_subdir,fileoutname),plugin,compress=compress)
-                                IJ.run("Close All")
-                                im=IJ.open(os.path.join(out_subdir,fileoutname))
-                                im = IJ.getImage()
+                                im_10=run_and_wait("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create", new_image)
+                                savefile_later(im_10.duplicate(),os.path.join(downsample_subdir,fileoutname),compress=compress)
+                                # Crop the tiles from the padded image still in memory, not from the file just saved
+                                # Besides it, only the canvases of this fusion group's channels still to do are held
+                                close_all_but(im3)
+                                im=im3
+                                WindowManager.setTempCurrentImage(im)
                                 for eachxtile in range(tileperside):
                                         for eachytile in range(tileperside):
                                                 each_tile_num = eachxtile*tileperside + eachytile + 1
                                                 IJ.makeRectangle(eachxtile*tilesize, eachytile*tilesize,tilesize,tilesize)
                                                 im_tile=im.crop()
-                                                savefile(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),plugin,compress=compress)
+                                                savefile_later(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),compress=compress)
                                 IJ.run("Close All")
         elif round_or_square == 'round':
                 if imperwell == '1364':
@@ -350,7 +509,6 @@ if os.path.isdir(subdir):
                                 print('Stitching whole well')
                                 standard_grid_instructions=["type=[Filename defined position] order=[Defined by filename         ] grid_size_x="+str(columns)+" grid_size_y="+str(rows)+" tile_overlap="+overlap_pct+" first_file_index_x=0 first_file_index_y=0 directory="+subdir+" file_names=",
                                 " output_textfile_name=TileConfiguration.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 compute_overlap computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"]
-                                copy_grid_instructions="type=[Positions from file] order=[Defined by TileConfiguration] directory="+subdir+" layout_file=TileConfiguration.registered_copy.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 ignore_z_stage computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"
                                 filename=permprefix+'_Well_'+eachwell+'_x_{xx}_y_{yy}_'+permsuffix
                                 fileoutname='Stitched'+filename.replace("{i}","")
                                 instructions = standard_grid_instructions[0] + filename + standard_grid_instructions[1]
@@ -361,10 +519,12 @@ if os.path.isdir(subdir):
                                 #This doesn't seem to play nicely with the compression option on, it doesn't get overwritten later and bad things happen
                                 if compress.lower()!='true':
                                         savefile(im,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
+                                        wait_for_file(tiffextend(os.path.join(out_subdir,fileoutname)))
                                 print(os.path.join(out_subdir,fileoutname))
-                                time.sleep(300)
                                 IJ.run("Close All")
                                 # cropping
+                                positions=read_tile_positions(os.path.join(subdir,'TileConfiguration.registered.txt'),[])
+                                fused={}
                                 for eachpresuf in presuflist: # for each channel
                                         thisprefix, thissuffix=eachpresuf
                                         thissuffixnicename = thissuffix.split('.')[0]
@@ -375,43 +535,37 @@ if os.path.isdir(subdir):
                                                 os.mkdir(tile_subdir_persuf)
                                         filename=thisprefix+'_Well_'+eachwell+'_Site_{i}_'+thissuffix
                                         fileoutname='Stitched'+filename.replace("{i}","")
-                                        with open(os.path.join(subdir, 'TileConfiguration.registered.txt'),'r') as infile:
-                                                with open(os.path.join(subdir, 'TileConfiguration.registered_copy.txt'),'w') as outfile:
-                                                        for line in infile:
-                                                                line=line.replace(permprefix,thisprefix)
-                                                                line=line.replace(permsuffix,thissuffix)
-                                                                outfile.write(line)
-
-                                        IJ.run("Grid/Collection stitching", copy_grid_instructions)
-                                        im=IJ.getImage()
+                                        if eachpresuf not in fused:
+                                                fused=fuse_channels(subdir,positions,presuflist,eachpresuf)
+                                        im=fused.pop(eachpresuf)
+                                        WindowManager.setTempCurrentImage(im)
                                         width = str(int(round(im.width*float(scalingstring))))
                                         height = str(int(round(im.height*float(scalingstring))))
                                         # scale the barcoding and cell painting images to match each other
                                         print("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                        IJ.run("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                        time.sleep(15)
-                                        im2=IJ.getImage()
+                                        im2=run_and_wait("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create", new_image)
+                                        # Only the scaled copy is needed from here on
+                                        im.flush()
                                         #padding to ensure tiles are all the same size (for CellProfiler later on)
                                         print("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Top-Left zero")
-                                        IJ.run("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Top-Left zero")
-                                        time.sleep(15)
-                                        im3=IJ.getImage()
+                                        im3=run_and_wait("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Top-Left zero", sized(upscaled_col_size,upscaled_row_size))
                                         savefile(im3,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
                                         im=IJ.getImage()
                                         #scaling to make a downsampled image for QC
                                         print("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                        im_10=IJ.run("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                        im_10=IJ.getImage()
-                                        savefile(im_10,os.path.join(downsample_subdir,fileoutname),plugin,compress=compress)
-                                        IJ.run("Close All")
-                                        im=IJ.open(os.path.join(out_subdir,fileoutname))
-                                        im = IJ.getImage()
+                                        im_10=run_and_wait("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create", new_image)
+                                        savefile_later(im_10.duplicate(),os.path.join(downsample_subdir,fileoutname),compress=compress)
+                                        # Crop the tiles from the padded image still in memory, not from the file just saved
+                                        # Besides it, only the canvases of this fusion group's channels still to do are held
+                                        close_all_but(im3)
+                                        im=im3
+                                        WindowManager.setTempCurrentImage(im)
                                         for eachxtile in range(tileperside):
                                                 for eachytile in range(tileperside):
                                                         each_tile_num = eachxtile*tileperside + eachytile + 1
                                                         IJ.makeRectangle(eachxtile*tilesize, eachytile*tilesize,tilesize,tilesize)
                                                         im_tile=im.crop()
-                                                        savefile(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),plugin,compress=compress)
+                                                        savefile_later(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),compress=compress)
                                         IJ.run("Close All")
 
 
@@ -421,7 +575,6 @@ if os.path.isdir(subdir):
                                 #Change per quarter
                                 standard_grid_instructions=["type=[Filename defined position] order=[Defined by filename         ] grid_size_x="+str(left_columns)+" grid_size_y="+top_rows+" tile_overlap="+overlap_pct+" first_file_index_x=0 first_file_index_y=0 directory="+subdir+" file_names=",
                                 " output_textfile_name=TileConfiguration.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 compute_overlap computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"]
-                                copy_grid_instructions="type=[Positions from file] order=[Defined by TileConfiguration] directory="+subdir+" layout_file=TileConfiguration.registered_copy.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 ignore_z_stage computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"
                                 filename=permprefix+'_Well_'+eachwell+'_x_{xx}_y_{yy}_'+permsuffix
                                 #Change per quarter
                                 fileoutname='StitchedTopLeft'+filename.replace("{xx}","").replace("{yy}","")
@@ -434,6 +587,8 @@ if os.path.isdir(subdir):
                                 if compress.lower()!='true':
                                         savefile(im,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
                                 IJ.run("Close All")
+                                positions=read_tile_positions(os.path.join(subdir,'TileConfiguration.registered.txt'),emptylist)
+                                fused={}
                                 for eachpresuf in presuflist:
                                         thisprefix, thissuffix=eachpresuf
                                         thissuffixnicename = thissuffix.split('.')[0]
@@ -445,16 +600,10 @@ if os.path.isdir(subdir):
                                         filename=thisprefix+'_Well_'+eachwell+'_x_{xx}_y_{yy}_'+thissuffix
                                         #Change per quarter
                                         fileoutname='StitchedTopLeft'+filename.replace("{xx}","").replace("{yy}","")
-                                        with open(os.path.join(subdir, 'TileConfiguration.registered.txt'),'r') as infile:
-                                                with open(os.path.join(subdir, 'TileConfiguration.registered_copy.txt'),'w') as outfile:
-                                                        for line in infile:
-                                                                if not any([empty in line for empty in emptylist]):
-                                                                        line=line.replace(permprefix,thisprefix)
-                                                                        line=line.replace(permsuffix,thissuffix)
-                                                                        outfile.write(line)
-
-                                        IJ.run("Grid/Collection stitching", copy_grid_instructions)
-                                        im0=IJ.getImage()
+                                        if eachpresuf not in fused:
+                                                fused=fuse_channels(subdir,positions,presuflist,eachpresuf)
+                                        im0=fused.pop(eachpresuf)
+                                        WindowManager.setTempCurrentImage(im0)
                                         #chop off the bottom and right
                                         #Change per quarter
                                         IJ.makeRectangle(0,0,im0.width-pixels_to_crop,im0.height-pixels_to_crop)
@@ -462,23 +611,23 @@ if os.path.isdir(subdir):
                                         width = str(int(round(im1.width*float(scalingstring))))
                                         height = str(int(round(im1.height*float(scalingstring))))
                                         print("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                        IJ.run("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                        time.sleep(15)
-                                        im2=IJ.getImage()
+                                        im2=run_and_wait("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create", new_image)
+                                        # Only the scaled copy is needed from here on
+                                        im0.flush()
+                                        im1.flush()
                                         #Chnage per quarter
                                         print("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Bottom-Right zero")
-                                        IJ.run("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Bottom-Right zero")
-                                        time.sleep(15)
-                                        im3=IJ.getImage()
+                                        im3=run_and_wait("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Bottom-Right zero", sized(upscaled_col_size,upscaled_row_size))
                                         savefile(im3,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
                                         im=IJ.getImage()
                                         print("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                        im_10=IJ.run("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                        im_10=IJ.getImage()
-                                        savefile(im_10,os.path.join(downsample_subdir,fileoutname),plugin,compress=compress)
-                                        IJ.run("Close All")
-                                        im=IJ.open(os.path.join(out_subdir,fileoutname))
-                                        im = IJ.getImage()
+                                        im_10=run_and_wait("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create", new_image)
+                                        savefile_later(im_10.duplicate(),os.path.join(downsample_subdir,fileoutname),compress=compress)
+                                        # Crop the tiles from the padded image still in memory, not from the file just saved
+                                        # Besides it, only the canvases of this fusion group's channels still to do are held
+                                        close_all_but(im3)
+                                        im=im3
+                                        WindowManager.setTempCurrentImage(im)
                                         tile_offset = upscaled_row_size - (tilesize * tiles_per_quarter)
                                         for eachxtile in range(tiles_per_quarter):
                                                 for eachytile in range(tiles_per_quarter):
@@ -487,7 +636,7 @@ if os.path.isdir(subdir):
                                                         #Change per quarter
                                                         IJ.makeRectangle((eachxtile*tilesize)+tile_offset, (eachytile*tilesize)+tile_offset,tilesize,tilesize)
                                                         im_tile=im.crop()
-                                                        savefile(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),plugin,compress=compress)
+                                                        savefile_later(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),compress=compress)
                                         IJ.run("Close All")
 
                                 #top right quarter
@@ -495,7 +644,6 @@ if os.path.isdir(subdir):
                                 #Change per quarter
                                 standard_grid_instructions=["type=[Filename defined position] order=[Defined by filename         ] grid_size_x="+str(right_columns)+" grid_size_y="+top_rows+" tile_overlap="+overlap_pct+" first_file_index_x="+str(left_columns)+" first_file_index_y=0 directory="+subdir+" file_names=",
                                 " output_textfile_name=TileConfiguration.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 compute_overlap computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"]
-                                copy_grid_instructions="type=[Positions from file] order=[Defined by TileConfiguration] directory="+subdir+" layout_file=TileConfiguration.registered_copy.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 ignore_z_stage computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"
                                 filename=permprefix+'_Well_'+eachwell+'_x_{xx}_y_{yy}_'+permsuffix
                                 #Change per quarter
                                 fileoutname='StitchedTopRight'+filename.replace("{xx}","").replace("{yy}","")
@@ -506,6 +654,8 @@ if os.path.isdir(subdir):
                                 if compress.lower()!='true':
                                         savefile(im,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
                                 IJ.run("Close All")
+                                positions=read_tile_positions(os.path.join(subdir,'TileConfiguration.registered.txt'),emptylist)
+                                fused={}
                                 for eachpresuf in presuflist:
                                         thisprefix, thissuffix=eachpresuf
                                         thissuffixnicename = thissuffix.split('.')[0]
@@ -517,16 +667,10 @@ if os.path.isdir(subdir):
                                         filename=thisprefix+'_Well_'+eachwell+'_x_{xx}_y_{yy}_'+thissuffix
                                         #Change per quarter
                                         fileoutname='StitchedTopRight'+filename.replace("{xx}","").replace("{yy}","")
-                                        with open(os.path.join(subdir, 'TileConfiguration.registered.txt'),'r') as infile:
-                                                with open(os.path.join(subdir, 'TileConfiguration.registered_copy.txt'),'w') as outfile:
-                                                        for line in infile:
-                                                                if not any([empty in line for empty in emptylist]):
-                                                                        line=line.replace(permprefix,thisprefix)
-                                                                        line=line.replace(permsuffix,thissuffix)
-                                                                        outfile.write(line)
-
-                                        IJ.run("Grid/Collection stitching", copy_grid_instructions)
-                                        im0=IJ.getImage()
+                                        if eachpresuf not in fused:
+                                                fused=fuse_channels(subdir,positions,presuflist,eachpresuf)
+                                        im0=fused.pop(eachpresuf)
+                                        WindowManager.setTempCurrentImage(im0)
                                         #chop off the bottom and left
                                         #Change per quarter
                                         IJ.makeRectangle(pixels_to_crop,0,im0.width-pixels_to_crop,im0.height-pixels_to_crop)
@@ -534,23 +678,23 @@ if os.path.isdir(subdir):
                                         width = str(int(round(im1.width*float(scalingstring))))
                                         height = str(int(round(im1.height*float(scalingstring))))
                                         print("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                        IJ.run("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                        time.sleep(15)
-                                        im2=IJ.getImage()
+                                        im2=run_and_wait("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create", new_image)
+                                        # Only the scaled copy is needed from here on
+                                        im0.flush()
+                                        im1.flush()
                                         #Chnage per quarter
                                         print("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Bottom-Left zero")
-                                        IJ.run("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Bottom-Left zero")
-                                        time.sleep(15)
-                                        im3=IJ.getImage()
+                                        im3=run_and_wait("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Bottom-Left zero", sized(upscaled_col_size,upscaled_row_size))
                                         savefile(im3,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
                                         im=IJ.getImage()
                                         print("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                        im_10=IJ.run("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                        im_10=IJ.getImage()
-                                        savefile(im_10,os.path.join(downsample_subdir,fileoutname),plugin,compress=compress)
-                                        IJ.run("Close All")
-                                        im=IJ.open(os.path.join(out_subdir,fileoutname))
-                                        im = IJ.getImage()
+                                        im_10=run_and_wait("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create", new_image)
+                                        savefile_later(im_10.duplicate(),os.path.join(downsample_subdir,fileoutname),compress=compress)
+                                        # Crop the tiles from the padded image still in memory, not from the file just saved
+                                        # Besides it, only the canvases of this fusion group's channels still to do are held
+                                        close_all_but(im3)
+                                        im=im3
+                                        WindowManager.setTempCurrentImage(im)
                                         tile_offset = upscaled_row_size - (tilesize * tiles_per_quarter)
                                         for eachxtile in range(tiles_per_quarter):
                                                 for eachytile in range(tiles_per_quarter):
@@ -559,7 +703,7 @@ if os.path.isdir(subdir):
                                                         #Change per quarter
                                                         IJ.makeRectangle((eachxtile*tilesize), (eachytile*tilesize)+tile_offset,tilesize,tilesize)
                                                         im_tile=im.crop()
-                                                        savefile(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),plugin,compress=compress)
+                                                        savefile_later(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),compress=compress)
                                         IJ.run("Close All")
 
                                 #bottom left quarter
@@ -567,7 +711,6 @@ if os.path.isdir(subdir):
                                 #Change per quarter
                                 standard_grid_instructions=["type=[Filename defined position] order=[Defined by filename         ] grid_size_x="+str(left_columns)+" grid_size_y="+bot_rows+" tile_overlap="+overlap_pct+" first_file_index_x=0 first_file_index_y="+top_rows+" directory="+subdir+" file_names=",
                                 " output_textfile_name=TileConfiguration.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 compute_overlap computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"]
-                                copy_grid_instructions="type=[Positions from file] order=[Defined by TileConfiguration] directory="+subdir+" layout_file=TileConfiguration.registered_copy.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 ignore_z_stage computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"
                                 filename=permprefix+'_Well_'+eachwell+'_x_{xx}_y_{yy}_'+permsuffix
                                 #Change per quarter
                                 fileoutname='StitchedBottomLeft'+filename.replace("{xx}","").replace("{yy}","")
@@ -578,6 +721,8 @@ if os.path.isdir(subdir):
                                 if compress.lower()!='true':
                                         savefile(im,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
                                 IJ.run("Close All")
+                                positions=read_tile_positions(os.path.join(subdir,'TileConfiguration.registered.txt'),emptylist)
+                                fused={}
                                 for eachpresuf in presuflist:
                                         thisprefix, thissuffix=eachpresuf
                                         thissuffixnicename = thissuffix.split('.')[0]
@@ -589,16 +734,10 @@ if os.path.isdir(subdir):
                                         filename=thisprefix+'_Well_'+eachwell+'_x_{xx}_y_{yy}_'+thissuffix
                                         #Change per quarter
                                         fileoutname='StitchedBottomLeft'+filename.replace("{xx}","").replace("{yy}","")
-                                        with open(os.path.join(subdir, 'TileConfiguration.registered.txt'),'r') as infile:
-                                                with open(os.path.join(subdir, 'TileConfiguration.registered_copy.txt'),'w') as outfile:
-                                                        for line in infile:
-                                                                if not any([empty in line for empty in emptylist]):
-                                                                        line=line.replace(permprefix,thisprefix)
-                                                                        line=line.replace(permsuffix,thissuffix)
-                                                                        outfile.write(line)
-
-                                        IJ.run("Grid/Collection stitching", copy_grid_instructions)
-                                        im0=IJ.getImage()
+                                        if eachpresuf not in fused:
+                                                fused=fuse_channels(subdir,positions,presuflist,eachpresuf)
+                                        im0=fused.pop(eachpresuf)
+                                        WindowManager.setTempCurrentImage(im0)
                                         #chop off the top and right
                                         #Change per quarter
                                         IJ.makeRectangle(0,pixels_to_crop,im0.width-pixels_to_crop,im0.height-pixels_to_crop)
@@ -606,23 +745,23 @@ if os.path.isdir(subdir):
                                         width = str(int(round(im1.width*float(scalingstring))))
                                         height = str(int(round(im1.height*float(scalingstring))))
                                         print("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                        IJ.run("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                        time.sleep(15)
-                                        im2=IJ.getImage()
+                                        im2=run_and_wait("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create", new_image)
+                                        # Only the scaled copy is needed from here on
+                                        im0.flush()
+                                        im1.flush()
                                         #Chnage per quarter
                                         print("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Top-Right zero")
-                                        IJ.run("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Top-Right zero")
-                                        time.sleep(15)
-                                        im3=IJ.getImage()
+                                        im3=run_and_wait("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Top-Right zero", sized(upscaled_col_size,upscaled_row_size))
                                         savefile(im3,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
                                         im=IJ.getImage()
                                         print("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                        im_10=IJ.run("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                        im_10=IJ.getImage()
-                                        savefile(im_10,os.path.join(downsample_subdir,fileoutname),plugin,compress=compress)
-                                        IJ.run("Close All")
-                                        im=IJ.open(os.path.join(out_subdir,fileoutname))
-                                        im = IJ.getImage()
+                                        im_10=run_and_wait("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create", new_image)
+                                        savefile_later(im_10.duplicate(),os.path.join(downsample_subdir,fileoutname),compress=compress)
+                                        # Crop the tiles from the padded image still in memory, not from the file just saved
+                                        # Besides it, only the canvases of this fusion group's channels still to do are held
+                                        close_all_but(im3)
+                                        im=im3
+                                        WindowManager.setTempCurrentImage(im)
                                         tile_offset = upscaled_row_size - (tilesize * tiles_per_quarter)
                                         for eachxtile in range(tiles_per_quarter):
                                                 for eachytile in range(tiles_per_quarter):
@@ -631,7 +770,7 @@ if os.path.isdir(subdir):
                                                         #Change per quarter
                                                         IJ.makeRectangle((eachxtile*tilesize)+tile_offset, (eachytile*tilesize),tilesize,tilesize)
                                                         im_tile=im.crop()
-                                                        savefile(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),plugin,compress=compress)
+                                                        savefile_later(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),compress=compress)
                                         IJ.run("Close All")
 
                                 #bottom right quarter
@@ -639,7 +778,6 @@ if os.path.isdir(subdir):
                                 #Change per quarter
                                 standard_grid_instructions=["type=[Filename defined position] order=[Defined by filename         ] grid_size_x="+str(right_columns)+" grid_size_y="+bot_rows+" tile_overlap="+overlap_pct+" first_file_index_x="+str(left_columns)+" first_file_index_y="+top_rows+" directory="+subdir+" file_names=",
                                 " output_textfile_name=TileConfiguration.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 compute_overlap computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"]
-                                copy_grid_instructions="type=[Positions from file] order=[Defined by TileConfiguration] directory="+subdir+" layout_file=TileConfiguration.registered_copy.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 ignore_z_stage computation_parameters=[Save computation time (but use more RAM)] image_output=[Fuse and display]"
                                 filename=permprefix+'_Well_'+eachwell+'_x_{xx}_y_{yy}_'+permsuffix
                                 #Change per quarter
                                 fileoutname='StitchedBottomRight'+filename.replace("{xx}","").replace("{yy}","")
@@ -650,6 +788,8 @@ if os.path.isdir(subdir):
                                 if compress.lower()!='true':
                                         savefile(im,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
                                 IJ.run("Close All")
+                                positions=read_tile_positions(os.path.join(subdir,'TileConfiguration.registered.txt'),emptylist)
+                                fused={}
                                 for eachpresuf in presuflist:
                                         thisprefix, thissuffix=eachpresuf
                                         thissuffixnicename = thissuffix.split('.')[0]
@@ -661,16 +801,10 @@ if os.path.isdir(subdir):
                                         filename=thisprefix+'_Well_'+eachwell+'_x_{xx}_y_{yy}_'+thissuffix
                                         #Change per quarter
                                         fileoutname='StitchedBottomRight'+filename.replace("{xx}","").replace("{yy}","")
-                                        with open(os.path.join(subdir, 'TileConfiguration.registered.txt'),'r') as infile:
-                                                with open(os.path.join(subdir, 'TileConfiguration.registered_copy.txt'),'w') as outfile:
-                                                        for line in infile:
-                                                                if not any([empty in line for empty in emptylist]):
-                                                                        line=line.replace(permprefix,thisprefix)
-                                                                        line=line.replace(permsuffix,thissuffix)
-                                                                        outfile.write(line)
-
-                                        IJ.run("Grid/Collection stitching", copy_grid_instructions)
-                                        im0=IJ.getImage()
+                                        if eachpresuf not in fused:
+                                                fused=fuse_channels(subdir,positions,presuflist,eachpresuf)
+                                        im0=fused.pop(eachpresuf)
+                                        WindowManager.setTempCurrentImage(im0)
                                         #chop off the top and left
                                         #Change per quarter
                                         IJ.makeRectangle(pixels_to_crop,pixels_to_crop,im0.width-pixels_to_crop,im0.height-pixels_to_crop)
@@ -678,23 +812,23 @@ if os.path.isdir(subdir):
                                         width = str(int(round(im1.width*float(scalingstring))))
                                         height = str(int(round(im1.height*float(scalingstring))))
                                         print("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                        IJ.run("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create")
-                                        time.sleep(15)
-                                        im2=IJ.getImage()
+                                        im2=run_and_wait("Scale...", "x="+scalingstring+" y="+scalingstring+" width="+width+" height="+height+" interpolation=Bilinear average create", new_image)
+                                        # Only the scaled copy is needed from here on
+                                        im0.flush()
+                                        im1.flush()
                                         #Chnage per quarter
                                         print("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Top-Left zero")
-                                        IJ.run("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Top-Left zero")
-                                        time.sleep(15)
-                                        im3=IJ.getImage()
+                                        im3=run_and_wait("Canvas Size...", "width="+str(upscaled_col_size)+" height="+str(upscaled_row_size)+" position=Top-Left zero", sized(upscaled_col_size,upscaled_row_size))
                                         savefile(im3,os.path.join(out_subdir,fileoutname),plugin,compress=compress)
                                         im=IJ.getImage()
                                         print("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                        im_10=IJ.run("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create")
-                                        im_10=IJ.getImage()
-                                        savefile(im_10,os.path.join(downsample_subdir,fileoutname),plugin,compress=compress)
-                                        IJ.run("Close All")
-                                        im=IJ.open(os.path.join(out_subdir,fileoutname))
-                                        im = IJ.getImage()
+                                        im_10=run_and_wait("Scale...", "x=0.1 y=0.1 width="+str(im.width/10)+" height="+str(im.width/10)+" interpolation=Bilinear average create", new_image)
+                                        savefile_later(im_10.duplicate(),os.path.join(downsample_subdir,fileoutname),compress=compress)
+                                        # Crop the tiles from the padded image still in memory, not from the file just saved
+                                        # Besides it, only the canvases of this fusion group's channels still to do are held
+                                        close_all_but(im3)
+                                        im=im3
+                                        WindowManager.setTempCurrentImage(im)
                                         tile_offset = upscaled_row_size - (tilesize * tiles_per_quarter)
                                         for eachxtile in range(tiles_per_quarter):
                                                 for eachytile in range(tiles_per_quarter):
@@ -703,12 +837,15 @@ if os.path.isdir(subdir):
                                                         #Change per quarter
                                                         IJ.makeRectangle((eachxtile*tilesize), (eachytile*tilesize),tilesize,tilesize)
                                                         im_tile=im.crop()
-                                                        savefile(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),plugin,compress=compress)
+                                                        savefile_later(im_tile,os.path.join(tile_subdir_persuf,thissuffixnicename+'_Site_'+str(each_tile_num)+'.tiff'),compress=compress)
                                         IJ.run("Close All")
 
         else:
                 print("Must identify well as round or square")
 else:
         print("Could not find input directory ",subdir)
-for eachlogfile in ['TileConfiguration.txt','TileConfiguration.registered.txt','TileConfiguration.registered_copy.txt']:
+# Let the writers finish
+writer_pool.shutdown()
+writer_pool.awaitTermination(1,TimeUnit.DAYS)
+for eachlogfile in ['TileConfiguration.txt','TileConfiguration.registered.txt']:
         os.rename(os.path.join(subdir,eachlogfile),os.path.join(out_subdir,eachlogfile))
@@ -0,0 +1,50 @@
+import json
+import os
+import sys
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda/lambda_functions")
+)
+
+import step_status
+import storage
+
+# Prints the status documents the monitor writes for every step of a batch.
+# Use: python batch_status.py BUCKET WORKSPACE_PREFIX BATCH
+#  or: python batch_status.py LOCAL_WORKSPACE_FOLDER BATCH
+
+
+def read_s3_statuses(bucket_name, prefix, batch):
+    s3 = storage.default_storage()
+    statuses = {}
+    keys = s3.list(bucket_name, os.path.join(prefix, "monitors", batch) + "/")
+    for eachkey in keys:
+        if eachkey.endswith("Status.json"):
+            statuses[eachkey.split("/")[-2]] = json.loads(s3.get(bucket_name, eachkey))
+    return statuses
+
+
+def read_local_statuses(folder, batch):
+    statuses = {}
+    batch_folder = os.path.join(folder, "monitors", batch)
+    for step in os.listdir(batch_folder):
+        for eachfile in os.listdir(os.path.join(batch_folder, step)):
+            if eachfile.endswith("Status.json"):
+                with open(os.path.join(batch_folder, step, eachfile), "r") as f:
+                    statuses[step] = json.load(f)
+    return statuses
+
+
+if len(sys.argv) == 4:
+    statuses = read_s3_statuses(sys.argv[1], sys.argv[2], sys.argv[3])
+elif len(sys.argv) == 3:
+    statuses = read_local_statuses(sys.argv[1], sys.argv[2])
+else:
+    print("Use: batch_status.py BUCKET WORKSPACE_PREFIX BATCH")
+    print("  or batch_status.py LOCAL_WORKSPACE_FOLDER BATCH")
+    sys.exit()
+
+if not statuses:
+    print("No status documents found. Is a monitor running for this batch?")
+else:
+    print(step_status.render_statuses(statuses))
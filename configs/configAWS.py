@@ -9,4 +9,3 @@ ECS_CLUSTER = "default_cluster"
 
 # SQS QUEUE INFORMATION:
 SQS_DEAD_LETTER_QUEUE = "arn:aws:sqs:us-east-1:XXXXXXXXXXXX:DeadMessages"
-SQS_DUPLICATE_QUEUE = "PreventOverlappingStarts.fifo"
@@ -1,17 +1,19 @@
 import json
 import os
 import sys
-import boto3
 import ast
 
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import checkpoints
 import create_CSVs
 import run_DCP
 import create_batch_jobs
+import fan_out
 import helpful_functions
+import storage
 
-s3 = boto3.client("s3")
+s3 = storage.default_storage()
 
 # Step information
 metadata_file_name = "/tmp/metadata.json"
@@ -42,7 +44,65 @@ exclude_plates = []
 include_plates = []
 
 
+def make_plate_csvs(work):
+    eachplate = work["plate"]
+    platedict = work["platedict"]
+    bucket = work["bucket"]
+    prefix = work["prefix"]
+    image_prefix = work["image_prefix"]
+    batch = work["batch"]
+    num_series = work["num_series"]
+    full_well_files = work["full_well_files"]
+    SABER = work["SABER"]
+    Channelrounds = work["Channelrounds"]
+    well_list = list(platedict.keys())
+    # Only keep full wells
+    print(f"{full_well_files} expected files per well and round for {eachplate}")
+    incomplete_wells = []
+    for eachwell in well_list:
+        if SABER:
+            for eachround in Channelrounds:
+                per_well = platedict[eachwell][eachround]
+                if len(per_well) != full_well_files:
+                    incomplete_wells.append(eachwell)
+                    print(
+                        f"{eachwell} {eachround} doesn't have full well files. {len(per_well)} files found."
+                    )
+        if not SABER:
+            paint_cycle_name = list(platedict[well_list[0]].keys())[0]
+            per_well = platedict[eachwell][paint_cycle_name]
+            if len(per_well) != full_well_files:
+                incomplete_wells.append(eachwell)
+                print(
+                    f"{eachwell} {paint_cycle_name} doesn't have full well files. {len(per_well)} files found."
+                )
+    if incomplete_wells:
+        for well in incomplete_wells:
+            del platedict[well]
+    bucket_folder = f"/home/ubuntu/bucket/{image_prefix}{batch}/images/{eachplate}/"
+    illum_folder = f"/home/ubuntu/bucket/{image_prefix}{batch}/illum/{eachplate}/"
+    per_plate_csv, per_plate_csv_2 = create_CSVs.create_CSV_pipeline1(
+        eachplate,
+        num_series,
+        bucket_folder,
+        illum_folder,
+        platedict,
+        work["one_or_many_files"],
+        work["Channeldict"],
+    )
+    csv_on_bucket_name = f"{prefix}load_data_csv/{batch}/{eachplate}/load_data_pipeline1.csv"
+    csv_on_bucket_name_2 = f"{prefix}load_data_csv/{batch}/{eachplate}/load_data_pipeline2.csv"
+
+    s3.upload(bucket, per_plate_csv, csv_on_bucket_name)
+    s3.upload(bucket, per_plate_csv_2, csv_on_bucket_name_2)
+    return [csv_on_bucket_name, csv_on_bucket_name_2]
+
+
+@checkpoints.record_endings
 def lambda_handler(event, context):
+    if fan_out.is_worker(event):
+        return make_plate_csvs(fan_out.worker_work(event))
+
     bucket = event["Records"][0]["s3"]["bucket"]["name"]
     key = event["Records"][0]["s3"]["object"]["key"]
     prefix, batchAndPipe = key.split("pipelines/")
@@ -119,67 +179,63 @@ def lambda_handler(event, context):
         platelist = [i for i in platelist if i not in exclude_plates]
     if include_plates:
         platelist = include_plates
-    # Pull the file names we care about, and make the CSV
-    for eachplate in platelist:
-        platedict = image_dict[eachplate]
-        well_list = list(platedict.keys())
-        # Only keep full wells
-        print(f"{full_well_files} expected files per well and round for {eachplate}")
-        incomplete_wells = []
-        for eachwell in well_list:
-            if SABER:
-                for eachround in Channelrounds:
-                    per_well = platedict[eachwell][eachround]
-                    if len(per_well) != full_well_files:
-                        incomplete_wells.append(eachwell)
-                        print(
-                            f"{eachwell} {eachround} doesn't have full well files. {len(per_well)} files found."
-                        )
-            if not SABER:
-                paint_cycle_name = list(platedict[well_list[0]].keys())[0]
-                per_well = platedict[eachwell][paint_cycle_name]
-                if len(per_well) != full_well_files:
-                    incomplete_wells.append(eachwell)
-                    print(
-                        f"{eachwell} {eachround} doesn't have full well files. {len(per_well)} files found."
-                    )
-        if incomplete_wells:
-            for well in incomplete_wells:
-                del platedict[well]
-        bucket_folder = f"/home/ubuntu/bucket/{image_prefix}{batch}/images/{eachplate}/"
-        illum_folder = f"/home/ubuntu/bucket/{image_prefix}{batch}/illum/{eachplate}/"
-        per_plate_csv, per_plate_csv_2 = create_CSVs.create_CSV_pipeline1(
-            eachplate,
-            num_series,
-            bucket_folder,
-            illum_folder,
-            platedict,
-            metadata["one_or_many_files"],
-            metadata["Channeldict"],
-        )
-        csv_on_bucket_name = f"{prefix}load_data_csv/{batch}/{eachplate}/load_data_pipeline1.csv"
-        csv_on_bucket_name_2 = f"{prefix}load_data_csv/{batch}/{eachplate}/load_data_pipeline2.csv"
-
-        with open(per_plate_csv, "rb") as a:
-            s3.put_object(Body=a, Bucket=bucket, Key=csv_on_bucket_name)
-        with open(per_plate_csv_2, "rb") as a:
-            s3.put_object(Body=a, Bucket=bucket, Key=csv_on_bucket_name_2)
+
+    # Pick up where a timed out invocation of this step left off, if there was one
+    checkpoint = checkpoints.StepCheckpoint(
+        s3, bucket, prefix, batch, config_dict["APP_NAME"]
+    )
+    if not checkpoint.claim(context):
+        return "Step already being launched"
+
+    # Pull the file names we care about, and make the CSV, one worker per plate
+    work_items = [
+        {
+            "plate": eachplate,
+            "platedict": image_dict[eachplate],
+            "bucket": bucket,
+            "prefix": prefix,
+            "image_prefix": image_prefix,
+            "batch": batch,
+            "num_series": num_series,
+            "full_well_files": full_well_files,
+            "SABER": SABER,
+            "Channelrounds": Channelrounds,
+            "one_or_many_files": metadata["one_or_many_files"],
+            "Channeldict": metadata["Channeldict"],
+        }
+        for eachplate in checkpoint.plates_to_do(platelist)
+    ]
+    fan_out.run_plates(
+        make_plate_csvs, work_items, context, plate_done=checkpoint.plate_done
+    )
+    checkpoint.complete("csvs")
 
     # Now it's time to run DCP
-    app_name = run_DCP.run_setup(bucket, prefix, batch, config_dict)
+    app_name = run_DCP.run_setup(
+        bucket, prefix, batch, config_dict, checkpoint=checkpoint
+    )
 
     # Make a batch
     if not SABER:
         pipeline_name = "1_CP_Illum.cppipe"
     if SABER:
         pipeline_name = "1_SABER_CP_Illum.cppipe"
+    create_batch_jobs.checkpoint = checkpoint
     create_batch_jobs.create_batch_jobs_1(
         image_prefix, batch, pipeline_name, platelist, app_name, SABER=SABER, config_dict=config_dict
     )
 
     # Start a cluster
-    run_DCP.run_cluster(bucket, prefix, batch, len(platelist), config_dict)
+    run_DCP.run_cluster(
+        bucket,
+        prefix,
+        batch,
+        len(platelist),
+        config_dict,
+        step=step,
+        checkpoint=checkpoint,
+    )
 
     # Run the monitor
-    run_DCP.run_monitor(bucket, prefix, batch, step, config_dict)
+    run_DCP.run_monitor(bucket, prefix, batch, step, config_dict, checkpoint=checkpoint)
     print("Go run the monitor now")
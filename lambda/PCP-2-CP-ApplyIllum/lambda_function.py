@@ -2,17 +2,20 @@ import json
 import os
 import sys
 import time
-import boto3
 import ast
 
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import aws_clients
+import checkpoints
 import run_DCP
 import create_batch_jobs
 import helpful_functions
+import streaming
+import storage
 
-s3 = boto3.client("s3")
-sqs = boto3.client("sqs")
+s3 = storage.default_storage()
+sqs = aws_clients.client("sqs")
 
 # Step information
 metadata_file_name = "/tmp/metadata.json"
@@ -43,6 +46,7 @@ exclude_plates = []
 include_plates = []
 
 
+@checkpoints.record_endings
 def lambda_handler(event, context):
     # Log the received event
     bucket_name = event["Records"][0]["s3"]["bucket"]["name"]
@@ -87,7 +91,10 @@ def lambda_handler(event, context):
         platelist = [i for i in platelist if i not in exclude_plates]
     if include_plates:
         platelist = include_plates
-    
+    # Streamed launches only cover the plates whose illum jobs have finished
+    if event.get("streaming"):
+        platelist = streaming.select_ready_plates(platelist, event["ready"])
+
     plate_well_dict = {}
     for plate in platelist:
         platedict = image_dict[plate]
@@ -95,17 +102,21 @@ def lambda_handler(event, context):
         plate_well_dict[plate] = well_list
 
     # Now let's check if it seems like the whole thing is done or not
-    sqs = boto3.client("sqs")
-
     run_DCP.grab_batch_config(bucket_name, prefix, batch)
-    from configAWS import SQS_DUPLICATE_QUEUE
 
     filter_prefix = image_prefix + batch + "/illum"
     expected_len = (num_painting_channels + 1) * len(platelist)
 
     print("Checking if all files are present")
     prev_step_app_name = config_dict["APP_NAME"].rsplit("_", 1)[-2] + "_IllumPainting"
-    done = helpful_functions.check_if_run_done(
+    # A timed out invocation of this step leaves a checkpoint to pick up from
+    checkpoint = checkpoints.StepCheckpoint(
+        s3, bucket_name, prefix, batch, config_dict["APP_NAME"]
+    )
+    extending = not checkpoint.resuming() and helpful_functions.extending_running_step(
+        event, sqs, config_dict["APP_NAME"]
+    )
+    done = extending or checkpoint.resuming() or helpful_functions.check_if_run_done(
         s3,
         bucket_name,
         filter_prefix,
@@ -113,8 +124,9 @@ def lambda_handler(event, context):
         config_dict["APP_NAME"],
         prev_step_app_name,
         sqs,
-        SQS_DUPLICATE_QUEUE,
+        prefix,
         filter_out="Cycle",
+        orchestrated=event.get("orchestrated", False),
     )
 
     if not done:
@@ -122,25 +134,55 @@ def lambda_handler(event, context):
         return "Still work ongoing"
 
     else:
+        # Streamed launches that only add jobs to the running step aren't checkpointed
+        if extending:
+            checkpoint = None
+        elif not checkpoint.claim(context):
+            return "Step already being launched"
+
         # now let's do our stuff!
-        app_name = run_DCP.run_setup(bucket_name, prefix, batch, config_dict)
+        if extending:
+            app_name = config_dict["APP_NAME"]
+        else:
+            app_name = run_DCP.run_setup(
+                bucket_name, prefix, batch, config_dict, checkpoint=checkpoint
+            )
 
         if not SABER:
             pipeline_name = "2_CP_Apply_Illum.cppipe"
         if SABER:
             pipeline_name = "2_SABER_CP_Apply_Illum.cppipe"
         # make the jobs
+        create_batch_jobs.checkpoint = checkpoint
         create_batch_jobs.create_batch_jobs_2(
             image_prefix, batch, pipeline_name, plate_well_dict, app_name
         )
 
+        if extending:
+            run_DCP.run_extend_monitor(bucket_name, prefix, batch, step, config_dict)
+            return "Jobs added"
+
         njobs = len([item for sublist in plate_well_dict.values() for item in sublist])
         # Start a cluster
         run_DCP.run_cluster(
-            bucket_name, prefix, batch, njobs, config_dict,
+            bucket_name,
+            prefix,
+            batch,
+            njobs,
+            config_dict,
+            step=step,
+            checkpoint=checkpoint,
         )
 
         # Run the monitor
-        run_DCP.run_monitor(bucket_name, prefix, batch, step, config_dict)
+        run_DCP.run_monitor(
+            bucket_name,
+            prefix,
+            batch,
+            step,
+            config_dict,
+            streaming_step=event.get("streaming", False),
+            checkpoint=checkpoint,
+        )
         print("Go run the monitor now")
         return "Cluster started"
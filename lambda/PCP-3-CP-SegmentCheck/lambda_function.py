@@ -1,19 +1,24 @@
 import datetime
 import os, sys
 import json
-import boto3
-import numpy
 import pandas
 
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import aws_clients
+import checkpoints
 import create_CSVs
 import run_DCP
+import coalescing
+import cppipe
 import create_batch_jobs
 import helpful_functions
+import site_sampling
+import storage
+import threshold_stats
 
-s3 = boto3.client("s3")
-sqs = boto3.client("sqs")
+s3 = storage.default_storage()
+sqs = aws_clients.client("sqs")
 
 # Step information
 metadata_file_name = "/tmp/metadata.json"
@@ -50,6 +55,7 @@ exclude_plates = []
 include_plates = []
 
 
+@checkpoints.record_endings
 def lambda_handler(event, context):
     bucket_name = event["Records"][0]["s3"]["bucket"]["name"]
     key = event["Records"][0]["s3"]["object"]["key"]
@@ -65,6 +71,17 @@ def lambda_handler(event, context):
     prefix = os.path.join(image_prefix, "workspace/")
     print(batch, prefix)
 
+    # Image.csv events are coalesced, so the checks below run at most once per
+    # trigger window rather than once per well
+    if "csv" in key and not event.get("orchestrated"):
+        counts = coalescing.coalesce(
+            s3, bucket_name, prefix, batch, step, event, context
+        )
+        if counts is None:
+            return "Coalesced"
+        # Keep the threshold percentiles up to date as step 2's CSVs land
+        threshold_stats.update(s3, bucket_name, prefix, batch, counts["new_keys"])
+
     # Get the metadata file
     metadata_on_bucket_name = os.path.join(prefix, "metadata", batch, "metadata.json")
     print(f"Downloading metadata from {metadata_on_bucket_name}")
@@ -98,12 +115,8 @@ def lambda_handler(event, context):
     if include_plates:
         platelist = include_plates
         plate_and_well_list = [x for x in plate_and_well_list if x[0] in include_plates]
-
     # First let's check if it seems like the whole thing is done or not
-    sqs = boto3.client("sqs")
-
     run_DCP.grab_batch_config(bucket_name, prefix, batch)
-    from configAWS import SQS_DUPLICATE_QUEUE
 
     filter_prefix = image_prefix + batch + "/images_corrected/painting"
     # Expected length shows that all transfers (i.e. all wells) have at least started
@@ -113,7 +126,11 @@ def lambda_handler(event, context):
     prev_step_app_name = (
         config_dict["APP_NAME"].rsplit("_", 1)[-2] + "_ApplyIllumPainting"
     )
-    done = helpful_functions.check_if_run_done(
+    # A timed out invocation of this step leaves a checkpoint to pick up from
+    checkpoint = checkpoints.StepCheckpoint(
+        s3, bucket_name, prefix, batch, config_dict["APP_NAME"]
+    )
+    done = checkpoint.resuming() or helpful_functions.check_if_run_done(
         s3,
         bucket_name,
         filter_prefix,
@@ -121,13 +138,17 @@ def lambda_handler(event, context):
         config_dict["APP_NAME"],
         prev_step_app_name,
         sqs,
-        SQS_DUPLICATE_QUEUE,
+        prefix,
+        orchestrated=event.get("orchestrated", False),
     )
 
     if not done:
         print("Still work ongoing")
         return "Still work ongoing"
     else:
+        if not checkpoint.claim(context):
+            return "Step already being launched"
+
         print("Checking CSVs for thresholds")
         image_csv_list = helpful_functions.paginate_a_folder(
             s3,
@@ -135,15 +156,15 @@ def lambda_handler(event, context):
             os.path.join(image_prefix, batch, "images_corrected/painting"),
         )
         image_csv_list = [x for x in image_csv_list if "Image.csv" in x]
-        image_df = helpful_functions.concat_some_csvs(
-            s3, bucket_name, image_csv_list, "Image.csv"
+        # Mostly already summarized as each CSV landed
+        threshes = threshold_stats.update(
+            s3, bucket_name, prefix, batch, image_csv_list
         )
-        threshes = image_df["Threshold_FinalThreshold_Cells"]
-        calc_upper_percentile = numpy.percentile(threshes, upper_percentile)
+        calc_upper_percentile = threshes.percentile(upper_percentile)
         print(
             f"In {len(image_csv_list) * num_series} images, the {upper_percentile} percentile was {calc_upper_percentile}"
         )
-        calc_lower_percentile = numpy.percentile(threshes, lower_percentile)
+        calc_lower_percentile = threshes.percentile(lower_percentile)
         print(
             f"In {len(image_csv_list) * num_series} images, the {lower_percentile} percentile was {calc_lower_percentile}"
         )
@@ -155,24 +176,50 @@ def lambda_handler(event, context):
         local_temp_pipeline_name = os.path.join(
             "/tmp", pipeline_name.split(".")[0] + "_edited.cppipe"
         )
-        with open(local_pipeline_name, "wb") as f:
-            s3.download_fileobj(bucket_name, pipeline_on_bucket_name, f)
+        s3.download(bucket_name, pipeline_on_bucket_name, local_pipeline_name)
         edit_id_secondary(
             local_pipeline_name,
             local_temp_pipeline_name,
             calc_lower_percentile,
             calc_upper_percentile,
         )
-        with open(local_temp_pipeline_name, "rb") as pipeline:
-            s3.put_object(
-                Body=pipeline, Bucket=bucket_name, Key=pipeline_on_bucket_name
-            )
+        s3.upload(bucket_name, local_temp_pipeline_name, pipeline_on_bucket_name)
         print("Edited pipeline file")
 
+        # Adaptive sampling checks fewer sites in wells whose thresholds vary less.
+        # Wells already sampled, e.g. by an earlier launch, keep their sites.
+        adaptive = metadata.get("segmentation_sampling", "uniform") == "adaptive"
+        if adaptive:
+            batch_thresholds = threshold_stats.load_batch_sketch(
+                s3, bucket_name, prefix, batch
+            )
+            segmentation_sites = metadata.get("segmentation_sites", {})
+
         # Pull the file names we care about, and make the CSV
         for eachplate in platelist:
             platedict = image_dict[eachplate]
             well_list = list(platedict.keys())
+            well_sites = None
+            if adaptive:
+                well_sites = segmentation_sites.setdefault(eachplate, {})
+                to_sample = [x for x in well_list if x not in well_sites]
+                well_sites.update(
+                    site_sampling.sample_sites(
+                        to_sample,
+                        threshold_stats.well_sketches(
+                            s3, bucket_name, prefix, batch, eachplate
+                        ),
+                        batch_thresholds,
+                        [lower_percentile, upper_percentile],
+                        num_series,
+                        metadata["range_skip"],
+                        rows=metadata["painting_rows"],
+                        columns=metadata["painting_columns"],
+                    )
+                )
+                print(
+                    f"Sampled {sum(len(well_sites[x]) for x in well_list)} sites in {len(well_list)} wells of {eachplate}"
+                )
             bucket_folder = (
                 "/home/ubuntu/bucket/"
                 + image_prefix
@@ -186,6 +233,7 @@ def lambda_handler(event, context):
                 well_list,
                 metadata["range_skip"],
                 segmentation_channel,
+                well_sites=well_sites,
             )
             csv_on_bucket_name = (
                 prefix
@@ -196,37 +244,54 @@ def lambda_handler(event, context):
                 + "/load_data_pipeline3.csv"
             )
             print("Created", csv_on_bucket_name)
-            with open(per_plate_csv, "rb") as a:
-                s3.put_object(Body=a, Bucket=bucket_name, Key=csv_on_bucket_name)
+            s3.upload(bucket_name, per_plate_csv, csv_on_bucket_name)
+        if adaptive:
+            # For step 4 to know how many sites to expect
+            metadata["segmentation_sites"] = segmentation_sites
+            helpful_functions.write_metadata_file(
+                s3, bucket_name, metadata, metadata_file_name, metadata_on_bucket_name
+            )
 
         # now let's do our stuff!
-        app_name = run_DCP.run_setup(bucket_name, prefix, batch, config_dict)
+        app_name = run_DCP.run_setup(
+            bucket_name, prefix, batch, config_dict, checkpoint=checkpoint
+        )
 
         # make the jobs
+        create_batch_jobs.checkpoint = checkpoint
         create_batch_jobs.create_batch_jobs_3(
             image_prefix, batch, pipeline_name, plate_and_well_list, app_name
         )
 
         # Start a cluster
         run_DCP.run_cluster(
-            bucket_name, prefix, batch, len(plate_and_well_list), config_dict,
+            bucket_name,
+            prefix,
+            batch,
+            len(plate_and_well_list),
+            config_dict,
+            step=step,
+            checkpoint=checkpoint,
         )
 
         # Run the monitor
-        run_DCP.run_monitor(bucket_name, prefix, batch, step, config_dict)
+        run_DCP.run_monitor(
+            bucket_name,
+            prefix,
+            batch,
+            step,
+            config_dict,
+            checkpoint=checkpoint,
+        )
         print("Go run the monitor now")
         return "Cluster started"
 
 
 def edit_id_secondary(file_in_name, file_out_name, lower_value, upper_value):
-    with open(file_in_name, "rt") as infile:
-        with open(file_out_name, "wt") as outfile:
-            IDSecond = False
-            for line in infile:
-                if "IdentifySecondaryObjects" in line:
-                    IDSecond = True
-                if "Lower and upper bounds on" in line and IDSecond == True:
-                    prompt, answer = line.split(":")
-                    new_answer = str(lower_value) + "," + str(upper_value)
-                    line = prompt + ":" + new_answer + "\n"
-                outfile.write(line)
+    pipeline = cppipe.load(file_in_name)
+    for module in pipeline.modules_named("IdentifySecondaryObjects"):
+        module.set(
+            "Lower and upper bounds on threshold",
+            str(lower_value) + "," + str(upper_value),
+        )
+    cppipe.save(pipeline, file_out_name)
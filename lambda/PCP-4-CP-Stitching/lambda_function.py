@@ -4,16 +4,17 @@ import sys
 import time
 import numpy as np
 
-import boto3
-
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import aws_clients
+import checkpoints
 import run_DCP
 import create_batch_jobs
 import helpful_functions
+import storage
 
-s3 = boto3.client("s3")
-sqs = boto3.client("sqs")
+s3 = storage.default_storage()
+sqs = aws_clients.client("sqs")
 
 # Step Information
 metadata_file_name = "/tmp/metadata.json"
@@ -41,6 +42,7 @@ exclude_plates = []
 include_plates = []
 
 
+@checkpoints.record_endings
 def lambda_handler(event, context):
     # Log the received event
     bucket_name = event["Records"][0]["s3"]["bucket"]["name"]
@@ -83,20 +85,30 @@ def lambda_handler(event, context):
     config_dict["EXPECTED_NUMBER_FILES"] = expected_number_CP_files
 
     # First let's check if it seems like the whole thing is done or not
-    sqs = boto3.client("sqs")
-
     run_DCP.grab_batch_config(bucket_name, prefix, batch)
-    from configAWS import SQS_DUPLICATE_QUEUE
 
     filter_prefix = image_prefix + batch + "/images_corrected/painting"
     # Because this step is batched per site (not well) don't need to anticipate partial loading of jobs
     expected_len = len(plate_and_well_list) * expected_files_per_well + 5
+    # Adaptively sampled wells each have their own number of sites
+    if "segmentation_sites" in metadata:
+        segmentation_sites = metadata["segmentation_sites"]
+        expected_len = 5
+        for plate, well in plate_and_well_list:
+            if well in segmentation_sites.get(plate, {}):
+                expected_len += len(segmentation_sites[plate][well])
+            else:
+                expected_len += expected_files_per_well
 
     print("Checking if all files are present")
     prev_step_app_name = (
         config_dict["APP_NAME"].rsplit("_", 1)[-2] + "_PaintingSegmentationCheck"
     )
-    done = helpful_functions.check_if_run_done(
+    # A timed out invocation of this step leaves a checkpoint to pick up from
+    checkpoint = checkpoints.StepCheckpoint(
+        s3, bucket_name, prefix, batch, config_dict["APP_NAME"]
+    )
+    done = checkpoint.resuming() or helpful_functions.check_if_run_done(
         s3,
         bucket_name,
         filter_prefix,
@@ -104,19 +116,29 @@ def lambda_handler(event, context):
         config_dict["APP_NAME"],
         prev_step_app_name,
         sqs,
-        SQS_DUPLICATE_QUEUE,
+        prefix,
+        orchestrated=event.get("orchestrated", False),
     )
 
     if not done:
         print("Still work ongoing")
         return "Still work ongoing"
     else:
+        if not checkpoint.claim(context):
+            return "Step already being launched"
+
         # now let's do our stuff!
         app_name = run_DCP.run_setup(
-            bucket_name, prefix, batch, config_dict, cellprofiler=False
+            bucket_name,
+            prefix,
+            batch,
+            config_dict,
+            cellprofiler=False,
+            checkpoint=checkpoint,
         )
 
         # make the jobs
+        create_batch_jobs.checkpoint = checkpoint
         create_batch_jobs.create_batch_jobs_4(
             bucket_name,
             image_prefix,
@@ -134,10 +156,18 @@ def lambda_handler(event, context):
 
         # Start a cluster
         run_DCP.run_cluster(
-            bucket_name, prefix, batch, len(plate_and_well_list), config_dict
+            bucket_name,
+            prefix,
+            batch,
+            len(plate_and_well_list),
+            config_dict,
+            step=step,
+            checkpoint=checkpoint,
         )
 
         # Run the monitor
-        run_DCP.run_monitor(bucket_name, prefix, batch, step, config_dict)
+        run_DCP.run_monitor(
+            bucket_name, prefix, batch, step, config_dict, checkpoint=checkpoint
+        )
         print("Go run the monitor now")
         return "Cluster started"
@@ -1,16 +1,18 @@
 import json
 import os
 import sys
-import boto3
 
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import checkpoints
 import create_CSVs
 import run_DCP
 import create_batch_jobs
+import fan_out
 import helpful_functions
+import storage
 
-s3 = boto3.client("s3")
+s3 = storage.default_storage()
 
 # Step information
 metadata_file_name = "/tmp/metadata.json"
@@ -42,7 +44,39 @@ exclude_plates = []
 include_plates = []
 
 
+def make_plate_csv(work):
+    eachplate = work["plate"]
+    # Cycles are ints in return_full_wells' output, but strings once sent as JSON
+    platedict = {int(x): y for x, y in work["platedict"].items()}
+    bucket_folder = os.path.join(
+        "/home/ubuntu/bucket", work["image_prefix"] + work["batch"], "images", eachplate
+    )
+    per_plate_csv = create_CSVs.create_CSV_pipeline5(
+        eachplate,
+        work["num_series"],
+        work["expected_cycles"],
+        bucket_folder,
+        platedict,
+        work["one_or_many_files"],
+        work["fast_or_slow_mode"],
+    )
+    csv_on_bucket_name = (
+        work["prefix"]
+        + "load_data_csv/"
+        + work["batch"]
+        + "/"
+        + eachplate
+        + "/load_data_pipeline5.csv"
+    )
+    s3.upload(work["bucket"], per_plate_csv, csv_on_bucket_name)
+    return csv_on_bucket_name
+
+
+@checkpoints.record_endings
 def lambda_handler(event, context):
+    if fan_out.is_worker(event):
+        return make_plate_csv(fan_out.worker_work(event))
+
     # Log the received event
     bucket = event["Records"][0]["s3"]["bucket"]["name"]
     key = event["Records"][0]["s3"]["object"]["key"]
@@ -99,46 +133,57 @@ def lambda_handler(event, context):
     if include_plates:
         platelist = include_plates
 
-    # Pull the file names we care about and make the CSVs
+    # Pick up where a timed out invocation of this step left off, if there was one
+    checkpoint = checkpoints.StepCheckpoint(
+        s3, bucket, prefix, batch, config_dict["APP_NAME"]
+    )
+    if not checkpoint.claim(context):
+        return "Step already being launched"
+
+    # Pull the file names we care about and make the CSVs, one worker per plate
     print("Making the CSVs")
-    for eachplate in platelist:
-        platedict = parsed_image_dict[eachplate]
-        bucket_folder = (
-            "/home/ubuntu/bucket/" + image_prefix + batch + "/images/" + eachplate
-        )
-        per_plate_csv = create_CSVs.create_CSV_pipeline5(
-            eachplate,
-            num_series,
-            expected_cycles,
-            bucket_folder,
-            platedict,
-            metadata["one_or_many_files"],
-            metadata["fast_or_slow_mode"],
-        )
-        csv_on_bucket_name = (
-            prefix
-            + "load_data_csv/"
-            + batch
-            + "/"
-            + eachplate
-            + "/load_data_pipeline5.csv"
-        )
-        with open(per_plate_csv, "rb") as a:
-            s3.put_object(Body=a, Bucket=bucket, Key=csv_on_bucket_name)
+    work_items = [
+        {
+            "plate": eachplate,
+            "platedict": parsed_image_dict[eachplate],
+            "bucket": bucket,
+            "prefix": prefix,
+            "image_prefix": image_prefix,
+            "batch": batch,
+            "num_series": num_series,
+            "expected_cycles": expected_cycles,
+            "one_or_many_files": metadata["one_or_many_files"],
+            "fast_or_slow_mode": metadata["fast_or_slow_mode"],
+        }
+        for eachplate in checkpoint.plates_to_do(platelist)
+    ]
+    fan_out.run_plates(
+        make_plate_csv, work_items, context, plate_done=checkpoint.plate_done
+    )
+    checkpoint.complete("csvs")
 
     # Now it's time to run DCP
-    app_name = run_DCP.run_setup(bucket, prefix, batch, config_dict)
+    app_name = run_DCP.run_setup(
+        bucket, prefix, batch, config_dict, checkpoint=checkpoint
+    )
 
     # Make a batch
+    create_batch_jobs.checkpoint = checkpoint
     create_batch_jobs.create_batch_jobs_5(
         image_prefix, batch, pipeline_name, platelist, expected_cycles, app_name
     )
 
     # Start a cluster
     run_DCP.run_cluster(
-        bucket, prefix, batch, len(platelist) * expected_cycles, config_dict
+        bucket,
+        prefix,
+        batch,
+        len(platelist) * expected_cycles,
+        config_dict,
+        step=step,
+        checkpoint=checkpoint,
     )
 
     # Run the monitor
-    run_DCP.run_monitor(bucket, prefix, batch, step, config_dict)
+    run_DCP.run_monitor(bucket, prefix, batch, step, config_dict, checkpoint=checkpoint)
     print("Go run the monitor now")
@@ -2,17 +2,21 @@ import json
 import os
 import sys
 import time
-import boto3
 
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import aws_clients
+import checkpoints
 import create_CSVs
 import run_DCP
+import coalescing
 import create_batch_jobs
 import helpful_functions
+import streaming
+import storage
 
-s3 = boto3.client("s3")
-sqs = boto3.client("sqs")
+s3 = storage.default_storage()
+sqs = aws_clients.client("sqs")
 
 # Step information
 metadata_file_name = "/tmp/metadata.json"
@@ -44,16 +48,26 @@ exclude_plates = []
 include_plates = []
 
 
+@checkpoints.record_endings
 def lambda_handler(event, context):
     # Log the received event
     bucket_name = event["Records"][0]["s3"]["bucket"]["name"]
     key = event["Records"][0]["s3"]["object"]["key"]
-    keys = [x["s3"]["object"]["key"] for x in event["Records"]]
     plate = key.split("/")[-2]
     batch = key.split("/")[-4]
     image_prefix = key.split(batch)[0]
     prefix = os.path.join(image_prefix, "workspace/")
 
+    # Output-file events are coalesced, so the checks below run at most once per
+    # trigger window rather than once per file
+    counts = None
+    if not event.get("orchestrated"):
+        counts = coalescing.coalesce(
+            s3, bucket_name, prefix, batch, step, event, context
+        )
+        if counts is None:
+            return "Coalesced"
+
     # Get the metadata file
     metadata_on_bucket_name = os.path.join(prefix, "metadata", batch, "metadata.json")
     print(f"Downloading metadata from {metadata_on_bucket_name}")
@@ -92,6 +106,12 @@ def lambda_handler(event, context):
     if include_plates:
         platelist = include_plates
         plate_and_well_list = [x for x in plate_and_well_list if x[0] in include_plates]
+    # Streamed launches only cover the plates whose barcoding illum is done
+    if event.get("streaming"):
+        plate_and_well_list = streaming.select_ready(
+            plate_and_well_list, event["ready"]
+        )
+        platelist = streaming.select_ready_plates(platelist, event["ready"])
 
     # Default pipeline is slow. If images acquired in fast mode, pulls alternate pipeline.
     pipe_name = pipeline_name
@@ -101,17 +121,21 @@ def lambda_handler(event, context):
     print(f"Pipeline name is {pipe_name}")
 
     # First let's check if it seems like the whole thing is done or not
-    sqs = boto3.client("sqs")
-
     run_DCP.grab_batch_config(bucket_name, prefix, batch)
-    from configAWS import SQS_DUPLICATE_QUEUE
 
     filter_prefix = image_prefix + batch + "/illum"
     expected_len = int(metadata["barcoding_cycles"]) * len(platelist) * 5
 
     print("Checking if all files are present")
     prev_step_app_name = config_dict["APP_NAME"].rsplit("_", 1)[-2] + "_IllumBarcoding"
-    done = helpful_functions.check_if_run_done(
+    # A timed out invocation of this step leaves a checkpoint to pick up from
+    checkpoint = checkpoints.StepCheckpoint(
+        s3, bucket_name, prefix, batch, config_dict["APP_NAME"]
+    )
+    extending = not checkpoint.resuming() and helpful_functions.extending_running_step(
+        event, sqs, config_dict["APP_NAME"]
+    )
+    done = extending or checkpoint.resuming() or helpful_functions.check_if_run_done(
         s3,
         bucket_name,
         filter_prefix,
@@ -119,14 +143,22 @@ def lambda_handler(event, context):
         config_dict["APP_NAME"],
         prev_step_app_name,
         sqs,
-        SQS_DUPLICATE_QUEUE,
+        prefix,
         filter_in="Cycle",
+        orchestrated=event.get("orchestrated", False),
+        output_count=counts["outputs"] if counts else None,
     )
 
     if not done:
         print("Still work ongoing")
         return "Still work ongoing"
     else:
+        # Streamed launches that only add jobs to the running step aren't checkpointed
+        if extending:
+            checkpoint = None
+        elif not checkpoint.claim(context):
+            return "Step already being launched"
+
         # Pull the file names we care about, and make the CSV
         for eachplate in platelist:
             platedict = image_dict[eachplate]
@@ -155,31 +187,59 @@ def lambda_handler(event, context):
                 + "/load_data_pipeline6.csv"
             )
             print("Created", csv_on_bucket_name)
-            with open(per_plate_csv, "rb") as a:
-                s3.put_object(Body=a, Bucket=bucket_name, Key=csv_on_bucket_name)
+            s3.upload(bucket_name, per_plate_csv, csv_on_bucket_name)
 
         # now let's do our stuff!
-        app_name = run_DCP.run_setup(bucket_name, prefix, batch, config_dict)
+        if extending:
+            app_name = config_dict["APP_NAME"]
+        else:
+            app_name = run_DCP.run_setup(
+                bucket_name, prefix, batch, config_dict, checkpoint=checkpoint
+            )
 
-        # make the jobs
+        # make the jobs, with the lean pipeline if production runs should use it
+        job_pipeline_name = helpful_functions.pick_pipeline(
+            s3, bucket_name, prefix, batch, metadata, pipeline_name
+        )
+        create_batch_jobs.checkpoint = checkpoint
         create_batch_jobs.create_batch_jobs_6(
             image_prefix,
             batch,
-            pipeline_name,
+            job_pipeline_name,
             plate_and_well_list,
             app_name,
             metadata["one_or_many_files"],
             num_series,
         )
 
+        if extending:
+            run_DCP.run_extend_monitor(bucket_name, prefix, batch, step, config_dict)
+            return "Jobs added"
+
         # Start a cluster
         if metadata["one_or_many_files"] == "one":
             njobs = len(plate_and_well_list) * 19
         else:
             njobs = len(plate_and_well_list) * num_series
-        run_DCP.run_cluster(bucket_name, prefix, batch, njobs, config_dict)
+        run_DCP.run_cluster(
+            bucket_name,
+            prefix,
+            batch,
+            njobs,
+            config_dict,
+            step=step,
+            checkpoint=checkpoint,
+        )
 
         # Run the monitor
-        run_DCP.run_monitor(bucket_name, prefix, batch, step, config_dict)
+        run_DCP.run_monitor(
+            bucket_name,
+            prefix,
+            batch,
+            step,
+            config_dict,
+            streaming_step=event.get("streaming", False),
+            checkpoint=checkpoint,
+        )
         print("Go run the monitor now")
         return "Cluster started"
@@ -2,17 +2,20 @@ import json
 import os
 import sys
 import time
-import boto3
 
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import aws_clients
+import checkpoints
 import create_CSVs
 import run_DCP
 import create_batch_jobs
 import helpful_functions
+import streaming
+import storage
 
-s3 = boto3.client("s3")
-sqs = boto3.client("sqs")
+s3 = storage.default_storage()
+sqs = aws_clients.client("sqs")
 
 # Step information
 metadata_file_name = "/tmp/metadata.json"
@@ -44,6 +47,7 @@ exclude_plates = []
 include_plates = []
 
 
+@checkpoints.record_endings
 def lambda_handler(event, context):
     # Log the received event
     bucket_name = event["Records"][0]["s3"]["bucket"]["name"]
@@ -63,10 +67,7 @@ def lambda_handler(event, context):
 
     # Check that the barcodes.csv is present
     barcodepath = os.path.join(prefix, "metadata", batch)
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=barcodepath)
-    filelist = []
-    for obj in response.get("Contents", []):
-        filelist.append(obj["Key"])
+    filelist = s3.list(bucket_name, barcodepath)
     if not any(".csv" in file for file in filelist):
         print(f"No Barcodes.csv in {barcodepath}")
         return "Barcodes.csv is missing"
@@ -91,6 +92,12 @@ def lambda_handler(event, context):
     if include_plates:
         platelist = include_plates
         plate_and_well_list = [x for x in plate_and_well_list if x[0] in include_plates]
+    # Streamed launches only cover the wells whose barcoding illum is applied
+    if event.get("streaming"):
+        plate_and_well_list = streaming.select_ready(
+            plate_and_well_list, event["ready"]
+        )
+        platelist = streaming.select_ready_plates(platelist, event["ready"])
 
     num_series = int(metadata["barcoding_rows"]) * int(metadata["barcoding_columns"])
     if metadata["barcoding_imperwell"] != "":
@@ -102,10 +109,7 @@ def lambda_handler(event, context):
     num_sites = len(plate_and_well_list) * num_series
 
     # First let's check if it seems like the whole thing is done or not
-    sqs = boto3.client("sqs")
-
     run_DCP.grab_batch_config(bucket_name, prefix, batch)
-    from configAWS import SQS_DUPLICATE_QUEUE
 
     filter_prefix = image_prefix + batch + "/images_aligned/barcoding"
     # Expected length shows that all transfers (i.e. all wells) have at least started
@@ -115,7 +119,14 @@ def lambda_handler(event, context):
     prev_step_app_name = (
         config_dict["APP_NAME"].rsplit("_", 1)[-2] + "_ApplyIllumBarcoding"
     )
-    done = helpful_functions.check_if_run_done(
+    # A timed out invocation of this step leaves a checkpoint to pick up from
+    checkpoint = checkpoints.StepCheckpoint(
+        s3, bucket_name, prefix, batch, config_dict["APP_NAME"]
+    )
+    extending = not checkpoint.resuming() and helpful_functions.extending_running_step(
+        event, sqs, config_dict["APP_NAME"]
+    )
+    done = extending or checkpoint.resuming() or helpful_functions.check_if_run_done(
         s3,
         bucket_name,
         filter_prefix,
@@ -123,13 +134,20 @@ def lambda_handler(event, context):
         config_dict["APP_NAME"],
         prev_step_app_name,
         sqs,
-        SQS_DUPLICATE_QUEUE,
+        prefix,
+        orchestrated=event.get("orchestrated", False),
     )
 
     if not done:
         print("Still work ongoing")
         return "Still work ongoing"
     else:
+        # Streamed launches that only add jobs to the running step aren't checkpointed
+        if extending:
+            checkpoint = None
+        elif not checkpoint.claim(context):
+            return "Step already being launched"
+
         # Pull the file names we care about, and make the CSV
         for eachplate in platelist:
             platedict = image_dict[eachplate]
@@ -152,26 +170,54 @@ def lambda_handler(event, context):
                 + "/load_data_pipeline7.csv"
             )
             print(f"Created {csv_on_bucket_name}")
-            with open(per_plate_csv, "rb") as a:
-                s3.put_object(Body=a, Bucket=bucket_name, Key=csv_on_bucket_name)
+            s3.upload(bucket_name, per_plate_csv, csv_on_bucket_name)
 
         # now let's do our stuff!
-        app_name = run_DCP.run_setup(bucket_name, prefix, batch, config_dict)
+        if extending:
+            app_name = config_dict["APP_NAME"]
+        else:
+            app_name = run_DCP.run_setup(
+                bucket_name, prefix, batch, config_dict, checkpoint=checkpoint
+            )
 
-        # make the jobs
+        # make the jobs, with the lean pipeline if production runs should use it
+        job_pipeline_name = helpful_functions.pick_pipeline(
+            s3, bucket_name, prefix, batch, metadata, pipeline_name
+        )
+        create_batch_jobs.checkpoint = checkpoint
         create_batch_jobs.create_batch_jobs_7(
             image_prefix,
             batch,
-            pipeline_name,
+            job_pipeline_name,
             plate_and_well_list,
             list(range(num_series)),
             app_name,
         )
 
+        if extending:
+            run_DCP.run_extend_monitor(bucket_name, prefix, batch, step, config_dict)
+            return "Jobs added"
+
         # Start a cluster
-        run_DCP.run_cluster(bucket_name, prefix, batch, num_sites, config_dict)
+        run_DCP.run_cluster(
+            bucket_name,
+            prefix,
+            batch,
+            num_sites,
+            config_dict,
+            step=step,
+            checkpoint=checkpoint,
+        )
 
         # Run the monitor
-        run_DCP.run_monitor(bucket_name, prefix, batch, step, config_dict)
+        run_DCP.run_monitor(
+            bucket_name,
+            prefix,
+            batch,
+            step,
+            config_dict,
+            streaming_step=event.get("streaming", False),
+            checkpoint=checkpoint,
+        )
         print("Go run the monitor now")
         return "Cluster started"
@@ -2,17 +2,18 @@ import json
 import os
 import sys
 import time
-import boto3
 
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import aws_clients
 import create_CSVs
 import run_DCP
 import create_batch_jobs
 import helpful_functions
+import storage
 
-s3 = boto3.client("s3")
-sqs = boto3.client("sqs")
+s3 = storage.default_storage()
+sqs = aws_clients.client("sqs")
 
 # Step information
 metadata_file_name = "/tmp/metadata.json"
@@ -3,16 +3,20 @@ import os
 import sys
 import time
 import numpy as np
-import boto3
 
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import aws_clients
+import checkpoints
 import run_DCP
+import coalescing
 import create_batch_jobs
 import helpful_functions
+import streaming
+import storage
 
-s3 = boto3.client("s3")
-sqs = boto3.client("sqs")
+s3 = storage.default_storage()
+sqs = aws_clients.client("sqs")
 
 # Step Information
 metadata_file_name = "/tmp/metadata.json"
@@ -40,16 +44,26 @@ exclude_plates = []
 include_plates = []
 
 
+@checkpoints.record_endings
 def lambda_handler(event, context):
     # Log the received event
     bucket_name = event["Records"][0]["s3"]["bucket"]["name"]
     key = event["Records"][0]["s3"]["object"]["key"]
-    keys = [x["s3"]["object"]["key"] for x in event["Records"]]
     plate = key.split("/")[-2].split("-")[0]
     batch = key.split("/")[-5]
     image_prefix = key.split(batch)[0]
     prefix = os.path.join(image_prefix, "workspace/")
 
+    # Output-file events are coalesced, so the checks below run at most once per
+    # trigger window rather than once per file
+    counts = None
+    if not event.get("orchestrated"):
+        counts = coalescing.coalesce(
+            s3, bucket_name, prefix, batch, step, event, context
+        )
+        if counts is None:
+            return "Coalesced"
+
     # Get the metadata file
     metadata_on_bucket_name = os.path.join(prefix, "metadata", batch, "metadata.json")
     print(f"Downloading metadata from {metadata_on_bucket_name}")
@@ -72,6 +86,12 @@ def lambda_handler(event, context):
         ]
     if include_plates:
         plate_and_well_list = [x for x in plate_and_well_list if x[0] in include_plates]
+    # Streamed launches only cover the wells whose preprocessing has finished
+    if event.get("streaming"):
+        plate_and_well_list = streaming.select_ready(
+            plate_and_well_list, event["ready"]
+        )
+        platelist = streaming.select_ready_plates(platelist, event["ready"])
 
     # Calculate EXPECTED_NUMBER_FILES per well
     cropped_BC_files = int(metadata["barcoding_cycles"]) * 4 * (
@@ -88,10 +108,7 @@ def lambda_handler(event, context):
     config_dict["EXPECTED_NUMBER_FILES"] = expected_number_BC_files
 
     # First let's check if it seems like the whole thing is done or not
-    sqs = boto3.client("sqs")
-
     run_DCP.grab_batch_config(bucket_name, prefix, batch)
-    from configAWS import SQS_DUPLICATE_QUEUE
 
     filter_prefix = image_prefix + batch + "/images_corrected/barcoding"
     # Because this step is batched per site (not well) don't need to anticipate partial loading of jobs
@@ -101,7 +118,14 @@ def lambda_handler(event, context):
     prev_step_app_name = (
         config_dict["APP_NAME"].rsplit("_", 1)[-2] + "_PreprocessBarcoding"
     )
-    done = helpful_functions.check_if_run_done(
+    # A timed out invocation of this step leaves a checkpoint to pick up from
+    checkpoint = checkpoints.StepCheckpoint(
+        s3, bucket_name, prefix, batch, config_dict["APP_NAME"]
+    )
+    extending = not checkpoint.resuming() and helpful_functions.extending_running_step(
+        event, sqs, config_dict["APP_NAME"]
+    )
+    done = extending or checkpoint.resuming() or helpful_functions.check_if_run_done(
         s3,
         bucket_name,
         filter_prefix,
@@ -109,19 +133,36 @@ def lambda_handler(event, context):
         config_dict["APP_NAME"],
         prev_step_app_name,
         sqs,
-        SQS_DUPLICATE_QUEUE,
+        prefix,
+        orchestrated=event.get("orchestrated", False),
+        output_count=counts["outputs"] if counts else None,
     )
 
     if not done:
         print("Still work ongoing")
         return "Still work ongoing"
     else:
+        # Streamed launches that only add jobs to the running step aren't checkpointed
+        if extending:
+            checkpoint = None
+        elif not checkpoint.claim(context):
+            return "Step already being launched"
+
         # now let's do our stuff!
-        app_name = run_DCP.run_setup(
-            bucket_name, prefix, batch, config_dict, cellprofiler=False
-        )
+        if extending:
+            app_name = config_dict["APP_NAME"]
+        else:
+            app_name = run_DCP.run_setup(
+                bucket_name,
+                prefix,
+                batch,
+                config_dict,
+                cellprofiler=False,
+                checkpoint=checkpoint,
+            )
 
         # make the jobs
+        create_batch_jobs.checkpoint = checkpoint
         create_batch_jobs.create_batch_jobs_8(
             bucket_name,
             image_prefix,
@@ -137,12 +178,30 @@ def lambda_handler(event, context):
             quarter_if_round=metadata["quarter_if_round"],
         )
 
+        if extending:
+            run_DCP.run_extend_monitor(bucket_name, prefix, batch, step, config_dict)
+            return "Jobs added"
+
         # Start a cluster
         run_DCP.run_cluster(
-            bucket_name, prefix, batch, len(plate_and_well_list), config_dict
+            bucket_name,
+            prefix,
+            batch,
+            len(plate_and_well_list),
+            config_dict,
+            step=step,
+            checkpoint=checkpoint,
         )
 
         # Run the monitor
-        run_DCP.run_monitor(bucket_name, prefix, batch, step, config_dict)
+        run_DCP.run_monitor(
+            bucket_name,
+            prefix,
+            batch,
+            step,
+            config_dict,
+            streaming_step=event.get("streaming", False),
+            checkpoint=checkpoint,
+        )
         print("Go run the monitor now")
         return "Cluster started"
@@ -2,17 +2,18 @@ import json
 import os
 import sys
 import time
-import boto3
 
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import aws_clients
 import create_CSVs
 import run_DCP
 import create_batch_jobs
 import helpful_functions
+import storage
 
-s3 = boto3.client("s3")
-sqs = boto3.client("sqs")
+s3 = storage.default_storage()
+sqs = aws_clients.client("sqs")
 
 # Step information
 metadata_file_name = "/tmp/metadata.json"
@@ -93,8 +94,7 @@ def lambda_handler(event, context):
             + "/load_data_pipeline8Y.csv"
         )
         print("Created", csv_on_bucket_name)
-        with open(per_plate_csv, "rb") as a:
-            s3.put_object(Body=a, Bucket=bucket_name, Key=csv_on_bucket_name)
+        s3.upload(bucket_name, per_plate_csv, csv_on_bucket_name)
 
     # now let's do our stuff!
     app_name = run_DCP.run_setup(bucket_name, prefix, batch, config_dict)
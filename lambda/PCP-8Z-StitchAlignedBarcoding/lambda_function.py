@@ -3,16 +3,17 @@ import os
 import sys
 import time
 import numpy as np
-import boto3
 
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import aws_clients
 import run_DCP
 import create_batch_jobs
 import helpful_functions
+import storage
 
-s3 = boto3.client("s3")
-sqs = boto3.client("sqs")
+s3 = storage.default_storage()
+sqs = aws_clients.client("sqs")
 
 # Step Information
 metadata_file_name = "/tmp/metadata.json"
@@ -2,17 +2,21 @@ import json
 import os
 import sys
 import time
-import boto3
 
 sys.path.append("/opt/pooled-cell-painting-lambda")
 
+import aws_clients
+import checkpoints
 import create_CSVs
 import run_DCP
 import create_batch_jobs
+import fan_out
 import helpful_functions
+import streaming
+import storage
 
-s3 = boto3.client("s3")
-sqs = boto3.client("sqs")
+s3 = storage.default_storage()
+sqs = aws_clients.client("sqs")
 
 # Step information
 metadata_file_name = "/tmp/metadata.json"
@@ -44,12 +48,48 @@ exclude_plates = []
 include_plates = []
 
 
+def make_plate_csv(work):
+    eachplate = work["plate"]
+    bucket_folder = os.path.join(
+        "/home/ubuntu/bucket",
+        work["image_prefix"] + work["batch"],
+        "images_corrected_cropped",
+    )
+    per_plate_csv = create_CSVs.create_CSV_pipeline9(
+        eachplate,
+        work["num_sites_perwell"],
+        work["expected_cycles"],
+        bucket_folder,
+        work["well_list"],
+    )
+    csv_on_bucket_name = (
+        work["prefix"]
+        + "load_data_csv/"
+        + work["batch"]
+        + "/"
+        + eachplate
+        + "/load_data_pipeline9.csv"
+    )
+    print("Created", csv_on_bucket_name)
+    s3.upload(work["bucket"], per_plate_csv, csv_on_bucket_name)
+    return csv_on_bucket_name
+
+
+@checkpoints.record_endings
 def lambda_handler(event, context):
+    if fan_out.is_worker(event):
+        return make_plate_csv(fan_out.worker_work(event))
+
     # Manual trigger
     batch = "BATCH_STRING"
     image_prefix = "projects/2018_11_20_Periscope_X/"
     prefix = "projects/2018_11_20_Periscope_X/workspace/"
     bucket_name = "BUCKET"
+    if event.get("orchestrated"):
+        batch = event["batch"]
+        image_prefix = event["image_prefix"]
+        prefix = os.path.join(image_prefix, "workspace/")
+        bucket_name = event["bucket"]
 
     # Get the metadata file
     metadata_on_bucket_name = os.path.join(prefix, "metadata", batch, "metadata.json")
@@ -69,50 +109,101 @@ def lambda_handler(event, context):
     if include_plates:
         platelist = include_plates
         plate_and_well_list = [x for x in plate_and_well_list if x[0] in include_plates]
+    # Streamed launches only cover wells stitched for both painting and barcoding
+    if event.get("streaming"):
+        plate_and_well_list = streaming.select_ready(
+            plate_and_well_list, event["ready"]
+        )
+        platelist = streaming.select_ready_plates(platelist, event["ready"])
 
     expected_cycles = metadata["barcoding_cycles"]
     num_sites_perwell = int(metadata["tileperside"]) ** 2
     num_sites_total = len(plate_and_well_list) * num_sites_perwell
 
-    # Pull the file names we care about, and make the CSV
-    for eachplate in platelist:
-        platedict = image_dict[eachplate]
-        well_list = list(platedict["1"].keys())
-        bucket_folder = (
-            "/home/ubuntu/bucket/" + image_prefix + batch + "/images_corrected_cropped"
-        )
-        per_plate_csv = create_CSVs.create_CSV_pipeline9(
-            eachplate, num_sites_perwell, expected_cycles, bucket_folder, well_list
-        )
-        csv_on_bucket_name = (
-            prefix
-            + "load_data_csv/"
-            + batch
-            + "/"
-            + eachplate
-            + "/load_data_pipeline9.csv"
-        )
-        print("Created", csv_on_bucket_name)
-        with open(per_plate_csv, "rb") as a:
-            s3.put_object(Body=a, Bucket=bucket_name, Key=csv_on_bucket_name)
+    # Pick up where a timed out invocation of this step left off, if there was one;
+    # streamed launches that only add jobs to the running step aren't checkpointed
+    checkpoint = checkpoints.StepCheckpoint(
+        s3, bucket_name, prefix, batch, config_dict["APP_NAME"]
+    )
+    extending = not checkpoint.resuming() and helpful_functions.extending_running_step(
+        event, sqs, config_dict["APP_NAME"]
+    )
+    if extending:
+        checkpoint = None
+        plates_to_do = platelist
+    elif not checkpoint.claim(context):
+        return "Step already being launched"
+    else:
+        plates_to_do = checkpoint.plates_to_do(platelist)
+
+    # Pull the file names we care about, and make the CSV, one worker per plate
+    work_items = [
+        {
+            "plate": eachplate,
+            "well_list": list(image_dict[eachplate]["1"].keys()),
+            "bucket": bucket_name,
+            "prefix": prefix,
+            "image_prefix": image_prefix,
+            "batch": batch,
+            "num_sites_perwell": num_sites_perwell,
+            "expected_cycles": expected_cycles,
+        }
+        for eachplate in plates_to_do
+    ]
+    fan_out.run_plates(
+        make_plate_csv,
+        work_items,
+        context,
+        plate_done=None if extending else checkpoint.plate_done,
+    )
 
     # now let's do our stuff!
-    app_name = run_DCP.run_setup(bucket_name, prefix, batch, config_dict)
+    if extending:
+        app_name = config_dict["APP_NAME"]
+    else:
+        checkpoint.complete("csvs")
+        app_name = run_DCP.run_setup(
+            bucket_name, prefix, batch, config_dict, checkpoint=checkpoint
+        )
 
-    # make the jobs
+    # make the jobs, with the lean pipeline if production runs should use it
+    job_pipeline_name = helpful_functions.pick_pipeline(
+        s3, bucket_name, prefix, batch, metadata, pipeline_name
+    )
+    create_batch_jobs.checkpoint = checkpoint
     create_batch_jobs.create_batch_jobs_9(
         image_prefix,
         batch,
-        pipeline_name,
+        job_pipeline_name,
         plate_and_well_list,
         list(range(1, num_sites_perwell + 1)),
         app_name,
     )
 
+    if extending:
+        run_DCP.run_extend_monitor(bucket_name, prefix, batch, step, config_dict)
+        return "Jobs added"
+
     # Start a cluster
-    run_DCP.run_cluster(bucket_name, prefix, batch, num_sites_total, config_dict)
+    run_DCP.run_cluster(
+        bucket_name,
+        prefix,
+        batch,
+        num_sites_total,
+        config_dict,
+        step=step,
+        checkpoint=checkpoint,
+    )
 
     # Run the monitor
-    run_DCP.run_monitor(bucket_name, prefix, batch, step, config_dict)
+    run_DCP.run_monitor(
+        bucket_name,
+        prefix,
+        batch,
+        step,
+        config_dict,
+        streaming_step=event.get("streaming", False),
+        checkpoint=checkpoint,
+    )
     print("Go run the monitor now")
     return "Cluster started"
@@ -0,0 +1,114 @@
+import json
+import os
+import sys
+
+sys.path.append("/opt/pooled-cell-painting-lambda")
+
+import aws_clients
+import run_DCP
+import create_batch_jobs
+import dead_letters
+import event_monitor
+import job_manifest
+import storage
+
+s3 = storage.default_storage()
+sqs = aws_clients.client("sqs")
+
+# Manually triggered once a step's monitor has finished. Pulls the step's failed
+# jobs back out of the dead-letter queue, writes a report of what failed where,
+# and resubmits them to a small fleet with more memory and bigger machines.
+# Event: {"batch": "...", "step": "3", "app_name": "...", "dry_run": true}
+# Leave dry_run on to only write the report; failed jobs are then left in the
+# dead-letter queue untouched.
+
+# How much more memory/time/price to give the rerun
+escalation_factor = 2
+# Any config_dict values to force on the rerun, e.g. {"MACHINE_TYPE": ["r5.2xlarge"]}
+config_overrides = {}
+
+
+def lambda_handler(event, context):
+    # Set up for Manual Trigger
+    bucket_name = "BUCKET"
+    prefix = "projects/2018_11_20_Periscope_X/workspace/"
+    batch = event["batch"]
+    step = event["step"]
+    app_name = event["app_name"]
+    dry_run = event.get("dry_run", True)
+
+    monitor_folder = os.path.join(prefix, "monitors", batch, step)
+    monitor_name = event_monitor.monitor_file_name(app_name)
+    s3.download(
+        bucket_name, os.path.join(monitor_folder, monitor_name), "/tmp/" + monitor_name
+    )
+    with open("/tmp/" + monitor_name, "r") as f:
+        monitorInfo = json.load(f)
+    if "MONITOR_CONFIG_DICT" not in monitorInfo:
+        print("Monitor file for", app_name, "predates reruns; can't rebuild its config")
+        return "No config"
+    state = event_monitor.S3StateFile(
+        s3,
+        bucket_name,
+        os.path.join(monitor_folder, event_monitor.state_file_name(app_name)),
+    ).load()
+    if state and state["state"] != event_monitor.DONE:
+        print(app_name, "is still", state["state"], "; its jobs may still succeed")
+        return "Still work ongoing"
+
+    manifest_name = job_manifest.manifest_file_name(app_name)
+    try:
+        s3.download(
+            bucket_name,
+            os.path.join(monitor_folder, manifest_name),
+            "/tmp/" + manifest_name,
+        )
+    except storage.NoSuchKey:
+        print("No job manifest for", app_name)
+        if os.path.exists("/tmp/" + manifest_name):
+            os.remove("/tmp/" + manifest_name)
+    manifest = job_manifest.load_manifest("/tmp/" + manifest_name)
+
+    run_DCP.grab_batch_config(bucket_name, prefix, batch)
+    import boto3_setup
+
+    queue_url = dead_letters.dead_letter_queue_url(
+        sqs, boto3_setup.SQS_DEAD_LETTER_QUEUE
+    )
+    failed = dead_letters.drain_dead_letters(sqs, queue_url, app_name, manifest)
+    if not failed:
+        return "No failed jobs"
+
+    # Write the triage report next to the step's monitor
+    report = {
+        "app_name": app_name,
+        "failed_jobs": len(failed),
+        "failures": dead_letters.group_failures([x[1] for x in failed]),
+    }
+    report_key = os.path.join(monitor_folder, app_name + "DeadLetters.json")
+    s3.put(bucket_name, report_key, json.dumps(report, indent=4))
+    print("Wrote triage report to", report_key)
+    if dry_run:
+        # Hand the messages back so a later, real rerun can find them
+        dead_letters.release_dead_letters(sqs, queue_url, [x[0] for x in failed])
+        return "Dry run"
+
+    config_dict = dead_letters.escalate_config(
+        monitorInfo["MONITOR_CONFIG_DICT"], escalation_factor, config_overrides
+    )
+    cellprofiler = "distributed-fiji" not in config_dict["DOCKERHUB_TAG"]
+    rerun_app_name = run_DCP.run_setup(
+        bucket_name, prefix, batch, config_dict, cellprofiler=cellprofiler
+    )
+
+    queue = create_batch_jobs.JobQueue(rerun_app_name + "Queue")
+    for receipt, body in failed:
+        queue.scheduleBatch(body)
+    queue.saveManifest()
+    # Only forget the failures once they are safely on the rerun queue
+    dead_letters.delete_dead_letters(sqs, queue_url, [x[0] for x in failed])
+    print("Resubmitted", len(failed), "jobs to", rerun_app_name)
+
+    run_DCP.run_cluster(bucket_name, prefix, batch, len(failed), config_dict)
+    run_DCP.run_monitor(bucket_name, prefix, batch, step + "rerun", config_dict)
+    return "Cluster started"
@@ -0,0 +1,73 @@
+import json
+import os
+import sys
+
+sys.path.append("/opt/pooled-cell-painting-lambda")
+
+import run_DCP
+import event_monitor
+import helpful_functions
+import storage
+
+s3 = storage.default_storage()
+
+# Triggered by an EventBridge schedule (every few minutes), by EC2 Spot Fleet
+# events, or by CloudWatch alarm state changes on a step's queue. Each invocation
+# advances every unfinished monitor under monitors/ by one short check.
+
+
+def lambda_handler(event, context):
+    # Set up for Manual Trigger
+    bucket_name = "BUCKET"
+    prefix = "projects/2018_11_20_Periscope_X/workspace/"
+
+    # Narrow down to the step the event is about, if it is about one
+    fleet_ids = [
+        x.split("spot-fleet-request/")[-1]
+        for x in event.get("resources", [])
+        if "spot-fleet-request/" in x
+    ]
+    alarm_name = event.get("detail", {}).get("alarmName")
+
+    monitor_list = helpful_functions.paginate_a_folder(
+        s3, bucket_name, os.path.join(prefix, "monitors/")
+    )
+    if not monitor_list:
+        return "No monitors"
+    monitor_list = [x for x in monitor_list if x.endswith("SpotFleetRequestId.json")]
+
+    results = {}
+    for monitor_key in monitor_list:
+        app_name = monitor_key.split("/")[-1][: -len("SpotFleetRequestId.json")]
+        batch = monitor_key.split("/")[-3]
+        if alarm_name and not alarm_name.startswith(app_name):
+            continue
+        monitor_folder = monitor_key.rsplit("/", 1)[0]
+        state_file = event_monitor.S3StateFile(
+            s3,
+            bucket_name,
+            os.path.join(monitor_folder, event_monitor.state_file_name(app_name)),
+        )
+        state = state_file.load()
+        if state and state["state"] == event_monitor.DONE:
+            continue
+        local_monitor_name = "/tmp/" + event_monitor.monitor_file_name(app_name)
+        s3.download(bucket_name, monitor_key, local_monitor_name)
+        with open(local_monitor_name, "r") as f:
+            monitorInfo = json.load(f)
+        if fleet_ids and monitorInfo["MONITOR_FLEET_ID"] not in fleet_ids:
+            continue
+
+        print("Checking", app_name)
+        run_DCP.grab_batch_config(bucket_name, prefix, batch)
+        machine = helpful_functions.step_monitor(
+            s3, bucket_name, monitor_folder, app_name
+        )
+        try:
+            results[app_name] = machine.check()
+        except Exception as error:
+            # One broken step shouldn't stop the others from being monitored
+            print("Monitor check of", app_name, "failed with error", error)
+            results[app_name] = "ERROR"
+    print(results)
+    return results
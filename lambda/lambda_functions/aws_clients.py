@@ -0,0 +1,56 @@
+import threading
+
+# One client per service (and region/endpoint), made on first use and kept for the
+# life of the process, so warm lambda invocations reuse their open connections.
+# Adaptive retries back off client-side when AWS throttles us, rather than
+# failing the trigger.
+
+# At least as many as the biggest thread pool sharing a client (teardown, the
+# orchestrator's launches, storage.MAX_CONCURRENCY)
+MAX_POOL_CONNECTIONS = 50
+MAX_ATTEMPTS = 10
+
+_clients = {}
+_resources = {}
+_lock = threading.Lock()
+
+
+def client_config(max_pool_connections=MAX_POOL_CONNECTIONS, read_timeout=60):
+    from botocore.config import Config
+
+    return Config(
+        max_pool_connections=max_pool_connections,
+        read_timeout=read_timeout,
+        retries={"mode": "adaptive", "max_attempts": MAX_ATTEMPTS},
+    )
+
+
+def client(service, region_name=None, endpoint_url=None, read_timeout=60):
+    # Calls that wait on long work, like synchronous lambda invokes, need a longer
+    # read_timeout than botocore's default
+    key = (service, region_name, endpoint_url, read_timeout)
+    # Creating clients on boto3's default session isn't thread safe
+    with _lock:
+        if key not in _clients:
+            import boto3
+
+            _clients[key] = boto3.client(
+                service,
+                region_name=region_name,
+                endpoint_url=endpoint_url,
+                config=client_config(read_timeout=read_timeout),
+            )
+        return _clients[key]
+
+
+def resource(service, region_name=None):
+    # Resources can't be shared between threads, so each thread gets its own
+    key = (service, region_name, threading.get_ident())
+    with _lock:
+        if key not in _resources:
+            import boto3
+
+            _resources[key] = boto3.resource(
+                service, region_name=region_name, config=client_config()
+            )
+        return _resources[key]
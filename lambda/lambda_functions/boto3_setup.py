@@ -1,20 +1,33 @@
 import os, sys
-import boto3
 import datetime
 import json
 import time
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 import numpy
 
+import aws_clients
+import event_monitor
+import fleet_scaling
+import job_manifest
+import queue_urls
+import step_status
+import storage
+import streaming
+
 CPU_SHARES = 1024
 from configAWS import *
 
 WAIT_TIME = 60
 MONITOR_TIME = 60
+LOG_EXPORT_POLL_TIME = 10
+# The workers log this once a job's outputs are safely on S3
+SUCCESS_LOG_PATTERN = '"SUCCESS"'
+TEARDOWN_WORKERS = 8
 
 #################################
 # AUXILIARY FUNCTIONS
@@ -44,7 +57,7 @@ def generate_task_definition(config_dict):
             }
         ],
     }
-    sqs = boto3.client("sqs")
+    sqs = aws_clients.client("sqs")
     queue_name = get_queue_url(sqs, config_dict)
     task_definition["containerDefinitions"][0]["environment"] += [
         {"name": "APP_NAME", "value": config_dict["APP_NAME"]},
@@ -98,7 +111,7 @@ def generate_fiji_task_definition(config_dict):
             }
         ],
     }
-    sqs = boto3.client("sqs")
+    sqs = aws_clients.client("sqs")
     queue_name = get_queue_url(sqs, config_dict)
     task_definition["containerDefinitions"][0]["environment"] += [
         {"name": "APP_NAME", "value": config_dict["APP_NAME"]},
@@ -168,12 +181,7 @@ def create_or_update_ecs_service(ecs, ECS_SERVICE_NAME, ECS_TASK_NAME):
 
 
 def get_queue_url(sqs, config_dict):
-    result = sqs.list_queues()
-    if "QueueUrls" in list(result.keys()):
-        for u in result["QueueUrls"]:
-            if u.split("/")[-1] == (config_dict["APP_NAME"] + "Queue"):
-                return u
-    return None
+    return queue_urls.queue_url(sqs, config_dict["APP_NAME"] + "Queue")
 
 
 def get_or_create_queue(sqs, config_dict):
@@ -191,7 +199,8 @@ def get_or_create_queue(sqs, config_dict):
     u = get_queue_url(sqs, config_dict)
     if u is None:
         print("Creating queue")
-        sqs.create_queue(QueueName=SQS_QUEUE_NAME, Attributes=SQS_DEFINITION)
+        queue = sqs.create_queue(QueueName=SQS_QUEUE_NAME, Attributes=SQS_DEFINITION)
+        queue_urls.remember(SQS_QUEUE_NAME, queue["QueueUrl"])
         time.sleep(WAIT_TIME)
     else:
         print("Queue exists")
@@ -209,8 +218,8 @@ def generateECSconfig(ECS_CLUSTER, APP_NAME, AWS_BUCKET, s3client):
     configfile.write("ECS_CLUSTER=" + ECS_CLUSTER + "\n")
     configfile.write('ECS_AVAILABLE_LOGGING_DRIVERS=["json-file","awslogs"]')
     configfile.close()
-    s3client.upload_file(
-        "/tmp/configtemp.config", AWS_BUCKET, "ecsconfigs/" + APP_NAME + "_ecs.config",
+    s3client.upload(
+        AWS_BUCKET, "/tmp/configtemp.config", "ecsconfigs/" + APP_NAME + "_ecs.config"
     )
     os.remove("/tmp/configtemp.config")
     return "s3://" + AWS_BUCKET + "/ecsconfigs/" + APP_NAME + "_ecs.config"
@@ -248,15 +257,21 @@ def generateUserData(ecsConfigFile, dockerBaseSize):
 
 
 def removequeue(queueName):
-    sqs = boto3.client("sqs")
-    queueoutput = sqs.list_queues(QueueNamePrefix=queueName)
-    if len(queueoutput["QueueUrls"]) == 1:
-        queueUrl = queueoutput["QueueUrls"][0]
-    else:  # In case we have "AnalysisQueue" and "AnalysisQueue1" and only want to delete the first of those
-        for eachUrl in queueoutput["QueueUrls"]:
-            if eachUrl.split("/")[-1] == queueName:
-                queueUrl = eachUrl
-    sqs.delete_queue(QueueUrl=queueUrl)
+    sqs = aws_clients.client("sqs")
+    queueUrl = queue_urls.queue_url(sqs, queueName)
+    if queueUrl is None:
+        print("Queue already removed")
+        return
+    from botocore.exceptions import ClientError
+
+    try:
+        sqs.delete_queue(QueueUrl=queueUrl)
+    except ClientError as error:
+        if not queue_urls.is_missing_queue(error):
+            raise
+        # Deleted since we last looked its URL up
+        print("Queue already removed")
+    queue_urls.forget(queueName)
 
 
 def deregistertask(taskName, ecs):
@@ -267,9 +282,12 @@ def deregistertask(taskName, ecs):
 
 
 def removeClusterIfUnused(clusterName, ecs):
+    # Returns True once there is nothing left for us to remove
     if clusterName != "default":
         # never delete the default cluster
         result = ecs.describe_clusters(clusters=[clusterName])
+        if not result["clusters"] or result["clusters"][0]["status"] == "INACTIVE":
+            return True
         if (
             sum(
                 [
@@ -282,41 +300,62 @@ def removeClusterIfUnused(clusterName, ecs):
             == 0
         ):
             ecs.delete_cluster(cluster=clusterName)
+            print("Removed cluster " + clusterName)
+            return True
+        return False
+    return True
 
 
-def downscaleSpotFleet(queue, spotFleetID, ec2):
-    visible, nonvisible = queue.returnLoad()
-    if visible > 0:
-        return
-    else:
-        status = ec2.describe_spot_fleet_instances(SpotFleetRequestId=spotFleetID)
-        if nonvisible < len(status["ActiveInstances"]):
-            ec2.modify_spot_fleet_request(
-                ExcessCapacityTerminationPolicy="noTermination",
-                SpotFleetRequestId=spotFleetID,
-                TargetCapacity=nonvisible,
-            )
+def deadInstanceIds(fleetId, ec2, starttime):
+    todel = []
+    kwargs = {"SpotFleetRequestId": fleetId, "StartTime": starttime}
+    while True:
+        changes = ec2.describe_spot_fleet_request_history(**kwargs)
+        for eachevent in changes["HistoryRecords"]:
+            if eachevent["EventType"] == "instanceChange":
+                if eachevent["EventInformation"]["EventSubType"] == "terminated":
+                    todel.append(eachevent["EventInformation"]["InstanceId"])
+        if not changes.get("NextToken"):
+            return todel
+        kwargs["NextToken"] = changes["NextToken"]
+
+
+def deleteAlarms(cloud, alarmnames):
+    # DeleteAlarms takes at most 100 names per call; send all the batches at once
+    batches = [alarmnames[i : i + 100] for i in range(0, len(alarmnames), 100)]
+    with ThreadPoolExecutor(max_workers=TEARDOWN_WORKERS) as pool:
+        list(pool.map(lambda x: cloud.delete_alarms(AlarmNames=x), batches))
+
+
+def killdeadAlarms(fleetId, monitorapp, ec2, cloud):
+    starttime = (datetime.datetime.now() - datetime.timedelta(hours=2)).replace(
+        microsecond=0
+    )
+    todel = deadInstanceIds(fleetId, ec2, starttime)
+    deleteAlarms(cloud, [monitorapp + "_" + x for x in todel])
+    print("Old alarms deleted")
 
 
-def export_logs(logs, loggroupId, starttime, bucketId):
-    result = logs.create_export_task(
-        taskName=loggroupId,
-        logGroupName=loggroupId,
-        fromTime=starttime,
-        to=time.time() * 1000,
-        destination=bucketId,
-        destinationPrefix="exportedlogs/" + loggroupId,
-    )
+def start_log_export(logs, loggroupId, starttime, bucketId):
+    # Returns None if another export task is still running; only one may run at a time
+    try:
+        result = logs.create_export_task(
+            taskName=loggroupId,
+            logGroupName=loggroupId,
+            fromTime=int(starttime),
+            to=int(time.time() * 1000),
+            destination=bucketId,
+            destinationPrefix="exportedlogs/" + loggroupId,
+        )
+    except logs.exceptions.LimitExceededException:
+        return None
+    print("Transfer of", loggroupId, "to S3 initiated")
+    return result["taskId"]
 
-    logExportId = result["taskId"]
 
-    while True:
-        result = describe_export_tasks(taskId=logExportId)
-        if result["exportTasks"][0]["status"]["code"] != "PENDING":
-            if result["exportTasks"][0]["status"]["code"] != "RUNNING":
-                print((result["exportTasks"][0]["status"]["code"]))
-                break
-        time.sleep(30)
+def log_export_status(logs, logExportId):
+    result = logs.describe_export_tasks(taskId=logExportId)
+    return result["exportTasks"][0]["status"]["code"]
 
 
 #################################
@@ -326,7 +365,7 @@ def export_logs(logs, loggroupId, starttime, bucketId):
 
 class JobQueue:
     def __init__(self, name=None):
-        self.sqs = boto3.resource("sqs")
+        self.sqs = aws_clients.resource("sqs")
         if name == None:
             self.queue = self.sqs.get_queue_by_name(
                 QueueName=(config_dict["APP_NAME"] + "Queue")
@@ -338,7 +377,16 @@ class JobQueue:
 
     def scheduleBatch(self, data):
         msg = json.dumps(data)
-        response = self.queue.send_message(MessageBody=msg)
+        # Tagged so failures can be picked back out of the shared dead-letter queue
+        response = self.queue.send_message(
+            MessageBody=msg,
+            MessageAttributes={
+                "AppName": {
+                    "StringValue": self.queue.url.split("/")[-1][: -len("Queue")],
+                    "DataType": "String",
+                }
+            },
+        )
         print("Batch sent. Message ID:", response.get("MessageId"))
 
     def pendingLoad(self):
@@ -362,6 +410,168 @@ class JobQueue:
         return visible, nonVis
 
 
+class AWSMonitorBackend:
+    # What event_monitor.MonitorStateMachine needs from AWS for one step
+    def __init__(self, monitor_file):
+        self.monitor_file = monitor_file
+        self.ec2 = aws_clients.client("ec2")
+        self.ecs = aws_clients.client("ecs")
+        self.cloud = aws_clients.client("cloudwatch")
+        self.logs = aws_clients.client("logs")
+
+    def monitor_info(self):
+        return loadConfig(self.monitor_file)
+
+    def queue_load(self, monitorInfo):
+        return JobQueue(name=monitorInfo["MONITOR_QUEUE_NAME"]).returnLoad()
+
+    def fleet_capacity(self, monitorInfo):
+        fleetId = monitorInfo["MONITOR_FLEET_ID"]
+        status = self.ec2.describe_spot_fleet_instances(SpotFleetRequestId=fleetId)
+        request = self.ec2.describe_spot_fleet_requests(SpotFleetRequestIds=[fleetId])
+        target = request["SpotFleetRequestConfigs"][0]["SpotFleetRequestConfig"][
+            "TargetCapacity"
+        ]
+        return len(status["ActiveInstances"]), target
+
+    def set_fleet_capacity(self, monitorInfo, capacity):
+        # Never force terminate; running jobs always get to finish
+        self.ec2.modify_spot_fleet_request(
+            ExcessCapacityTerminationPolicy="noTermination",
+            SpotFleetRequestId=monitorInfo["MONITOR_FLEET_ID"],
+            TargetCapacity=capacity,
+        )
+
+    def set_service_count(self, monitorInfo, count):
+        self.ecs.update_service(
+            cluster=monitorInfo["MONITOR_ECS_CLUSTER"],
+            service=monitorInfo["MONITOR_APP_NAME"] + "Service",
+            desiredCount=count,
+        )
+        print("Service desired count set to", count)
+
+    def kill_dead_alarms(self, monitorInfo):
+        killdeadAlarms(
+            monitorInfo["MONITOR_FLEET_ID"],
+            monitorInfo["MONITOR_APP_NAME"],
+            self.ec2,
+            self.cloud,
+        )
+
+    def fleet_alarm_names(self, monitorInfo):
+        # Alarms from active machines and from machines that died since the step started
+        fleetId = monitorInfo["MONITOR_FLEET_ID"]
+        result = self.ec2.describe_spot_fleet_instances(SpotFleetRequestId=fleetId)
+        instancelist = [x["InstanceId"] for x in result["ActiveInstances"]]
+        starttime = datetime.datetime.fromtimestamp(
+            int(monitorInfo["MONITOR_START_TIME"]) / 1000, tz=datetime.timezone.utc
+        ).replace(microsecond=0)
+        instancelist += deadInstanceIds(fleetId, self.ec2, starttime)
+        return [monitorInfo["MONITOR_APP_NAME"] + "_" + x for x in set(instancelist)]
+
+    def delete_alarms(self, monitorInfo, alarmnames):
+        deleteAlarms(self.cloud, alarmnames)
+
+    def cancel_fleet(self, monitorInfo):
+        print("Shutting down spot fleet", monitorInfo["MONITOR_FLEET_ID"])
+        self.ec2.cancel_spot_fleet_requests(
+            SpotFleetRequestIds=[monitorInfo["MONITOR_FLEET_ID"]],
+            TerminateInstances=True,
+        )
+
+    def remove_queue(self, monitorInfo):
+        print("Deleting existing queue.")
+        removequeue(monitorInfo["MONITOR_QUEUE_NAME"])
+
+    def delete_service(self, monitorInfo):
+        print("Deleting service")
+        try:
+            self.ecs.delete_service(
+                cluster=monitorInfo["MONITOR_ECS_CLUSTER"],
+                service=monitorInfo["MONITOR_APP_NAME"] + "Service",
+                force=True,
+            )
+        except self.ecs.exceptions.ServiceNotFoundException:
+            print("Service already removed")
+
+    def deregister_task(self, monitorInfo):
+        print("De-registering task")
+        deregistertask(monitorInfo["MONITOR_APP_NAME"] + "Task", self.ecs)
+
+    def remove_cluster(self, monitorInfo):
+        return removeClusterIfUnused(monitorInfo["MONITOR_ECS_CLUSTER"], self.ecs)
+
+    def start_log_export(self, monitorInfo, loggroupId):
+        return start_log_export(
+            self.logs,
+            loggroupId,
+            monitorInfo["MONITOR_START_TIME"],
+            monitorInfo["MONITOR_BUCKET_NAME"],
+        )
+
+    def log_export_status(self, logExportId):
+        return log_export_status(self.logs, logExportId)
+
+    def job_manifest(self, monitorInfo):
+        return job_manifest.load_manifest(
+            os.path.join(
+                os.path.dirname(self.monitor_file),
+                job_manifest.manifest_file_name(monitorInfo["MONITOR_APP_NAME"]),
+            )
+        )
+
+    def stream_open(self, monitorInfo):
+        # The monitor lambda keeps the local copy of the marker in step with S3
+        return os.path.exists(
+            os.path.join(
+                os.path.dirname(self.monitor_file),
+                streaming.stream_marker_name(monitorInfo["MONITOR_APP_NAME"]),
+            )
+        )
+
+    def finished_jobs(self, monitorInfo, since):
+        # One log stream per job, so streams that logged success are finished jobs
+        finished = set()
+        paginator = self.logs.get_paginator("filter_log_events")
+        pages = paginator.paginate(
+            logGroupName=monitorInfo["MONITOR_LOG_GROUP_NAME"],
+            startTime=since,
+            filterPattern=SUCCESS_LOG_PATTERN,
+        )
+        for page in pages:
+            finished.update(x["logStreamName"] for x in page["events"])
+        return list(finished)
+
+    def recent_job_runtimes(self, monitorInfo):
+        result = self.logs.describe_log_streams(
+            logGroupName=monitorInfo["MONITOR_LOG_GROUP_NAME"],
+            orderBy="LastEventTime",
+            descending=True,
+            limit=50,
+        )
+        return [
+            [x["logStreamName"], x["firstEventTimestamp"], x["lastEventTimestamp"]]
+            for x in result["logStreams"]
+            if "firstEventTimestamp" in x
+        ]
+
+    def job_start_times(self, monitorInfo, job_ids):
+        # A job's log stream starts when a worker picks it up
+        starts = {}
+        for eachid in job_ids:
+            result = self.logs.describe_log_streams(
+                logGroupName=monitorInfo["MONITOR_LOG_GROUP_NAME"],
+                logStreamNamePrefix=eachid,
+            )
+            for stream in result["logStreams"]:
+                if stream["logStreamName"] == eachid and "firstEventTimestamp" in stream:
+                    starts[eachid] = stream["firstEventTimestamp"]
+        return starts
+
+    def enqueue(self, monitorInfo, message):
+        JobQueue(name=monitorInfo["MONITOR_QUEUE_NAME"]).scheduleBatch(message)
+
+
 #################################
 # SERVICE 1: SETUP
 #################################
@@ -371,9 +581,9 @@ def setup(config_dict, cellprofiler):
     print(config_dict["APP_NAME"], "setup started")
     ECS_TASK_NAME = config_dict["APP_NAME"] + "Task"
     ECS_SERVICE_NAME = config_dict["APP_NAME"] + "Service"
-    sqs = boto3.client("sqs")
+    sqs = aws_clients.client("sqs")
     get_or_create_queue(sqs, config_dict)
-    ecs = boto3.client("ecs")
+    ecs = aws_clients.client("ecs")
     get_or_create_cluster(ecs)
     update_ecs_task_definition(ecs, ECS_TASK_NAME, config_dict, cellprofiler)
     create_or_update_ecs_service(ecs, ECS_SERVICE_NAME, ECS_TASK_NAME)
@@ -424,27 +634,10 @@ def submitJob():
 #################################
 
 
-def startCluster(fleetfile, njobs, config_dict):
-
-    print(njobs, "jobs to do")
-
-    try:
-        DOCKER_CORES = float(config_dict["DOCKER_CORES"])
-    except:
-        DOCKER_CORES = 1.0
-    nmachines = min(
-        200,
-        int(
-            numpy.ceil(
-                float(njobs) / (DOCKER_CORES * int(config_dict["TASKS_PER_MACHINE"]))
-            )
-        ),
-    )
-
-    print(nmachines, "machines being started to run them")
-
+def requestFleet(fleetfile, nmachines, config_dict, ec2client):
+    # Requests the spot fleet and returns its monitorInfo
     # Step 1: set up the configuration files
-    s3client = boto3.client("s3")
+    s3client = storage.default_storage()
     ecsConfigFile = generateECSconfig(
         ECS_CLUSTER, config_dict["APP_NAME"], AWS_BUCKET, s3client
     )
@@ -469,33 +662,64 @@ def startCluster(fleetfile, njobs, config_dict):
         ] = config_dict["MACHINE_TYPE"][LaunchSpecification]
 
     # Step 2: make the spot fleet request
-    ec2client = boto3.client("ec2")
     requestInfo = ec2client.request_spot_fleet(SpotFleetRequestConfig=spotfleetConfig)
     print("Request in process. Wait until your machines are available in the cluster.")
     print("SpotFleetRequestId", requestInfo["SpotFleetRequestId"])
 
     # Step 3: Make the monitor
     starttime = str(int(time.time() * 1000))
-    createMonitor = open(
-        "/tmp/" + config_dict["APP_NAME"] + "SpotFleetRequestId.json", "w"
-    )
-    createMonitor.write(
-        '{"MONITOR_FLEET_ID" : "' + requestInfo["SpotFleetRequestId"] + '",\n'
-    )
-    createMonitor.write('"MONITOR_APP_NAME" : "' + config_dict["APP_NAME"] + '",\n')
-    createMonitor.write('"MONITOR_ECS_CLUSTER" : "' + ECS_CLUSTER + '",\n')
-    createMonitor.write(
-        '"MONITOR_QUEUE_NAME" : "' + (config_dict["APP_NAME"] + "Queue") + '",\n'
-    )
-    createMonitor.write('"MONITOR_BUCKET_NAME" : "' + AWS_BUCKET + '",\n')
-    createMonitor.write(
-        '"MONITOR_LOG_GROUP_NAME" : "' + config_dict["APP_NAME"] + '",\n'
+    monitorInfo = {
+        "MONITOR_FLEET_ID": requestInfo["SpotFleetRequestId"],
+        "MONITOR_APP_NAME": config_dict["APP_NAME"],
+        "MONITOR_ECS_CLUSTER": ECS_CLUSTER,
+        "MONITOR_QUEUE_NAME": config_dict["APP_NAME"] + "Queue",
+        "MONITOR_BUCKET_NAME": AWS_BUCKET,
+        "MONITOR_LOG_GROUP_NAME": config_dict["APP_NAME"],
+        "MONITOR_START_TIME": starttime,
+    }
+    monitorInfo.update(fleet_scaling.scaling_settings(config_dict))
+    # Kept so reruns (e.g. dead_letters.escalate_config) can start from the step's own config
+    monitorInfo["MONITOR_CONFIG_DICT"] = config_dict
+    return monitorInfo
+
+
+def startCluster(fleetfile, njobs, config_dict, monitorInfo=None, fleet_requested=None):
+    # monitorInfo is the monitor of a fleet already requested for this launch, by an
+    # invocation that timed out, to wait on instead of requesting another.
+    # fleet_requested(monitorInfo), if given, is called as soon as the fleet is known,
+    # before waiting on its instances.
+    print(njobs, "jobs to do")
+
+    try:
+        DOCKER_CORES = float(config_dict["DOCKER_CORES"])
+    except:
+        DOCKER_CORES = 1.0
+    nmachines = min(
+        200,
+        int(
+            numpy.ceil(
+                float(njobs) / (DOCKER_CORES * int(config_dict["TASKS_PER_MACHINE"]))
+            )
+        ),
     )
-    createMonitor.write('"MONITOR_START_TIME" : "' + starttime + '"}\n')
-    createMonitor.close()
+
+    print(nmachines, "machines being started to run them")
+
+    ec2client = aws_clients.client("ec2")
+    if monitorInfo is not None:
+        print("Spot fleet already requested", monitorInfo["MONITOR_FLEET_ID"])
+    else:
+        monitorInfo = requestFleet(fleetfile, nmachines, config_dict, ec2client)
+    fleet_id = monitorInfo["MONITOR_FLEET_ID"]
+    with open(
+        "/tmp/" + config_dict["APP_NAME"] + "SpotFleetRequestId.json", "w"
+    ) as createMonitor:
+        json.dump(monitorInfo, createMonitor, indent=0)
+    if fleet_requested is not None:
+        fleet_requested(monitorInfo)
 
     # Step 4: Create a log group for this app and date if one does not already exist
-    logclient = boto3.client("logs")
+    logclient = aws_clients.client("logs")
     loggroupinfo = logclient.describe_log_groups(
         logGroupNamePrefix=config_dict["APP_NAME"]
     )
@@ -515,7 +739,7 @@ def startCluster(fleetfile, njobs, config_dict):
 
     # Step 5: update the ECS service to be ready to inject docker containers in EC2 instances
     print("Updating service")
-    ecs = boto3.client("ecs")
+    ecs = aws_clients.client("ecs")
     ecs.update_service(
         cluster=ECS_CLUSTER,
         service=config_dict["APP_NAME"] + "Service",
@@ -525,14 +749,14 @@ def startCluster(fleetfile, njobs, config_dict):
 
     # Step 6: Monitor the creation of the instances until all are present
     status = ec2client.describe_spot_fleet_instances(
-        SpotFleetRequestId=requestInfo["SpotFleetRequestId"]
+        SpotFleetRequestId=fleet_id
     )
     while len(status["ActiveInstances"]) < nmachines:
         # First check to make sure there's not a problem
         print(datetime.datetime.now().replace(microsecond=0))
         # hackery to deal with time zones
         errorcheck = ec2client.describe_spot_fleet_request_history(
-            SpotFleetRequestId=requestInfo["SpotFleetRequestId"],
+            SpotFleetRequestId=fleet_id,
             EventType="error",
             StartTime=(datetime.datetime.now() - datetime.timedelta(hours=4)).replace(
                 microsecond=0
@@ -551,7 +775,7 @@ def startCluster(fleetfile, njobs, config_dict):
                     )
                 )
             ec2client.cancel_spot_fleet_requests(
-                SpotFleetRequestIds=[requestInfo["SpotFleetRequestId"]],
+                SpotFleetRequestIds=[fleet_id],
                 TerminateInstances=True,
             )
             return
@@ -560,7 +784,7 @@ def startCluster(fleetfile, njobs, config_dict):
         print(".")
         time.sleep(20)
         status = ec2client.describe_spot_fleet_instances(
-            SpotFleetRequestId=requestInfo["SpotFleetRequestId"]
+            SpotFleetRequestId=fleet_id
         )
 
     print("Spot fleet successfully created. Your job should start in a few minutes.")
@@ -571,112 +795,97 @@ def startCluster(fleetfile, njobs, config_dict):
 #################################
 
 
-def upload_monitor(bucket_name, prefix, batch, step, config_dict):
-    s3 = boto3.client("s3")
-    json_on_bucket_name = (
-        prefix
-        + "monitors/"
-        + batch
-        + "/"
-        + step
-        + "/"
-        + config_dict["APP_NAME"]
-        + "SpotFleetRequestId.json"
-    )
-    with open("/tmp/" + config_dict["APP_NAME"] + "SpotFleetRequestId.json", "rb") as a:
-        s3.put_object(Body=a, Bucket=bucket_name, Key=json_on_bucket_name)
-
+def monitor_folder_name(prefix, batch, step):
+    return prefix + "monitors/" + batch + "/" + step
 
-def monitor(config_dict):
 
-    monitorInfo = loadConfig(
-        "/tmp/" + config_dict["APP_NAME"] + "SpotFleetRequestId.json"
+def upload_monitor_file(bucket_name, prefix, batch, step, config_dict):
+    # The monitor file and job manifest, along with a fresh monitor state so a rerun
+    # of this step doesn't inherit a finished one; returns the monitor's folder on S3
+    s3 = storage.default_storage()
+    monitor_folder = monitor_folder_name(prefix, batch, step)
+    s3.upload(
+        bucket_name,
+        "/tmp/" + config_dict["APP_NAME"] + "SpotFleetRequestId.json",
+        monitor_folder + "/" + config_dict["APP_NAME"] + "SpotFleetRequestId.json",
     )
-    monitorcluster = monitorInfo["MONITOR_ECS_CLUSTER"]
-    monitorapp = monitorInfo["MONITOR_APP_NAME"]
-    fleetId = monitorInfo["MONITOR_FLEET_ID"]
-    queueId = monitorInfo["MONITOR_QUEUE_NAME"]
-
-    ec2 = boto3.client("ec2")
-    cloud = boto3.client("cloudwatch")
-    # Step 1: Create job and count messages periodically
-    queue = JobQueue(name=queueId)
-    while queue.pendingLoad():
-        # Once an hour (except at midnight) check for terminated machines and delete their alarms.
-        # This is slooooooow, which is why we don't just do it at the end
-        curtime = datetime.datetime.now().strftime("%H%M")
-        if curtime[-2:] == "00":
-            if curtime[:2] != "00":
-                killdeadAlarms(fleetId, monitorapp, ec2, cloud)
-        # Once every 10 minutes, check if all jobs are in process, and if so scale the spot fleet size to match
-        # the number of jobs still in process WITHOUT force terminating them.
-        # This can help keep costs down if, for example, you start up 100+ machines to run a large job, and
-        # 1-10 jobs with errors are keeping it rattling around for hours.
-        if curtime[-1:] == "9":
-            downscaleSpotFleet(queue, fleetId, ec2)
-        time.sleep(MONITOR_TIME)
-
-    # Step 2: When no messages are pending, stop service
-    # Reload the monitor info, because for long jobs new fleets may have been started, etc
-    monitorInfo = loadConfig(
-        "/tmp/" + config_dict["APP_NAME"] + "SpotFleetRequestId.json"
+    manifest_name = job_manifest.manifest_file_name(config_dict["APP_NAME"])
+    if os.path.exists("/tmp/" + manifest_name):
+        s3.upload(
+            bucket_name, "/tmp/" + manifest_name, monitor_folder + "/" + manifest_name
+        )
+    state_name = event_monitor.state_file_name(config_dict["APP_NAME"])
+    state = event_monitor.new_state()
+    event_monitor.LocalStateFile("/tmp/" + state_name).save(state)
+    event_monitor.S3StateFile(s3, bucket_name, monitor_folder + "/" + state_name).save(
+        state
     )
-    monitorcluster = monitorInfo["MONITOR_ECS_CLUSTER"]
-    monitorapp = monitorInfo["MONITOR_APP_NAME"]
-    fleetId = monitorInfo["MONITOR_FLEET_ID"]
-    queueId = monitorInfo["MONITOR_QUEUE_NAME"]
-    bucketId = monitorInfo["MONITOR_BUCKET_NAME"]
-    loggroupId = monitorInfo["MONITOR_LOG_GROUP_NAME"]
-    starttime = monitorInfo["MONITOR_START_TIME"]
-
-    ecs = boto3.client("ecs")
-    ecs.update_service(
-        cluster=monitorcluster, service=monitorapp + "Service", desiredCount=0
+    return monitor_folder
+
+
+def upload_monitor(
+    bucket_name,
+    prefix,
+    batch,
+    step,
+    config_dict,
+    streaming_step=False,
+    monitor_uploaded=False,
+):
+    s3 = storage.default_storage()
+    if monitor_uploaded:
+        # Uploaded as soon as the fleet was requested, and maybe checked on since
+        monitor_folder = monitor_folder_name(prefix, batch, step)
+    else:
+        monitor_folder = upload_monitor_file(
+            bucket_name, prefix, batch, step, config_dict
+        )
+    if streaming_step:
+        # Keeps the monitor from tearing the step down between batches of wells
+        marker_name = streaming.stream_marker_name(config_dict["APP_NAME"])
+        marker = {"app_name": config_dict["APP_NAME"], "opened": time.time()}
+        event_monitor.LocalStateFile("/tmp/" + marker_name).save(marker)
+        event_monitor.S3StateFile(
+            s3, bucket_name, monitor_folder + "/" + marker_name
+        ).save(marker)
+
+
+def extend_monitor(bucket_name, prefix, batch, step, config_dict):
+    # Adds the jobs just sent to a running step to the manifest its monitor reads
+    s3 = storage.default_storage()
+    manifest_name = job_manifest.manifest_file_name(config_dict["APP_NAME"])
+    manifest_file = event_monitor.S3StateFile(
+        s3,
+        bucket_name,
+        prefix + "monitors/" + batch + "/" + step + "/" + manifest_name,
     )
-    print("Service has been downscaled")
+    manifest = manifest_file.load()
+    new_jobs = job_manifest.load_manifest("/tmp/" + manifest_name)
+    if manifest is None:
+        manifest = new_jobs
+    else:
+        manifest["jobs"].update(new_jobs["jobs"])
+    manifest_file.save(manifest)
+    print(config_dict["APP_NAME"], "manifest now has", len(manifest["jobs"]), "jobs")
 
-    # Step3: Delete the alarms from active machines and machines that have died since the last sweep
-    # This is in a try loop, because while it is important, we don't want to not stop the spot fleet
-    try:
-        result = ec2.describe_spot_fleet_instances(SpotFleetRequestId=fleetId)
-        instancelist = result["ActiveInstances"]
-        while len(instancelist) > 0:
-            to_del = instancelist[:100]
-            del_alarms = [monitorapp + "_" + x["InstanceId"] for x in to_del]
-            cloud.delete_alarms(AlarmNames=del_alarms)
-            time.sleep(10)
-            instancelist = instancelist[100:]
-        killdeadAlarms(fleetId, monitorapp)
-    except:
-        pass
 
-    # Step 4: Read spot fleet id and terminate all EC2 instances
-    print("Shutting down spot fleet", fleetId)
-    ec2.cancel_spot_fleet_requests(
-        SpotFleetRequestIds=[fleetId], TerminateInstances=True
+def monitor(config_dict):
+    # Drive the same state machine the scheduled monitor lambda uses, from a single process
+    monitor_file = "/tmp/" + event_monitor.monitor_file_name(config_dict["APP_NAME"])
+    state_file = event_monitor.LocalStateFile(
+        "/tmp/" + event_monitor.state_file_name(config_dict["APP_NAME"])
     )
-    print("Job done.")
-
-    # Step 5. Release other resources
-    # Remove SQS queue, ECS Task Definition, ECS Service
-    ECS_TASK_NAME = monitorapp + "Task"
-    ECS_SERVICE_NAME = monitorapp + "Service"
-    print("Deleting existing queue.")
-    removequeue(queueId)
-    print("Deleting service")
-    ecs.delete_service(cluster=monitorcluster, service=ECS_SERVICE_NAME)
-    print("De-registering task")
-    deregistertask(ECS_TASK_NAME, ecs)
-    print("Removing cluster if it's not the default and not otherwise in use")
-    removeClusterIfUnused(monitorcluster, ecs)
-
-    # Step 6: Export the logs to S3
-    logs = boto3.client("logs")
-
-    print("Transfer of CellProfiler logs to S3 initiated")
-    export_logs(logs, loggroupId, starttime, bucketId)
-
-    print("Transfer of per-instance to S3 initiated")
-    export_logs(logs, loggroupId + "_perInstance", starttime, bucketId)
-
-    print("All export tasks done")
+    status_file = event_monitor.LocalStateFile(
+        "/tmp/" + step_status.status_file_name(config_dict["APP_NAME"])
+    )
+    machine = event_monitor.MonitorStateMachine(
+        AWSMonitorBackend(monitor_file), state_file, status_file
+    )
+    state = machine.check()
+    while state != event_monitor.DONE:
+        # Once the paid resources are released only the log exports are left to watch
+        if state == event_monitor.EXPORTING_LOGS:
+            time.sleep(LOG_EXPORT_POLL_TIME)
+        else:
+            time.sleep(MONITOR_TIME)
+        state = machine.check()
@@ -0,0 +1,172 @@
+import functools
+import json
+import os
+import time
+
+import leases
+import storage
+
+# A step lambda that times out part way through launching a step (plates' CSVs
+# made, queue set up, some of its jobs sent) leaves a checkpoint next to the batch
+# metadata saying how far it got. When the step is invoked again, by Lambda's own
+# retry or by hand, it picks up after the last completed phase and the last message
+# sent rather than starting over, so it doesn't send the step's jobs again or start
+# a second cluster: the spot fleet is recorded as soon as it's requested, before
+# waiting on its instances. Phases are "csvs", "setup", "jobs" and "cluster", in
+# that order, though not every step has them all. The checkpoint is removed once
+# the monitor is up; delete it by hand to launch a step from scratch instead. Each
+# invocation records how it ended, and only one that ran out of time is picked up
+# from: after one that failed, the next trigger goes through the step's usual
+# checks again.
+
+# A timeout can resend at most this many messages that were sent but not yet saved
+SAVE_EVERY_MESSAGES = 25
+
+# The checkpoint claimed by the invocation in progress, for record_endings
+current = None
+
+
+def checkpoint_key(prefix, batch, app_name):
+    return os.path.join(prefix, "metadata", batch, "checkpoints", app_name + ".json")
+
+
+def run_lease_key(prefix, app_name):
+    return os.path.join(prefix, "leases", app_name + "Run")
+
+
+def invocation_seconds(context):
+    # Until this invocation is stopped; its lease on the run can't outlive it
+    if context is None:
+        return leases.LAUNCH_LEASE_SECONDS
+    return context.get_remaining_time_in_millis() / 1000.0
+
+
+def record_endings(handler):
+    # Wraps a step's lambda_handler so an invocation that claims its checkpoint
+    # and then fails, or returns without finishing the launch, says so in it.
+    # One that times out is stopped before it can, so leaves no ending.
+    @functools.wraps(handler)
+    def wrapped(event, context):
+        global current
+        current = None
+        try:
+            result = handler(event, context)
+        except Exception as e:
+            if current is not None:
+                current.end("failed", repr(e))
+            raise
+        if current is not None and not current.finished:
+            current.end("returned", result)
+        return result
+
+    return wrapped
+
+
+class StepCheckpoint:
+    def __init__(self, s3, bucket_name, prefix, batch, app_name):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = checkpoint_key(prefix, batch, app_name)
+        self.lease_key = run_lease_key(prefix, app_name)
+        self.owner = leases.new_owner()
+        self.unsaved = 0
+        self.finished = False
+        try:
+            self.state = json.loads(s3.get(bucket_name, self.key))
+            print("Found checkpoint for", app_name, "after", self.state["phases"])
+        except storage.NoSuchKey:
+            self.state = {
+                "app_name": app_name,
+                "batch": batch,
+                "phases": [],
+                "plates_done": [],
+                "messages_sent": 0,
+                "invocations": [],
+            }
+
+    def resuming(self):
+        # An earlier invocation got part of the way through this run and was
+        # stopped for running out of time
+        if not self.state["invocations"]:
+            return False
+        last = self.state["invocations"][-1]
+        return last.get("ended") is None and last["deadline"] < time.time()
+
+    def claim(self, context=None):
+        # Only one invocation works on a run at a time; an earlier one's claim
+        # lapses when that invocation is stopped
+        if not leases.acquire(
+            self.s3,
+            self.bucket_name,
+            self.lease_key,
+            self.owner,
+            invocation_seconds(context),
+        ):
+            print("Another invocation is still working on this step")
+            return False
+        global current
+        current = self
+        started = time.time()
+        self.state["invocations"].append(
+            {
+                "id": getattr(context, "aws_request_id", self.owner),
+                "started": started,
+                "deadline": started + invocation_seconds(context),
+                "ended": None,
+            }
+        )
+        self.save()
+        return True
+
+    def end(self, ended, detail=None):
+        # Records how this invocation ended without finishing the launch, and lets
+        # the next one claim the run straight away
+        self.state["invocations"][-1]["ended"] = ended
+        self.state["invocations"][-1]["detail"] = str(detail)
+        self.save()
+        leases.release(self.s3, self.bucket_name, self.lease_key, self.owner)
+        print("Launch of", self.state["app_name"], ended, "-", detail)
+
+    def done(self, phase):
+        return phase in self.state["phases"]
+
+    def complete(self, phase):
+        if not self.done(phase):
+            self.state["phases"].append(phase)
+        self.save()
+
+    def requested_fleet(self):
+        # The monitorInfo of the spot fleet requested for this run, if it got that far
+        return self.state.get("fleet")
+
+    def fleet_requested(self, monitorInfo):
+        if self.state.get("fleet") != monitorInfo:
+            self.state["fleet"] = monitorInfo
+            self.save()
+
+    def plates_to_do(self, platelist):
+        return [x for x in platelist if x not in self.state["plates_done"]]
+
+    def plate_done(self, plate):
+        self.state["plates_done"].append(plate)
+        self.save()
+
+    def already_sent(self, index):
+        return index < self.state["messages_sent"]
+
+    def message_sent(self, index):
+        self.state["messages_sent"] = index + 1
+        self.unsaved += 1
+        if self.unsaved >= SAVE_EVERY_MESSAGES:
+            self.save()
+
+    def save(self):
+        self.unsaved = 0
+        self.s3.put(self.bucket_name, self.key, json.dumps(self.state))
+
+    def finish(self):
+        # The step is fully launched, so the next trigger starts a fresh run
+        self.finished = True
+        self.s3.delete(self.bucket_name, self.key)
+        leases.release(self.s3, self.bucket_name, self.lease_key, self.owner)
+        print("Launch of", self.state["app_name"], "complete")
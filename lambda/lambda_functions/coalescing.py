@@ -0,0 +1,158 @@
+import datetime
+import json
+import math
+import os
+import time
+import uuid
+
+import aws_clients
+import storage
+
+# Steps triggered by every output file of the step before (3 on each Image.csv,
+# 6 and 8 on each plate's outputs) get thousands of events per batch, nearly all of
+# which would only find work still ongoing. Events are instead grouped into windows
+# per batch and step: every event leaves a small record of its keys, and the first
+# event of a window schedules one check of the step for when the window has closed,
+# so it sees every output that arrived in it. The check is a one-off EventBridge
+# Scheduler invocation of the same lambda, made with the role in
+# PCP_SCHEDULER_ROLE_ARN, so no invocation sits idle waiting for the window.
+# Without a role (or outside Lambda) the first event waits for the window itself,
+# and the step lambdas' timeout needs to allow for WINDOW_SECONDS on top of their
+# usual run time.
+
+WINDOW_SECONDS = 30
+COUNTS_FILE_NAME = "TriggerCounts.json"
+SCHEDULER_ROLE_ENV = "PCP_SCHEDULER_ROLE_ARN"
+CHECK_KEY = "coalesced_check"
+
+
+def trigger_folder(prefix, batch, step):
+    return os.path.join(prefix, "triggers", batch, step)
+
+
+def event_keys(event):
+    return [x["s3"]["object"]["key"] for x in event.get("Records", [])]
+
+
+def record_event(s3, bucket_name, prefix, batch, step, keys, now=None):
+    # Returns how long to wait before checking the step, or None if an earlier
+    # event in this window will already check it after this one
+    if now is None:
+        now = time.time()
+    window = int(now // WINDOW_SECONDS)
+    window_folder = os.path.join(trigger_folder(prefix, batch, step), str(window))
+    s3.put(
+        bucket_name,
+        os.path.join(window_folder, uuid.uuid4().hex + ".json"),
+        json.dumps(keys),
+    )
+    claim = {"claimed": now, "keys": keys}
+    if not s3.put_if_absent(bucket_name, window_folder + ".json", json.dumps(claim)):
+        return None
+    return (window + 1) * WINDOW_SECONDS - now
+
+
+def update_counts(s3, bucket_name, prefix, batch, step, now=None):
+    # Folds the event records of every window so far into TriggerCounts.json and
+    # clears them, along with past windows' claims, so the folder stays small. Only
+    # a running count of outputs is kept, along with the keys new since the last
+    # check.
+    if now is None:
+        now = time.time()
+    folder = trigger_folder(prefix, batch, step)
+    counts_key = os.path.join(folder, COUNTS_FILE_NAME)
+    try:
+        counts = json.loads(s3.get(bucket_name, counts_key))
+    except storage.NoSuchKey:
+        counts = {"events": 0, "checks": 0, "outputs": 0, "new_keys": []}
+    new_keys = set()
+    listed = s3.list(bucket_name, folder + "/")
+    records = [x for x in listed if x.count("/") > counts_key.count("/")]
+    claims = [
+        x
+        for x in listed
+        if x.count("/") == counts_key.count("/")
+        and x != counts_key
+        and int(os.path.basename(x)[: -len(".json")]) < int(now // WINDOW_SECONDS)
+    ]
+    for eachkey in records:
+        try:
+            new_keys.update(json.loads(s3.get(bucket_name, eachkey)))
+        except storage.NoSuchKey:
+            # Already folded in by a check from an overlapping window
+            continue
+        counts["events"] += 1
+    counts["checks"] += 1
+    counts["outputs"] += len(new_keys)
+    counts["new_keys"] = sorted(new_keys)
+    s3.put(bucket_name, counts_key, json.dumps(counts))
+    for eachkey in records + claims:
+        s3.delete(bucket_name, eachkey)
+    print(
+        counts["events"],
+        "trigger events for step",
+        step,
+        "so far, covering",
+        counts["outputs"],
+        "outputs,",
+        len(new_keys),
+        "of them new, in",
+        counts["checks"],
+        "checks",
+    )
+    return counts
+
+
+def check_event(event):
+    # Just enough of the triggering event for the handler to find its batch
+    record = event["Records"][0]["s3"]
+    return {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": record["bucket"]["name"]},
+                    "object": {"key": record["object"]["key"]},
+                }
+            }
+        ],
+        CHECK_KEY: True,
+    }
+
+
+def schedule_check(function_arn, role_arn, step, event, wait):
+    scheduler = aws_clients.client("scheduler")
+    at = datetime.datetime.fromtimestamp(
+        math.ceil(time.time() + wait), datetime.timezone.utc
+    )
+    scheduler.create_schedule(
+        Name="pcp-check-" + step + "-" + uuid.uuid4().hex,
+        ScheduleExpression="at(" + at.strftime("%Y-%m-%dT%H:%M:%S") + ")",
+        ScheduleExpressionTimezone="UTC",
+        FlexibleTimeWindow={"Mode": "OFF"},
+        ActionAfterCompletion="DELETE",
+        Target={
+            "Arn": function_arn,
+            "RoleArn": role_arn,
+            "Input": json.dumps(check_event(event)),
+        },
+    )
+
+
+def coalesce(s3, bucket_name, prefix, batch, step, event, context=None):
+    # Returns the trigger counts if this invocation should go on and check the step;
+    # None if a check is already pending for this event's window
+    if event.get(CHECK_KEY):
+        print("Scheduled check of step", step, "for batch", batch)
+        return update_counts(s3, bucket_name, prefix, batch, step)
+    wait = record_event(s3, bucket_name, prefix, batch, step, event_keys(event))
+    if wait is None:
+        print("Left for the check already pending for batch", batch, "step", step)
+        return None
+    role_arn = os.environ.get(SCHEDULER_ROLE_ENV)
+    if context is not None and role_arn:
+        schedule_check(context.invoked_function_arn, role_arn, step, event, wait)
+        print("Scheduled a check of step", step, "in", int(wait), "s")
+        return None
+    print("Checking step", step, "once this trigger window closes in", int(wait), "s")
+    time.sleep(wait)
+    return update_counts(s3, bucket_name, prefix, batch, step)
@@ -0,0 +1,270 @@
+import re
+
+# A CellProfiler .cppipe as its header, modules and their settings, so pipelines
+# can be edited from code (e.g. step 3's thresholds) and written back out exactly
+# as they were apart from the edits, line endings included. static_cost sums up
+# what a pipeline writes out per image set, before anything is run, and lean cuts
+# it down to the images later steps read.
+
+MODULE_HEADER = re.compile(r"^([A-Za-z0-9_]+):\[(.*)\]$")
+
+# Bytes per pixel of SaveImages' bit depths, uncompressed
+BIT_DEPTH_BYTES = {
+    "8-bit integer": 1,
+    "16-bit integer": 2,
+    "32-bit floating point": 4,
+}
+DEFAULT_PIXEL_BYTES = 2
+# .npy files hold the image's floats whatever the bit depth setting says
+NPY_PIXEL_BYTES = 8
+
+# Images a later step reads, by pipeline; lean drops every other SaveImages
+LEAN_KEPT_IMAGES = {
+    # Step 7's load_data reads the first cycle's DAPI and every cycle's bases
+    "6_BC_Apply_Illum.cppipe": r"^Cycle01_DAPI$|^Cycle\d+_[ACGT]$",
+    # Stitched and cropped in step 8
+    "7_BC_Preprocess.cppipe": r"^Cycle01_DAPI$|^CorrCycle\d+_[ACGT]$",
+    # Only its CSVs are used
+    "9_Analysis.cppipe": None,
+}
+# Modules that make nothing but an image, so can go once no module left uses it
+IMAGE_ONLY_MODULES = [
+    "ConvertObjectsToImage",
+    "GrayToColor",
+    "ImageMath",
+    "OverlayOutlines",
+    "RescaleIntensity",
+    "Resize",
+]
+OUTPUT_IMAGE_SETTING = "Name the output image"
+
+
+def split_ending(line):
+    body = line.rstrip("\r\n")
+    return body, line[len(body) :]
+
+
+class Setting:
+    def __init__(self, line):
+        self.raw = line
+        body, self.ending = split_ending(line)
+        stripped = body.lstrip(" ")
+        self.indent = body[: len(body) - len(stripped)]
+        self.text, _, self.value = stripped.partition(":")
+        self.original_value = self.value
+
+    def serialize(self):
+        if self.value == self.original_value:
+            return self.raw
+        return self.indent + self.text + ":" + self.value + self.ending
+
+
+class Module:
+    def __init__(self, line):
+        self.raw = line
+        body, self.ending = split_ending(line)
+        match = MODULE_HEADER.match(body)
+        self.name = match.group(1)
+        self.attributes = match.group(2)
+        self.original_attributes = self.attributes
+        self.settings = []
+        # Blank lines between this module and the next
+        self.trailer = []
+
+    def attribute(self, key):
+        match = re.search(r"(?:^|\|)" + key + r":([^|]*)", self.attributes)
+        return match.group(1) if match else None
+
+    def set_attribute(self, key, value):
+        self.attributes = re.sub(
+            r"(^|\|)" + key + r":[^|]*",
+            lambda x: x.group(1) + key + ":" + str(value),
+            self.attributes,
+        )
+
+    @property
+    def module_num(self):
+        return int(self.attribute("module_num"))
+
+    @property
+    def enabled(self):
+        return self.attribute("enabled") != "False"
+
+    def settings_named(self, text):
+        # Setting texts repeat in modules with a variable number of groups
+        return [x for x in self.settings if x.text == text]
+
+    def get(self, text, default=None):
+        found = self.settings_named(text)
+        return found[0].value if found else default
+
+    def set(self, text, value):
+        found = self.settings_named(text)
+        if not found:
+            raise KeyError(f"{self.name} has no setting {text}")
+        for setting in found:
+            setting.value = str(value)
+
+    def serialize(self):
+        if self.attributes == self.original_attributes:
+            header = self.raw
+        else:
+            header = self.name + ":[" + self.attributes + "]" + self.ending
+        return (
+            header
+            + "".join(x.serialize() for x in self.settings)
+            + "".join(self.trailer)
+        )
+
+
+class Pipeline:
+    def __init__(self, header, modules):
+        self.header = header
+        self.modules = modules
+
+    def modules_named(self, name):
+        return [x for x in self.modules if x.name == name]
+
+    def remove_modules(self, to_remove):
+        # Renumbers the modules left and keeps ModuleCount in step
+        self.modules = [x for x in self.modules if x not in to_remove]
+        for number, module in enumerate(self.modules, 1):
+            if module.module_num != number:
+                module.set_attribute("module_num", number)
+        for index, line in enumerate(self.header):
+            body, ending = split_ending(line)
+            if body.startswith("ModuleCount:"):
+                self.header[index] = "ModuleCount:" + str(len(self.modules)) + ending
+
+    def serialize(self):
+        return "".join(self.header) + "".join(x.serialize() for x in self.modules)
+
+
+def parse(text):
+    header = []
+    modules = []
+    for line in text.splitlines(True):
+        body = split_ending(line)[0]
+        if MODULE_HEADER.match(body):
+            modules.append(Module(line))
+        elif not modules:
+            header.append(line)
+        elif body.startswith(" ") and not modules[-1].trailer:
+            modules[-1].settings.append(Setting(line))
+        else:
+            modules[-1].trailer.append(line)
+    return Pipeline(header, modules)
+
+
+def load(file_name):
+    # newline="" keeps each line's own ending, which pipelines don't agree on
+    with open(file_name, "r", encoding="utf-8", newline="") as infile:
+        return parse(infile.read())
+
+
+def save(pipeline, file_name):
+    with open(file_name, "w", encoding="utf-8", newline="") as outfile:
+        outfile.write(pipeline.serialize())
+
+
+def resize_factor(module):
+    if "fraction or multiple" not in module.get("Resizing method", ""):
+        return None
+    return float(module.get("Resizing factor"))
+
+
+def lean_name(pipeline_name):
+    return pipeline_name[: -len(".cppipe")] + "_lean.cppipe"
+
+
+def lean(pipeline, kept_images=None):
+    # Drops the SaveImages of images not matching kept_images, then whatever made
+    # only the images dropped. Returns the modules removed.
+    to_remove = [
+        x
+        for x in pipeline.modules_named("SaveImages")
+        if not kept_images
+        or not re.search(kept_images, x.get("Select the image to save", ""))
+    ]
+    while True:
+        left = [x for x in pipeline.modules if x not in to_remove]
+        used = [
+            setting.value
+            for module in left
+            for setting in module.settings
+            if setting.text != OUTPUT_IMAGE_SETTING
+        ]
+        # Substring match, since some settings list several images in one value
+        unused = [
+            x
+            for x in left
+            if x.name in IMAGE_ONLY_MODULES
+            and not any(x.get(OUTPUT_IMAGE_SETTING) in value for value in used)
+        ]
+        if not unused:
+            break
+        to_remove += unused
+    pipeline.remove_modules(to_remove)
+    return to_remove
+
+
+def static_cost(pipeline, image_width=None, image_height=None):
+    # What one image set of the pipeline writes out and how much heavy lifting it
+    # does; output bytes are uncompressed, so an upper bound, and are only
+    # estimated when the size of the input images is given
+    modules = [x for x in pipeline.modules if x.enabled]
+    # How much Resize modules have scaled each image they made, relative to the input
+    scale = {}
+    resize_factors = []
+    for module in modules:
+        if module.name != "Resize":
+            continue
+        factor = resize_factor(module)
+        if factor is None:
+            continue
+        resize_factors.append(factor)
+        input_scale = scale.get(module.get("Select the input image"), 1.0)
+        scale[module.get("Name the output image")] = input_scale * factor
+    saved = []
+    for module in modules:
+        if module.name != "SaveImages":
+            continue
+        image = module.get("Select the image to save")
+        depth = module.get("Image bit depth", "")
+        saved_bytes = None
+        if image_width and image_height:
+            pixels = image_width * image_height * scale.get(image, 1.0) ** 2
+            pixel_bytes = BIT_DEPTH_BYTES.get(depth, DEFAULT_PIXEL_BYTES)
+            if module.get("Saved file format") == "npy":
+                pixel_bytes = NPY_PIXEL_BYTES
+            saved_bytes = int(pixels * pixel_bytes)
+        saved.append(
+            {
+                "image": image,
+                "format": module.get("Saved file format"),
+                "bit_depth": depth,
+                "folder": module.get("Output file location"),
+                "bytes": saved_bytes,
+            }
+        )
+    by_format = {}
+    for eachsave in saved:
+        by_format[eachsave["format"]] = by_format.get(eachsave["format"], 0) + 1
+    output_bytes = None
+    if image_width and image_height:
+        output_bytes = sum(x["bytes"] for x in saved)
+    return {
+        "modules": len(modules),
+        "save_images": len(saved),
+        "saved_by_format": by_format,
+        "saved": saved,
+        "output_bytes": output_bytes,
+        "resize_factors": resize_factors,
+        "align": len([x for x in modules if x.name == "Align"]),
+        "identify_primary_objects": len(
+            [x for x in modules if x.name == "IdentifyPrimaryObjects"]
+        ),
+        "export_to_spreadsheet": len(
+            [x for x in modules if x.name == "ExportToSpreadsheet"]
+        ),
+    }
@@ -95,8 +95,18 @@ def create_CSV_pipeline1(
 
 
 def create_CSV_pipeline3(
-    platename, seriesperwell, path, well_list, range_skip, segmentation_channel
+    platename,
+    seriesperwell,
+    path,
+    well_list,
+    range_skip,
+    segmentation_channel,
+    well_sites=None,
 ):
+    # well_sites, {well: [sites]}, overrides taking every range_skip-th site
+    if well_sites is None:
+        sitelist = list(range(0, seriesperwell, int(range_skip)))
+        well_sites = {eachwell: sitelist for eachwell in well_list}
     columns = [
         "Metadata_Plate",
         "Metadata_Site",
@@ -107,34 +117,35 @@ def create_CSV_pipeline3(
     channels = ["DNA", segmentation_channel]
     columns += [col + chan for col in columns_per_channel for chan in channels]
     df = pd.DataFrame(columns=columns)
-    sitelist = list(range(0, seriesperwell, int(range_skip)))
-    sites_per_well = len(sitelist)
-    total_file_count = sites_per_well * len(well_list)
+    total_file_count = sum(len(well_sites[eachwell]) for eachwell in well_list)
     df["Metadata_Plate"] = [platename] * total_file_count
-    df["Metadata_Site"] = sitelist * len(well_list)
+    site_df_list = []
     well_df_list = []
     well_val_df_list = []
     parsed_well_list = []
     for eachwell in well_list:
+        sites_per_well = len(well_sites[eachwell])
+        site_df_list += well_sites[eachwell]
         well_df_list += [eachwell] * sites_per_well
         wellval = eachwell.split("Well")[1]
         if wellval[0] == "_":
             wellval = wellval[1:]
         well_val_df_list += [wellval] * sites_per_well
         parsed_well_list.append(wellval)
+    df["Metadata_Site"] = site_df_list
     df["Metadata_Well"] = well_df_list
     df["Metadata_Well_Value"] = well_val_df_list
     path_list = [
         os.path.join(path, platename + "-" + well)
         for well in well_list
-        for site in sitelist
+        for site in well_sites[well]
     ]
     for chan in channels:
         df["PathName_" + chan] = path_list
         df["FileName_" + chan] = [
-            f"Plate_{platename}_Well_{well}_Site_{str(site)}_Corr{chan}.tiff"
-            for well in parsed_well_list
-            for site in sitelist
+            f"Plate_{platename}_Well_{wellval}_Site_{str(site)}_Corr{chan}.tiff"
+            for well, wellval in zip(well_list, parsed_well_list)
+            for site in well_sites[well]
         ]
     file_out_name = "/tmp/" + str(platename) + ".csv"
     df.to_csv(file_out_name, index=False)
@@ -1,21 +1,58 @@
 import json
-import boto3
 import string
 import os
 import posixpath
 
+import aws_clients
+import job_manifest
+
+# Set to only record jobs in the manifest, without sending them to SQS, e.g. to
+# run them on one machine with local_runner
+record_only = False
+# Set to a checkpoints.StepCheckpoint to skip the messages an earlier, timed out
+# invocation already sent, and to note each one sent from here on
+checkpoint = None
+
 
 class JobQueue:
     def __init__(self, name=None):
-        self.sqs = boto3.resource("sqs")
-        self.queue = self.sqs.get_queue_by_name(QueueName=name)
+        self.queue = None
+        if not record_only:
+            self.sqs = aws_clients.resource("sqs")
+            self.queue = self.sqs.get_queue_by_name(QueueName=name)
         self.inProcess = -1
         self.pending = -1
+        self.app_name = name[: -len("Queue")]
+        self.manifest = job_manifest.new_manifest(self.app_name)
+        self.checkpoint = checkpoint
+        self.scheduled = 0
 
-    def scheduleBatch(self, data):
+    def scheduleBatch(self, data, plate=None, well=None):
         msg = json.dumps(data)
-        response = self.queue.send_message(MessageBody=msg)
-        print(("Batch sent. Message ID:", response.get("MessageId")))
+        index = self.scheduled
+        self.scheduled += 1
+        if self.checkpoint is not None and self.checkpoint.already_sent(index):
+            # Still recorded below, so the manifest lists every job of the step
+            print("Batch", index, "already sent")
+        elif self.queue is not None:
+            # Tagged so failures can be picked back out of the shared dead-letter queue
+            response = self.queue.send_message(
+                MessageBody=msg,
+                MessageAttributes={
+                    "AppName": {"StringValue": self.app_name, "DataType": "String"}
+                },
+            )
+            print(("Batch sent. Message ID:", response.get("MessageId")))
+            if self.checkpoint is not None:
+                self.checkpoint.message_sent(index)
+        # Record a copy, since callers reuse and mutate their template message
+        job_manifest.add_job(self.manifest, json.loads(msg), plate=plate, well=well)
+
+    def saveManifest(self):
+        if self.checkpoint is not None:
+            self.checkpoint.complete("jobs")
+        # Uploaded next to the monitor file by boto3_setup.upload_monitor
+        return job_manifest.save_manifest(self.manifest)
 
 
 def create_batch_jobs_1(startpath, batchsuffix, illumpipename, platelist, app_name):
@@ -38,6 +75,7 @@ def create_batch_jobs_1(startpath, batchsuffix, illumpipename, platelist, app_na
             ),
         }
         illumqueue.scheduleBatch(templateMessage_illum)
+    illumqueue.saveManifest()
     print("Illum job submitted. Check your queue")
 
 
@@ -66,6 +104,7 @@ def create_batch_jobs_2(
                 ),
             }
             illumqueue.scheduleBatch(templateMessage_illum)
+    illumqueue.saveManifest()
     print("Illum job submitted. Check your queue")
 
 
@@ -97,6 +136,7 @@ def create_batch_jobs_3(
             ),
         }
         segmentqueue.scheduleBatch(templateMessage_segment)
+    segmentqueue.saveManifest()
     print("Segment check job submitted. Check your queue")
 
 
@@ -128,6 +168,7 @@ def create_batch_jobs_3A(
                 ),
             }
             segmentAqueue.scheduleBatch(templateMessage_segmentA)
+    segmentAqueue.saveManifest()
     print("Segment Troubleshoot A job submitted. Check your queue")
 
 
@@ -162,6 +203,7 @@ def create_batch_jobs_3B(
                 ),
             }
             segmentBqueue.scheduleBatch(templateMessage_segmentB)
+    segmentBqueue.saveManifest()
     print("Segment Troubleshoot B job submitted. Check your queue")
 
 
@@ -228,7 +270,10 @@ def create_batch_jobs_4(
             "filterstring": well,
             "downloadfilter": "*" + well + "*",
         }
-        stitchqueue.scheduleBatch(stitchMessage)
+        stitchqueue.scheduleBatch(
+            stitchMessage, plate=tostitch[0], well=tostitch[1]
+        )
+    stitchqueue.saveManifest()
     print("Stitching job submitted. Check your queue")
 
 
@@ -259,6 +304,7 @@ def create_batch_jobs_5(
                 ),
             }
             illumqueue.scheduleBatch(templateMessage_illum)
+    illumqueue.saveManifest()
     print("Illum job submitted. Check your queue")
 
 
@@ -318,6 +364,7 @@ def create_batch_jobs_6(
                     ),
                 }
                 illumqueue.scheduleBatch(templateMessage_illum)
+    illumqueue.saveManifest()
     print("Illum job submitted. Check your queue")
 
 
@@ -353,6 +400,7 @@ def create_batch_jobs_6A(
                     ),
                 }
                 illumqueue.scheduleBatch(templateMessage_illum)
+    illumqueue.saveManifest()
     print("Illum job submitted. Check your queue")
 
 
@@ -387,6 +435,7 @@ def create_batch_jobs_7(
                 ),
             }
             correctqueue.scheduleBatch(templateMessage_correct)
+    correctqueue.saveManifest()
     print("Correction job submitted. Check your queue")
 
 
@@ -422,6 +471,7 @@ def create_batch_jobs_7A(
                 ),
             }
             correctqueue.scheduleBatch(templateMessage_correct)
+    correctqueue.saveManifest()
     print("Correction job submitted. Check your queue")
 
 
@@ -483,7 +533,10 @@ def create_batch_jobs_8(
             "filterstring": well,
             "downloadfilter": tostitch[0] + "-" + tostitch[1] + "*",
         }
-        stitchqueue.scheduleBatch(stitchMessage)
+        stitchqueue.scheduleBatch(
+            stitchMessage, plate=tostitch[0], well=tostitch[1]
+        )
+    stitchqueue.saveManifest()
     print("Stitching job submitted. Check your queue")
 
 
@@ -545,7 +598,10 @@ def create_batch_jobs_8Z(
             "filterstring": well,
             "downloadfilter": tostitch[0] + "-" + tostitch[1] + "*",
         }
-        stitchqueue.scheduleBatch(stitchMessage)
+        stitchqueue.scheduleBatch(
+            stitchMessage, plate=tostitch[0], well=tostitch[1]
+        )
+    stitchqueue.saveManifest()
     print("Stitching job submitted. Check your queue")
 
 
@@ -580,6 +636,7 @@ def create_batch_jobs_8Y(
                 ),
             }
             aligncheckqueue.scheduleBatch(templateMessage_aligncheck)
+    aligncheckqueue.saveManifest()
     print("AlignmentCheck job submitted. Check your queue")
 
 
@@ -612,4 +669,5 @@ def create_batch_jobs_9(
                 ),
             }
             analysisqueue.scheduleBatch(templateMessage_analysis)
+    analysisqueue.saveManifest()
     print("Analysis job submitted. Check your queue")
@@ -0,0 +1,145 @@
+import json
+import math
+import posixpath
+
+import job_manifest
+import queue_urls
+
+# How long drained messages stay hidden from other readers of the dead-letter
+# queue while we decide what to do with them
+DRAIN_VISIBILITY = 900
+EMPTY_RECEIVES_TO_STOP = 3
+# The longest visibility timeout SQS accepts, in seconds (12 hours)
+MAX_MESSAGE_VISIBILITY = 43200
+
+INSTANCE_SIZES = [
+    "large",
+    "xlarge",
+    "2xlarge",
+    "4xlarge",
+    "8xlarge",
+    "12xlarge",
+    "16xlarge",
+    "24xlarge",
+]
+
+
+def dead_letter_queue_url(sqs, dead_letter_arn):
+    return queue_urls.queue_url(sqs, dead_letter_arn.split(":")[-1])
+
+
+def belongs_to_app(message, body, app_name, manifest=None):
+    attributes = message.get("MessageAttributes", {})
+    if "AppName" in attributes:
+        return attributes["AppName"]["StringValue"] == app_name
+    # Messages sent before jobs were tagged with their app can still be matched by content
+    if manifest is not None:
+        eachid = job_manifest.job_id(body)
+        return manifest["jobs"].get(eachid, {}).get("message") == body
+    return False
+
+
+def drain_dead_letters(sqs, queue_url, app_name, manifest=None):
+    # Returns [[receipt handle, body]] for this app's failed jobs; other apps'
+    # messages are made visible again untouched
+    ours = []
+    others = []
+    empty_receives = 0
+    while empty_receives < EMPTY_RECEIVES_TO_STOP:
+        result = sqs.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=10,
+            MessageAttributeNames=["All"],
+            VisibilityTimeout=DRAIN_VISIBILITY,
+            WaitTimeSeconds=1,
+        )
+        if not result.get("Messages"):
+            empty_receives += 1
+            continue
+        empty_receives = 0
+        for message in result["Messages"]:
+            body = json.loads(message["Body"])
+            if belongs_to_app(message, body, app_name, manifest):
+                ours.append([message["ReceiptHandle"], body])
+            else:
+                others.append(message["ReceiptHandle"])
+    release_dead_letters(sqs, queue_url, others)
+    print(len(ours), "failed jobs for", app_name, "and", len(others), "for other apps")
+    return ours
+
+
+def release_dead_letters(sqs, queue_url, receipt_handles):
+    for i in range(0, len(receipt_handles), 10):
+        sqs.change_message_visibility_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": str(n), "ReceiptHandle": x, "VisibilityTimeout": 0}
+                for n, x in enumerate(receipt_handles[i : i + 10])
+            ],
+        )
+
+
+def delete_dead_letters(sqs, queue_url, receipt_handles):
+    for i in range(0, len(receipt_handles), 10):
+        sqs.delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": str(n), "ReceiptHandle": x}
+                for n, x in enumerate(receipt_handles[i : i + 10])
+            ],
+        )
+
+
+def job_step(body):
+    if "pipeline" in body:
+        return posixpath.basename(body["pipeline"])
+    step_to_stitch = body.get("shared_metadata", {}).get("step_to_stitch", "unknown")
+    return step_to_stitch + "_stitching"
+
+
+def group_failures(bodies):
+    # {step: {plate: {well: number of failed jobs}}}
+    groups = {}
+    for body in bodies:
+        values = job_manifest.metadata_values(body)
+        plate = values.get("Metadata_Plate", values.get("out_subdir_tag", "unknown"))
+        well = values.get("Metadata_Well", values.get("filterstring", "unknown"))
+        per_step = groups.setdefault(job_step(body), {})
+        per_plate = per_step.setdefault(plate, {})
+        per_plate[well] = per_plate.get(well, 0) + 1
+    return groups
+
+
+def bigger_instance(machine_type, steps):
+    family, size = machine_type.split(".")
+    if size not in INSTANCE_SIZES:
+        return machine_type
+    index = min(INSTANCE_SIZES.index(size) + steps, len(INSTANCE_SIZES) - 1)
+    return family + "." + INSTANCE_SIZES[index]
+
+
+def escalate_config(config_dict, factor=2, overrides=None):
+    # Same step, more of everything a failing job usually ran out of
+    escalated = dict(config_dict)
+    steps = max(1, int(round(math.log(factor, 2))))
+    escalated["APP_NAME"] = config_dict["APP_NAME"] + "Rerun"
+    escalated["MEMORY"] = str(int(float(config_dict["MEMORY"]) * factor))
+    escalated["MACHINE_TYPE"] = [
+        bigger_instance(x, steps) for x in config_dict["MACHINE_TYPE"]
+    ]
+    escalated["MACHINE_PRICE"] = "%.2f" % (float(config_dict["MACHINE_PRICE"]) * factor)
+    escalated["SQS_MESSAGE_VISIBILITY"] = str(
+        int(float(config_dict["SQS_MESSAGE_VISIBILITY"]) * factor)
+    )
+    # One job per machine, so a job gets the whole (bigger) machine to itself
+    escalated["TASKS_PER_MACHINE"] = "1"
+    if "DOCKER_CORES" in escalated:
+        escalated["DOCKER_CORES"] = "1"
+    if overrides:
+        escalated.update(overrides)
+    # SQS won't make a queue with a longer visibility timeout, and steps such as
+    # 2, 4 and 6 already ask for the longest
+    escalated["SQS_MESSAGE_VISIBILITY"] = str(
+        min(int(float(escalated["SQS_MESSAGE_VISIBILITY"])), MAX_MESSAGE_VISIBILITY)
+    )
+    return escalated
@@ -0,0 +1,296 @@
+import datetime
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fleet_scaling
+import step_status
+import storage
+import stragglers
+
+# Monitor states, in the order a step moves through them
+RUNNING = "RUNNING"
+TEARING_DOWN = "TEARING_DOWN"
+EXPORTING_LOGS = "EXPORTING_LOGS"
+DONE = "DONE"
+
+ALARM_SWEEP_SECONDS = 3600
+TEARDOWN_WORKERS = 8
+# Teardown steps that must succeed before a step counts as shut down; alarm and
+# cluster cleanup are best effort, as they always have been.
+REQUIRED_TEARDOWN = ("fleet", "queue", "service", "task")
+# Straggler lookups cost one log call per job, so only look once the tail is this short
+MAX_STRAGGLER_CANDIDATES = 50
+FINISHED_EXPORT_CODES = ("COMPLETED", "CANCELLED", "FAILED", "PENDING_CANCEL")
+
+
+def state_file_name(app_name):
+    return app_name + "MonitorState.json"
+
+
+def monitor_file_name(app_name):
+    return app_name + "SpotFleetRequestId.json"
+
+
+def new_state():
+    return {
+        "state": RUNNING,
+        "samples": [],
+        "last_change": 0,
+        "last_alarm_sweep": time.time(),
+        "instance_seconds": 0,
+        "last_check": None,
+        "last_progress": None,
+        "finished": [],
+        "finished_checked": 0,
+        "runtimes": {},
+        "speculated": {},
+        "teardown": {},
+        "log_exports": [],
+        "history": [],
+    }
+
+
+class LocalStateFile:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def save(self, state):
+        with open(self.path, "w") as f:
+            json.dump(state, f)
+
+
+class S3StateFile:
+    # Lives next to the SpotFleetRequestId.json under monitors/BATCH/STEP/; s3 is
+    # a storage.S3Storage or LocalStorage
+    def __init__(self, s3, bucket_name, key):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+
+    def load(self):
+        try:
+            return json.loads(self.s3.get(self.bucket_name, self.key))
+        except storage.NoSuchKey:
+            return None
+
+    def save(self, state):
+        self.s3.put(self.bucket_name, self.key, json.dumps(state).encode("utf-8"))
+
+
+class MonitorStateMachine:
+    # Each check does a few seconds of work and persists where it got to, so it can be
+    # driven by a schedule, by queue/fleet events, or by a plain loop (boto3_setup.monitor).
+    # The backend hides AWS; see boto3_setup.AWSMonitorBackend and local_aws.LocalMonitorBackend.
+    def __init__(self, backend, state_file, status_file=None):
+        self.backend = backend
+        self.state_file = state_file
+        self.status_file = status_file
+
+    def check(self, now=None):
+        if now is None:
+            now = time.time()
+        state = self.state_file.load() or new_state()
+        # Reload the monitor info every time, because for long jobs new fleets may have been started, etc
+        monitorInfo = self.backend.monitor_info()
+        self.manifest = self.backend.job_manifest(monitorInfo)
+        while state["state"] != DONE:
+            current = state["state"]
+            handler = getattr(self, "_" + current.lower())
+            next_state = handler(state, monitorInfo, now)
+            if next_state == current:
+                break
+            print(
+                datetime.datetime.now(),
+                monitorInfo["MONITOR_APP_NAME"],
+                current,
+                "->",
+                next_state,
+            )
+            state["history"].append([now, next_state])
+            state["state"] = next_state
+        self.state_file.save(state)
+        if self.status_file is not None:
+            self.status_file.save(
+                step_status.build_status(monitorInfo, state, self.manifest, now=now)
+            )
+        return state["state"]
+
+    def _running(self, state, monitorInfo, now):
+        visible, nonvisible = self.backend.queue_load(monitorInfo)
+        if "last_load" in state and sum(state["last_load"]) > visible + nonvisible:
+            state["last_progress"] = now
+        state["last_load"] = [visible, nonvisible]
+        self._track_finished_jobs(state, monitorInfo, now)
+        if visible + nonvisible == 0 or self._all_jobs_finished(state):
+            if self.backend.stream_open(monitorInfo):
+                # A streamed step waits, as small as it can be, for more wells
+                self._rescale(state, monitorInfo, visible, nonvisible, now)
+                return RUNNING
+            # When no messages are pending, stop service
+            self.backend.set_service_count(monitorInfo, 0)
+            return TEARING_DOWN
+        if visible == 0:
+            self._speculate(state, monitorInfo, now)
+        # Once an hour check for terminated machines and delete their alarms
+        if now - state["last_alarm_sweep"] >= ALARM_SWEEP_SECONDS:
+            self.backend.kill_dead_alarms(monitorInfo)
+            state["last_alarm_sweep"] = now
+        self._rescale(state, monitorInfo, visible, nonvisible, now)
+        return RUNNING
+
+    def _rescale(self, state, monitorInfo, visible, nonvisible, now):
+        tracker = fleet_scaling.ThroughputTracker(samples=state["samples"])
+        tracker.add_sample(visible, nonvisible, now=now)
+        active, current = self.backend.fleet_capacity(monitorInfo)
+        # Machine time so far, for the cost estimate in the status document
+        if state["last_check"] is not None:
+            state["instance_seconds"] += active * (now - state["last_check"])
+        state["last_check"] = now
+        state["last_fleet"] = [active, current]
+        desired = fleet_scaling.compute_target_capacity(
+            visible,
+            nonvisible,
+            active,
+            tracker.jobs_per_minute(),
+            fleet_scaling.seconds_until_target(monitorInfo, now=now),
+            monitorInfo,
+            current,
+        )
+        if fleet_scaling.should_rescale(
+            current, desired, visible, state["last_change"], now=now
+        ):
+            print("Rescaling spot fleet from", current, "to", desired)
+            self.backend.set_fleet_capacity(monitorInfo, desired)
+            if desired > current:
+                # New machines need containers; the service is never scaled down here
+                # because that would stop tasks that are still working.
+                self.backend.set_service_count(
+                    monitorInfo,
+                    desired * int(monitorInfo.get("MONITOR_TASKS_PER_MACHINE", "1")),
+                )
+            state["last_change"] = now
+
+    def _track_finished_jobs(self, state, monitorInfo, now):
+        if self.manifest is None:
+            return
+        # Look back a little past the last check, since log delivery lags
+        started = float(monitorInfo["MONITOR_START_TIME"]) / 1000
+        since = max(started, state["finished_checked"] - 300) * 1000
+        finished = set(state["finished"])
+        new_ids = set(self.backend.finished_jobs(monitorInfo, int(since))) - finished
+        if new_ids:
+            state["finished"] = sorted(finished | new_ids)
+            state["last_progress"] = now
+        state["finished_checked"] = now
+
+    def _all_jobs_finished(self, state):
+        # Once every job has succeeded somewhere, whatever is still in flight is a
+        # speculative copy or its original, and doesn't need waiting for
+        if self.manifest is None or not self.manifest["jobs"]:
+            return False
+        if set(self.manifest["jobs"]) <= set(state["finished"]):
+            print("Every job in the manifest has finished")
+            return True
+        return False
+
+    def _speculate(self, state, monitorInfo, now):
+        # Only in the tail: re-enqueue jobs that have run far beyond the step's usual
+        # runtime. Outputs land at the same paths, so whichever copy finishes first wins.
+        if self.manifest is None:
+            return
+        finished = set(state["finished"])
+        recent = self.backend.recent_job_runtimes(monitorInfo)
+        stragglers.add_runtimes(
+            state["runtimes"], [x for x in recent if x[0] in finished]
+        )
+        threshold = stragglers.runtime_threshold(state["runtimes"])
+        if threshold is None:
+            return
+        candidates = [
+            x
+            for x in self.manifest["jobs"]
+            if x not in finished and x not in state["speculated"]
+        ]
+        if not candidates or len(candidates) > MAX_STRAGGLER_CANDIDATES:
+            return
+        start_times = self.backend.job_start_times(monitorInfo, candidates)
+        found = stragglers.find_stragglers(start_times, threshold, now)
+        for eachid in found[: stragglers.MAX_SPECULATIVE_PER_CHECK]:
+            print(
+                "Job", eachid, "has run over", int(threshold), "seconds; enqueueing a copy"
+            )
+            self.backend.enqueue(monitorInfo, self.manifest["jobs"][eachid]["message"])
+            state["speculated"][eachid] = now
+
+    def _tearing_down(self, state, monitorInfo, now):
+        if not state["log_exports"]:
+            loggroupId = monitorInfo["MONITOR_LOG_GROUP_NAME"]
+            state["log_exports"] = [
+                {"group": loggroupId, "task": None, "status": None},
+                {"group": loggroupId + "_perInstance", "task": None, "status": None},
+            ]
+        # Alarm names have to be read before the fleet is cancelled
+        alarm_names = []
+        if "alarms" not in state["teardown"]:
+            try:
+                alarm_names = self.backend.fleet_alarm_names(monitorInfo)
+            except Exception as error:
+                print("Listing alarms failed with error", error)
+        steps = {
+            "alarms": lambda: self.backend.delete_alarms(monitorInfo, alarm_names),
+            "fleet": lambda: self.backend.cancel_fleet(monitorInfo),
+            "queue": lambda: self.backend.remove_queue(monitorInfo),
+            "service": lambda: self.backend.delete_service(monitorInfo),
+            "task": lambda: self.backend.deregister_task(monitorInfo),
+            "logs": lambda: self._advance_log_exports(state, monitorInfo),
+        }
+        steps = {k: v for k, v in steps.items() if k not in state["teardown"]}
+        # None of these depend on each other, so run them all at once
+        with ThreadPoolExecutor(max_workers=TEARDOWN_WORKERS) as pool:
+            futures = {name: pool.submit(step) for name, step in steps.items()}
+        for name, future in futures.items():
+            error = future.exception()
+            if error is None or name in ("alarms", "logs"):
+                state["teardown"][name] = "done"
+                if error is not None:
+                    print("Teardown of", name, "failed with error", error)
+            else:
+                print("Teardown of", name, "failed with error", error, "; will retry")
+        if all(name in state["teardown"] for name in REQUIRED_TEARDOWN):
+            print("Job done.")
+            return EXPORTING_LOGS
+        return TEARING_DOWN
+
+    def _exporting_logs(self, state, monitorInfo, now):
+        # The cluster only becomes unused once the cancelled instances deregister
+        if "cluster" not in state["teardown"]:
+            if self.backend.remove_cluster(monitorInfo):
+                state["teardown"]["cluster"] = "done"
+        if self._advance_log_exports(state, monitorInfo):
+            print("All export tasks done")
+            return DONE
+        return EXPORTING_LOGS
+
+    def _advance_log_exports(self, state, monitorInfo):
+        for export in state["log_exports"]:
+            if export["status"] in FINISHED_EXPORT_CODES:
+                continue
+            if export["task"] is None:
+                # Only one export task can run per account, so this may have to wait a check
+                export["task"] = self.backend.start_log_export(
+                    monitorInfo, export["group"]
+                )
+                if export["task"] is None:
+                    break
+            export["status"] = self.backend.log_export_status(export["task"])
+            if export["status"] not in FINISHED_EXPORT_CODES:
+                break
+        return all(x["status"] in FINISHED_EXPORT_CODES for x in state["log_exports"])
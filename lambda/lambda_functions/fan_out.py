@@ -0,0 +1,60 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import aws_clients
+
+# Spreads a step lambda's per-plate work (building and uploading each plate's
+# load_data CSVs) over one invocation of the same lambda per plate, so a big batch
+# takes as long as its biggest plate rather than all of its plates together.
+# Outside Lambda, or with PCP_FAN_OUT=threads, the same work runs on local threads.
+
+FAN_OUT_WORKERS = 32
+# How long a single plate may take; a worker lambda's own timeout caps it anyway
+WORKER_READ_TIMEOUT = 900
+WORK_KEY = "fan_out_work"
+
+
+def is_worker(event):
+    return WORK_KEY in event
+
+
+def worker_work(event):
+    return event[WORK_KEY]
+
+
+def use_threads(context):
+    return context is None or os.environ.get("PCP_FAN_OUT") == "threads"
+
+
+def _invoke(function_name, work):
+    lambda_client = aws_clients.client("lambda", read_timeout=WORKER_READ_TIMEOUT)
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType="RequestResponse",
+        Payload=json.dumps({WORK_KEY: work}),
+    )
+    result = json.loads(response["Payload"].read())
+    if "FunctionError" in response:
+        raise RuntimeError("Worker for plate %s failed: %s" % (work["plate"], result))
+    return result
+
+
+def run_plates(plate_function, work_items, context=None, plate_done=None):
+    # work_items are JSON-able dicts, each with a "plate"; plate_function(work) is
+    # what the lambda's handler runs for is_worker events. Returns {plate: result}.
+    # plate_done(plate), if given, is called as each plate finishes.
+    if use_threads(context):
+        run = plate_function
+    else:
+        run = lambda x: _invoke(context.function_name, x)
+    results = {}
+    workers = max(1, min(FAN_OUT_WORKERS, len(work_items)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run, work): work["plate"] for work in work_items}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            if plate_done is not None:
+                plate_done(futures[future])
+    print("Worked on", len(work_items), "plates")
+    return results
@@ -0,0 +1,133 @@
+import math
+import time
+
+# Defaults used when a step's config_dict doesn't set its own autoscaling values
+TARGET_FINISH_HOURS = 12
+MAX_MACHINES = 200
+SCALE_HYSTERESIS = 0.2
+SCALE_COOLDOWN_SECONDS = 600
+THROUGHPUT_WINDOW_SECONDS = 1800
+MIN_PLANNING_MINUTES = 10
+
+
+def scaling_settings(config_dict):
+    # Everything the control loop needs, flattened so it can live in the monitor file
+    try:
+        docker_cores = float(config_dict["DOCKER_CORES"])
+    except (KeyError, ValueError):
+        docker_cores = 1.0
+    jobs_per_machine = max(
+        1, int(docker_cores * int(config_dict.get("TASKS_PER_MACHINE", 1)))
+    )
+    return {
+        "MONITOR_JOBS_PER_MACHINE": str(jobs_per_machine),
+        "MONITOR_TASKS_PER_MACHINE": str(config_dict.get("TASKS_PER_MACHINE", "1")),
+        "MONITOR_MACHINE_PRICE": str(config_dict.get("MACHINE_PRICE", "0")),
+        "MONITOR_TARGET_FINISH_HOURS": str(
+            config_dict.get("TARGET_FINISH_HOURS", TARGET_FINISH_HOURS)
+        ),
+        "MONITOR_MAX_HOURLY_COST": str(config_dict.get("MAX_HOURLY_COST", "")),
+        "MONITOR_MAX_MACHINES": str(config_dict.get("MAX_MACHINES", MAX_MACHINES)),
+    }
+
+
+class ThroughputTracker:
+    def __init__(self, window=THROUGHPUT_WINDOW_SECONDS, samples=None):
+        self.window = window
+        # Each sample is [epoch seconds, visible, nonvisible]
+        self.samples = samples if samples is not None else []
+
+    def add_sample(self, visible, nonvisible, now=None):
+        if now is None:
+            now = time.time()
+        self.samples.append([now, int(visible), int(nonvisible)])
+        # Keep one sample older than the window as the anchor for the oldest interval
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.pop(0)
+
+    def completed(self):
+        # Jobs only leave the queue by finishing, so every drop in the total is work done.
+        # Rises (new jobs enqueued, failed jobs returned) are ignored rather than netted.
+        done = 0
+        for previous, current in zip(self.samples, self.samples[1:]):
+            drop = (previous[1] + previous[2]) - (current[1] + current[2])
+            if drop > 0:
+                done += drop
+        return done
+
+    def jobs_per_minute(self):
+        if len(self.samples) < 2:
+            return None
+        elapsed = self.samples[-1][0] - self.samples[0][0]
+        if elapsed <= 0:
+            return None
+        return self.completed() * 60.0 / elapsed
+
+    def remaining(self):
+        if not self.samples:
+            return None
+        return self.samples[-1][1] + self.samples[-1][2]
+
+    def eta_seconds(self):
+        rate = self.jobs_per_minute()
+        remaining = self.remaining()
+        if remaining == 0:
+            return 0
+        if not rate:
+            return None
+        return remaining / rate * 60.0
+
+
+def compute_target_capacity(
+    visible, nonvisible, active, jobs_per_minute, seconds_left, monitorInfo, current
+):
+    jobs_per_machine = int(monitorInfo.get("MONITOR_JOBS_PER_MACHINE", 1))
+    remaining = visible + nonvisible
+    # Never plan below what it takes to keep every in-process job on a machine...
+    floor = int(math.ceil(float(nonvisible) / jobs_per_machine))
+    # ...and never above what the remaining work, the machine cap or the cost cap allow
+    ceiling = min(
+        int(math.ceil(float(remaining) / jobs_per_machine)),
+        int(monitorInfo.get("MONITOR_MAX_MACHINES", MAX_MACHINES)),
+    )
+    price = float(monitorInfo.get("MONITOR_MACHINE_PRICE") or 0)
+    max_hourly_cost = monitorInfo.get("MONITOR_MAX_HOURLY_COST", "")
+    if max_hourly_cost not in ("", None) and price > 0:
+        ceiling = min(ceiling, int(float(max_hourly_cost) / price))
+
+    if visible == 0:
+        # Long tail: everything left is already running, so pay only for those machines
+        desired = floor
+    elif jobs_per_minute is None or jobs_per_minute == 0 or active == 0:
+        # No throughput estimate yet (e.g. the fleet is still coming up), or one taken
+        # over less time than a job takes; hold the target, not the machines up so far,
+        # but don't let pending work starve
+        desired = max(current, 1)
+    else:
+        per_machine_rate = jobs_per_minute / active
+        minutes_left = max(seconds_left / 60.0, MIN_PLANNING_MINUTES)
+        desired = int(math.ceil(remaining / (per_machine_rate * minutes_left)))
+    return max(0, min(max(desired, floor), ceiling))
+
+
+def should_rescale(current, desired, visible, last_change, now=None):
+    if now is None:
+        now = time.time()
+    if desired == current:
+        return False
+    # Shrinking to the in-process count during the tail is always safe and always worth it
+    if desired < current and visible == 0:
+        return True
+    if abs(desired - current) < max(1, int(math.ceil(SCALE_HYSTERESIS * current))):
+        return False
+    return now - last_change >= SCALE_COOLDOWN_SECONDS
+
+
+def seconds_until_target(monitorInfo, now=None):
+    if now is None:
+        now = time.time()
+    start = float(monitorInfo["MONITOR_START_TIME"]) / 1000
+    target_hours = float(
+        monitorInfo.get("MONITOR_TARGET_FINISH_HOURS", TARGET_FINISH_HOURS)
+    )
+    return start + target_hours * 3600 - now
@@ -1,10 +1,24 @@
+import collections
+import io
 import json
 import os
 import re
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas
+import cppipe
+import event_monitor
+import job_manifest
+import leases
+import queue_urls
 import run_DCP
+import step_status
+import storage
+import streaming
+
+# CSVs downloaded at once when reading many of them, e.g. every Image.csv of a step
+CSV_WORKERS = 32
 
 
 def parse_image_names(imlist, filter_in, filter_out=["jibberish"]):
@@ -96,14 +110,11 @@ def return_full_wells(image_dict, expected_cycles, one_or_many, files_per_well=1
 def download_and_read_metadata_file(
     s3, bucket_name, metadata_file_name, metadata_on_bucket_name
 ):
-    import botocore
-
-    with open(metadata_file_name, "wb") as f:
-        try:
-            s3.download_fileobj(bucket_name, metadata_on_bucket_name, f)
-        except botocore.exceptions.ClientError as error:
-            print("Metadata file missing. Upload metadata.json.")
-            return
+    try:
+        s3.download(bucket_name, metadata_on_bucket_name, metadata_file_name)
+    except storage.NoSuchKey:
+        print("Metadata file missing. Upload metadata.json.")
+        return
     with open(metadata_file_name, "r") as input_metadata:
         metadata = json.load(input_metadata)
     return metadata
@@ -114,21 +125,26 @@ def write_metadata_file(
 ):
     with open(metadata_file_name, "w") as f:
         json.dump(metadata, f)
-    with open(metadata_file_name, "rb") as metadatafile:
-        print(metadatafile)
-        s3.put_object(
-            Body=metadatafile, Bucket=bucket_name, Key=metadata_on_bucket_name
-        )
+    s3.upload(bucket_name, metadata_file_name, metadata_on_bucket_name)
+
+
+def pick_pipeline(s3, bucket_name, prefix, batch, metadata, pipeline_name):
+    # The lean variant (see lean_pipelines.py) if the metadata asks for it and it
+    # has been uploaded next to the full pipeline
+    if metadata.get("pipeline_variant", "full") != "lean":
+        return pipeline_name
+    lean_pipeline_name = cppipe.lean_name(pipeline_name)
+    lean_on_bucket_name = os.path.join(prefix, "pipelines", batch, lean_pipeline_name)
+    if s3.head(bucket_name, lean_on_bucket_name) is None:
+        print(f"No {lean_on_bucket_name}, running the full {pipeline_name}")
+        return pipeline_name
+    print(f"Running the lean {lean_pipeline_name}")
+    return lean_pipeline_name
 
 
 def paginate_a_folder(s3, bucket_name, prefix):
-    paginator = s3.get_paginator("list_objects_v2")
-    pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
-    image_list = []
-    try:
-        for page in pages:
-            image_list += [x["Key"] for x in page["Contents"]]
-    except KeyError:
+    image_list = s3.list(bucket_name, prefix)
+    if not image_list:
         print(
             "No images in folder. Check batch name matches between pipeline and images."
         )
@@ -144,24 +160,39 @@ def check_if_run_done(
     current_app_name,
     prev_step_app_name,
     sqs,
-    dup_queue_name,
+    prefix,
     filter_in=None,
     filter_out=None,
+    orchestrated=False,
+    output_count=None,
 ):
-    # Check output folder from previous step to ensure sufficient files created
-    image_list = paginate_a_folder(s3, bucket_name, filter_prefix)
+    if orchestrated:
+        # The orchestrator only launches a step once everything it depends on is
+        # done, so all that's left is not to start a step that is already running
+        if check_named_queue(sqs, current_app_name + "Queue") != None:
+            print("Current step queue already exists.")
+            return False
+        return take_launch_lease(s3, bucket_name, prefix, current_app_name)
+
     done = False
+    # output_count, the outputs counted from trigger events so far, can only
+    # overcount what's in the folder, so there's no need to list it until it's enough
+    if output_count is not None and output_count < expected_len:
+        print("Only ", output_count, " output files triggered so far")
+    else:
+        # Check output folder from previous step to ensure sufficient files created
+        image_list = paginate_a_folder(s3, bucket_name, filter_prefix)
 
-    if filter_in != None:
-        image_list = [x for x in image_list if filter_in in x]
-    if filter_out != None:
-        image_list = [x for x in image_list if filter_out not in x]
+        if filter_in != None:
+            image_list = [x for x in image_list if filter_in in x]
+        if filter_out != None:
+            image_list = [x for x in image_list if filter_out not in x]
 
-    if len(image_list) >= expected_len:
-        done = True
-        print("Sufficient output files found from previous step.")
-    else:
-        print("Only ", len(image_list), " output files so far")
+        if len(image_list) >= expected_len:
+            done = True
+            print("Sufficient output files found from previous step.")
+        else:
+            print("Only ", len(image_list), " output files so far")
 
     # Maybe something died, but everything is done, and you have a monitor on that already cleaned up your queue
     queue_url = check_named_queue(sqs, prev_step_app_name + "Queue")
@@ -170,14 +201,11 @@ def check_if_run_done(
         print("Queue from previous step does not still exist.")
     else:
         # Maybe something died, and now your queue is just at 0 jobs
-        attributes = sqs.get_queue_attributes(
-            QueueUrl=queue_url,
-            AttributeNames=[
-                "ApproximateNumberOfMessages",
-                "ApproximateNumberOfMessagesNotVisible",
-            ],
-        )
-        if (
+        attributes = previous_queue_attributes(sqs, queue_url, prev_step_app_name)
+        if attributes is None:
+            done = True
+            print("Queue from previous step has just been removed.")
+        elif (
             attributes["Attributes"]["ApproximateNumberOfMessages"]
             + attributes["Attributes"]["ApproximateNumberOfMessagesNotVisible"]
             == 0
@@ -192,57 +220,110 @@ def check_if_run_done(
         if current_queue_url != None:
             print("Current step queue already exists.")
             return False
-        # Check FIFO queue
-        dup_queue_url = check_named_queue(sqs, dup_queue_name)
-        nmess = sqs.get_queue_attributes(
-            QueueUrl=dup_queue_url, AttributeNames=["ApproximateNumberOfMessages"]
-        )["Attributes"]["ApproximateNumberOfMessages"]
-        sqs.send_message(
-            QueueUrl=dup_queue_url, MessageBody=prev_step_app_name, MessageGroupId="0"
-        )
-        time.sleep(2)
-        nmess2 = sqs.get_queue_attributes(
-            QueueUrl=dup_queue_url, AttributeNames=["ApproximateNumberOfMessages"]
-        )["Attributes"]["ApproximateNumberOfMessages"]
-        if nmess2 != nmess:  # aka, if we're the first job to report in as finished
-            return True
-        else:
-            print("Trigger already exists in FIFO queue.")
-            return False
+        # Only the first trigger to report in as finished gets to start the step
+        return take_launch_lease(s3, bucket_name, prefix, current_app_name)
 
     # or, we're just not done yet
     return False
 
 
+def take_launch_lease(s3, bucket_name, prefix, current_app_name):
+    # Held until it expires, by which time the step's queue exists and is what
+    # keeps it from being started again
+    lease_key = leases.launch_lease_key(prefix, current_app_name)
+    if not leases.acquire(
+        s3, bucket_name, lease_key, leases.new_owner(), leases.LAUNCH_LEASE_SECONDS
+    ):
+        print("Another trigger is already starting this step.")
+        return False
+    return True
+
+
+def previous_queue_attributes(sqs, queue_url, prev_step_app_name):
+    import botocore
+
+    try:
+        return sqs.get_queue_attributes(
+            QueueUrl=queue_url,
+            AttributeNames=[
+                "ApproximateNumberOfMessages",
+                "ApproximateNumberOfMessagesNotVisible",
+            ],
+        )
+    except botocore.exceptions.ClientError as error:
+        if not queue_urls.is_missing_queue(error):
+            raise
+        # Its monitor cleaned it up since we last looked its URL up
+        queue_urls.forget(prev_step_app_name + "Queue")
+        return None
+
+
+def extending_running_step(event, sqs, current_app_name):
+    # A streamed launch of a step that is already running only adds jobs to it
+    if not event.get("streaming"):
+        return False
+    return check_named_queue(sqs, current_app_name + "Queue") != None
+
+
 def check_named_queue(sqs, SQS_QUEUE_NAME):
-    result = sqs.list_queues()
-    if "QueueUrls" in list(result.keys()):
-        for u in result["QueueUrls"]:
-            if u.split("/")[-1] == SQS_QUEUE_NAME:
-                return u
-    return None
+    return queue_urls.queue_url(sqs, SQS_QUEUE_NAME)
+
+
+def step_monitor(s3, bucket_name, monitor_folder, app_name):
+    # The step's monitor as PCP-Monitor runs it: its job manifest and stream marker
+    # fetched to /tmp (dropping any left there by an earlier invocation), and its
+    # state and status kept on S3, where the orchestrator and dead-letter reruns
+    # read them. Expects the monitor file in /tmp already.
+    for file_name in [
+        job_manifest.manifest_file_name(app_name),
+        # Streamed steps keep running while this marker is on S3
+        streaming.stream_marker_name(app_name),
+    ]:
+        if s3.head(bucket_name, os.path.join(monitor_folder, file_name)) is not None:
+            s3.download(
+                bucket_name,
+                os.path.join(monitor_folder, file_name),
+                "/tmp/" + file_name,
+            )
+        elif os.path.exists("/tmp/" + file_name):
+            os.remove("/tmp/" + file_name)
+    state_file = event_monitor.S3StateFile(
+        s3,
+        bucket_name,
+        os.path.join(monitor_folder, event_monitor.state_file_name(app_name)),
+    )
+    status_file = event_monitor.S3StateFile(
+        s3,
+        bucket_name,
+        os.path.join(monitor_folder, step_status.status_file_name(app_name)),
+    )
+    import boto3_setup
+
+    return event_monitor.MonitorStateMachine(
+        boto3_setup.AWSMonitorBackend(
+            "/tmp/" + event_monitor.monitor_file_name(app_name)
+        ),
+        state_file,
+        status_file,
+    )
 
 
 def try_to_run_monitor(s3, bucket_name, prefix, batch, step, prev_step_app_name):
-    prev_step_monitor_bucket_name = (
-        prefix
-        + "monitors/"
-        + batch
-        + "/"
-        + step
-        + "/"
-        + prev_step_app_name
-        + "SpotFleetRequestId.json"
+    monitor_folder = prefix + "monitors/" + batch + "/" + step
+    prev_step_monitor_bucket_name = os.path.join(
+        monitor_folder, event_monitor.monitor_file_name(prev_step_app_name)
+    )
+    prev_step_monitor_name = "/tmp/" + event_monitor.monitor_file_name(
+        prev_step_app_name
     )
-    prev_step_monitor_name = "/tmp/" + prev_step_app_name + "SpotFleetRequestId.json"
     print("Trying to shut down ", prev_step_monitor_bucket_name)
-    with open(prev_step_monitor_name, "wb") as f:
-        s3.download_fileobj(bucket_name, prev_step_monitor_bucket_name, f)
+    s3.download(bucket_name, prev_step_monitor_bucket_name, prev_step_monitor_name)
     print("Grabbing config for batch", batch, "step", step)
-    run_DCP.grab_batch_config(bucket_name, prefix, batch, step)
-    import boto3_setup
-
-    boto3_setup.monitor()
+    run_DCP.grab_batch_config(bucket_name, prefix, batch)
+    # One check, on the same state PCP-Monitor keeps, which carries on from here on
+    # its schedule rather than this trigger waiting for the step to be torn down
+    machine = step_monitor(s3, bucket_name, monitor_folder, prev_step_app_name)
+    print("Monitor of", prev_step_app_name, "is", machine.check())
 
 
 def try_a_shutdown(
@@ -255,7 +336,7 @@ def try_a_shutdown(
         try_to_run_monitor(
             s3, bucket_name, prefix, batch, str(prev_step_number), prev_step_app_name
         )
-    except botocore.exceptions.ClientError as error:
+    except (botocore.exceptions.ClientError, storage.NoSuchKey) as error:
         print("Monitor cleanup of previous step failed with error: ", error)
         print(
             "Usually this is no existing queue by that name, maybe a previous monitor cleaned up"
@@ -265,19 +346,28 @@ def try_a_shutdown(
         pass
 
 
-def concat_some_csvs(s3, bucket_name, file_list, csvname):
-    tmp_name = os.path.join("/tmp", csvname)
-    df_dict = {}
-    count = 0
-    for eachfile in file_list:
-        with open(tmp_name, "wb") as f:
-            s3.download_fileobj(bucket_name, eachfile, f)
-        df_dict[eachfile] = pandas.read_csv(tmp_name, index_col=False)
-        count += 1
-        if count % 100 == 0:
-            print(count)
-    df_merged = pandas.concat(df_dict, ignore_index=True)
-    return df_merged
+def read_csv_columns(s3, bucket_name, key, columns=None):
+    return pandas.read_csv(
+        io.BytesIO(s3.get(bucket_name, key)), index_col=False, usecols=columns
+    )
+
+
+def read_some_csvs(s3, bucket_name, file_list, columns=None):
+    # Yields each CSV, parsed for only the columns asked for, in file_list order.
+    # Only a few pools' worth are ever downloaded ahead of the caller, so memory
+    # doesn't grow with the number of files.
+    with ThreadPoolExecutor(max_workers=CSV_WORKERS) as pool:
+        pending = collections.deque()
+        for count, eachfile in enumerate(file_list, 1):
+            pending.append(
+                pool.submit(read_csv_columns, s3, bucket_name, eachfile, columns)
+            )
+            if len(pending) >= 2 * CSV_WORKERS:
+                yield pending.popleft().result()
+            if count % 100 == 0:
+                print(count)
+        while pending:
+            yield pending.popleft().result()
 
 
 def make_plate_and_well_list(platelist, image_dict):
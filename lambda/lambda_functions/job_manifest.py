@@ -0,0 +1,79 @@
+import json
+import os
+
+# Every job a step enqueues, keyed by the name its worker logs it under, so the
+# monitor can tell which plates are done and later requests can find a job again.
+
+
+def manifest_file_name(app_name):
+    return app_name + "Jobs.json"
+
+
+def metadata_values(message):
+    # Metadata is "Metadata_Plate=X,Metadata_Well=Y" for CellProfiler jobs and a dict for Fiji jobs
+    if isinstance(message["Metadata"], dict):
+        return message["Metadata"]
+    values = {}
+    for pair in message["Metadata"].split(","):
+        if "=" in pair:
+            key, value = pair.split("=", 1)
+            values[key] = value
+    return values
+
+
+def job_id(message):
+    # Matches the log stream name the DCP workers use for each job
+    values = metadata_values(message)
+    if "out_subdir_tag" in values:
+        return values["out_subdir_tag"]
+    return "-".join(str(x) for x in values.values())
+
+
+def job_plate(message):
+    return metadata_values(message).get("Metadata_Plate")
+
+
+def job_well(message):
+    return metadata_values(message).get("Metadata_Well")
+
+
+def new_manifest(app_name):
+    return {"app_name": app_name, "jobs": {}}
+
+
+def add_job(manifest, message, plate=None, well=None):
+    manifest["jobs"][job_id(message)] = {
+        "plate": plate if plate is not None else job_plate(message),
+        "well": well if well is not None else job_well(message),
+        "message": message,
+    }
+
+
+def save_manifest(manifest, folder="/tmp"):
+    file_name = os.path.join(folder, manifest_file_name(manifest["app_name"]))
+    with open(file_name, "w") as f:
+        json.dump(manifest, f)
+    return file_name
+
+
+def load_manifest(file_name):
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, "r") as f:
+        return json.load(f)
+
+
+def jobs_per_plate(manifest):
+    counts = {}
+    for job in manifest["jobs"].values():
+        counts[job["plate"]] = counts.get(job["plate"], 0) + 1
+    return counts
+
+
+def plate_completion(manifest, finished_ids):
+    # {plate: [finished, total]}
+    completion = {plate: [0, total] for plate, total in jobs_per_plate(manifest).items()}
+    for eachid in finished_ids:
+        if eachid in manifest["jobs"]:
+            completion[manifest["jobs"][eachid]["plate"]][0] += 1
+    return completion
@@ -0,0 +1,67 @@
+import json
+import os
+import time
+import uuid
+
+import storage
+
+# A lease is held by whoever manages to create the next object under its key, using
+# a conditional put, so exactly one of any number of racing triggers gets it. Each
+# holder writes a new generation (KEY/0, KEY/1, ...), so an expired lease is taken
+# over by creating the next one rather than by deleting it, which could race with
+# someone else taking it over at the same time.
+
+LAUNCH_LEASE_SECONDS = 900
+
+
+def new_owner():
+    return uuid.uuid4().hex
+
+
+def launch_lease_key(prefix, app_name):
+    return os.path.join(prefix, "leases", app_name + "Launch")
+
+
+def _generations(s3, bucket_name, lease_key):
+    names = [os.path.basename(x) for x in s3.list(bucket_name, lease_key + "/")]
+    return sorted(int(x) for x in names if x.isdigit())
+
+
+def _holder(s3, bucket_name, lease_key, generation):
+    try:
+        return json.loads(s3.get(bucket_name, os.path.join(lease_key, str(generation))))
+    except storage.NoSuchKey:
+        return None
+
+
+def acquire(s3, bucket_name, lease_key, owner, seconds, now=None):
+    # True if owner now holds the lease (or already did)
+    if now is None:
+        now = time.time()
+    generations = _generations(s3, bucket_name, lease_key)
+    generation = generations[-1] if generations else 0
+    lease = {"owner": owner, "acquired": now, "expires": now + seconds}
+    while True:
+        lease_name = os.path.join(lease_key, str(generation))
+        if s3.put_if_absent(bucket_name, lease_name, json.dumps(lease)):
+            print("Took lease", lease_name)
+            return True
+        holder = _holder(s3, bucket_name, lease_key, generation)
+        if holder is None:
+            # Released between our put and our read; try the same generation again
+            continue
+        if holder["owner"] == owner:
+            return True
+        if holder["expires"] > now:
+            print("Lease", lease_name, "is held until", holder["expires"])
+            return False
+        generation += 1
+
+
+def release(s3, bucket_name, lease_key, owner):
+    generations = _generations(s3, bucket_name, lease_key)
+    if not generations:
+        return
+    holder = _holder(s3, bucket_name, lease_key, generations[-1])
+    if holder is not None and holder["owner"] == owner:
+        s3.delete(bucket_name, os.path.join(lease_key, str(generations[-1])))
@@ -0,0 +1,183 @@
+import json
+import time
+
+import job_manifest
+
+# In-memory stand-ins for the AWS pieces the monitor drives, so the monitor
+# state machine can be exercised without an account.
+
+
+class LocalQueue:
+    def __init__(self, name="LocalQueue"):
+        self.name = name
+        self.pending = []
+        self.in_process = {}
+        self.next_handle = 0
+        self.finished = []
+        self.started = {}
+        self.runtimes = []
+
+    def scheduleBatch(self, data):
+        self.pending.append(json.dumps(data))
+
+    def receive(self, now=None):
+        if not self.pending:
+            return None, None
+        if now is None:
+            now = time.time()
+        self.next_handle += 1
+        self.in_process[self.next_handle] = self.pending.pop(0)
+        message = json.loads(self.in_process[self.next_handle])
+        self.started.setdefault(job_manifest.job_id(message), now * 1000)
+        return self.next_handle, message
+
+    def complete(self, handle, now=None):
+        if now is None:
+            now = time.time()
+        eachid = job_manifest.job_id(json.loads(self.in_process.pop(handle)))
+        self.finished.append(eachid)
+        self.runtimes.append([eachid, self.started[eachid], now * 1000])
+
+    def fail(self, handle):
+        self.pending.append(self.in_process.pop(handle))
+
+    def returnLoad(self):
+        return len(self.pending), len(self.in_process)
+
+
+class LocalFleet:
+    def __init__(self, capacity=0):
+        self.target = capacity
+        self.active = capacity
+        self.cancelled = False
+
+    def settle(self):
+        # A real fleet takes minutes to reach its target; call this to fast forward
+        self.active = 0 if self.cancelled else self.target
+
+
+class LocalMonitorBackend:
+    def __init__(self, monitorInfo, queue, fleet, manifest=None):
+        self.info = monitorInfo
+        self.queue = queue
+        self.fleet = fleet
+        self.manifest = manifest
+        self.service_count = None
+        self.actions = []
+        self.exports = {}
+        self.export_limit = 1
+        self.streaming = False
+
+    def monitor_info(self):
+        return self.info
+
+    def queue_load(self, monitorInfo):
+        return self.queue.returnLoad()
+
+    def fleet_capacity(self, monitorInfo):
+        return self.fleet.active, self.fleet.target
+
+    def set_fleet_capacity(self, monitorInfo, capacity):
+        self.actions.append(("set_fleet_capacity", capacity))
+        self.fleet.target = capacity
+
+    def set_service_count(self, monitorInfo, count):
+        self.actions.append(("set_service_count", count))
+        self.service_count = count
+
+    def kill_dead_alarms(self, monitorInfo):
+        self.actions.append(("kill_dead_alarms",))
+
+    def fleet_alarm_names(self, monitorInfo):
+        return [
+            monitorInfo["MONITOR_APP_NAME"] + "_i-" + str(x)
+            for x in range(self.fleet.active)
+        ]
+
+    def delete_alarms(self, monitorInfo, alarmnames):
+        self.actions.append(("delete_alarms", len(alarmnames)))
+
+    def cancel_fleet(self, monitorInfo):
+        self.actions.append(("cancel_fleet",))
+        self.fleet.cancelled = True
+
+    def remove_queue(self, monitorInfo):
+        self.actions.append(("remove_queue",))
+
+    def delete_service(self, monitorInfo):
+        self.actions.append(("delete_service",))
+
+    def deregister_task(self, monitorInfo):
+        self.actions.append(("deregister_task",))
+
+    def remove_cluster(self, monitorInfo):
+        # Like ECS, the cluster can't go until the fleet's instances have
+        if self.fleet.active > 0:
+            return False
+        self.actions.append(("remove_cluster",))
+        return True
+
+    def start_log_export(self, monitorInfo, loggroupId):
+        running = [x for x in self.exports.values() if x == "RUNNING"]
+        if len(running) >= self.export_limit:
+            return None
+        self.actions.append(("start_log_export", loggroupId))
+        self.exports[loggroupId] = "RUNNING"
+        return loggroupId
+
+    def finish_log_exports(self):
+        for task in self.exports:
+            self.exports[task] = "COMPLETED"
+
+    def log_export_status(self, logExportId):
+        return self.exports[logExportId]
+
+    def job_manifest(self, monitorInfo):
+        return self.manifest
+
+    def stream_open(self, monitorInfo):
+        return self.streaming
+
+    def finished_jobs(self, monitorInfo, since):
+        return list(self.queue.finished)
+
+    def recent_job_runtimes(self, monitorInfo):
+        return self.queue.runtimes[-50:]
+
+    def job_start_times(self, monitorInfo, job_ids):
+        return {x: self.queue.started[x] for x in job_ids if x in self.queue.started}
+
+    def enqueue(self, monitorInfo, message):
+        self.actions.append(("enqueue", job_manifest.job_id(message)))
+        self.queue.scheduleBatch(message)
+
+
+class LocalStepLauncher:
+    # Steps only "start" and "finish" when told to, so an orchestrator can be
+    # walked through a batch
+    def __init__(self):
+        self.launches = []
+        self.started = set()
+        self.finished = set()
+        self.progress = {}
+        self.closed = []
+
+    def launch(self, step, ready=None):
+        self.launches.append(step if ready is None else [step, ready])
+        self.started.add(step)
+        return True
+
+    def step_progress(self, step):
+        return self.progress.get(step)
+
+    def close_stream(self, step):
+        self.closed.append(step)
+
+    def finish(self, step):
+        self.finished.add(step)
+
+    def step_started(self, step):
+        return step in self.started
+
+    def step_finished(self, step):
+        return step in self.finished
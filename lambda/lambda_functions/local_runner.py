@@ -0,0 +1,160 @@
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import job_manifest
+
+# Runs a step's job messages (as recorded in its manifest by create_batch_jobs_*)
+# on one machine, against a local folder laid out like the bucket, instead of
+# on a spot fleet. Does what the DCP/DCP-Fiji workers would do for each job.
+
+CELLPROFILER_COMMAND = "cellprofiler"
+FIJI_COMMAND = "ImageJ-linux64"
+FIJI_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "..",
+    "FIJI",
+    "BatchStitchPooledCellPainting_StitchAndCrop_Headless.py",
+)
+# Where the workers see the bucket; load_data CSVs and Fiji jobs refer to it
+BUCKET_MOUNT = "/home/ubuntu/bucket/"
+
+
+def _local_paths(text, local_root):
+    return text.replace(BUCKET_MOUNT, local_root.rstrip("/") + "/")
+
+
+def output_subfolder(message):
+    # Same folder the DCP worker would upload this job's output to
+    values = job_manifest.metadata_values(message)
+    structure = message.get("output_structure", "")
+    if structure == "":
+        return "-".join(values.values())
+    for key, value in values.items():
+        structure = structure.replace(key, value)
+    return structure
+
+
+def cellprofiler_command(message, local_root, workdir):
+    # load_data CSVs point at the bucket mount; point them at local_root instead
+    with open(os.path.join(local_root, message["data_file"]), "r") as f:
+        data_file = _local_paths(f.read(), local_root)
+    local_data_file = os.path.join(workdir, os.path.basename(message["data_file"]))
+    with open(local_data_file, "w") as f:
+        f.write(data_file)
+    output = os.path.join(local_root, message["output"], output_subfolder(message))
+    os.makedirs(output, exist_ok=True)
+    return [
+        CELLPROFILER_COMMAND,
+        "-c",
+        "-r",
+        "-p",
+        os.path.join(local_root, message["pipeline"]),
+        "-i",
+        os.path.join(local_root, message["input"]),
+        "-o",
+        output,
+        "--data-file=" + local_data_file,
+        "-g",
+        message["Metadata"],
+    ]
+
+
+def fiji_command(message, local_root):
+    parameters = dict(message["shared_metadata"])
+    parameters.update(message["Metadata"])
+    parameters["input_file_location"] = _local_paths(
+        parameters["input_file_location"], local_root
+    )
+    # Read straight from local_root rather than copying from S3 first
+    parameters["awsdownload"] = "False"
+    return [
+        FIJI_COMMAND,
+        "--ij2",
+        "--headless",
+        "--console",
+        "--run",
+        FIJI_SCRIPT,
+        ",".join("%s='%s'" % (key, value) for key, value in parameters.items()),
+    ]
+
+
+def run_job(message, local_root, log_folder):
+    # Returns [job id, return code, seconds]; run in a worker process
+    eachid = job_manifest.job_id(message)
+    start = time.time()
+    workdir = tempfile.mkdtemp(prefix="pcp_")
+    try:
+        if "pipeline" in message:
+            cmd = cellprofiler_command(message, local_root, workdir)
+        else:
+            cmd = fiji_command(message, local_root)
+        with open(os.path.join(log_folder, eachid + ".txt"), "w") as log:
+            returncode = subprocess.call(
+                cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT
+            )
+        if returncode == 0 and "pipeline" not in message:
+            # The Fiji script writes to ./output, which DCP-Fiji uploads here
+            destination = os.path.join(local_root, message["output_file_location"])
+            shutil.copytree(
+                os.path.join(workdir, "output"), destination, dirs_exist_ok=True
+            )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return [eachid, returncode, time.time() - start]
+
+
+def run_manifest(manifest, local_root, workers=None, job_ids=None):
+    # Runs every job in the manifest (or just job_ids) with a pool of worker
+    # processes; returns {job id: [return code, seconds]}
+    if workers is None:
+        workers = os.cpu_count()
+    log_folder = os.path.join(local_root, "logs", manifest["app_name"])
+    os.makedirs(log_folder, exist_ok=True)
+    if job_ids is None:
+        job_ids = list(manifest["jobs"].keys())
+    results = {}
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                run_job, manifest["jobs"][x]["message"], local_root, log_folder
+            )
+            for x in job_ids
+        ]
+        for future in as_completed(futures):
+            eachid, returncode, seconds = future.result()
+            results[eachid] = [returncode, seconds]
+            print(
+                "SUCCESS" if returncode == 0 else "FAILED",
+                eachid,
+                "in %.1fs" % seconds,
+                "(%d/%d)" % (len(results), len(job_ids)),
+            )
+    summary = summarize(results, time.time() - start, workers)
+    with open(os.path.join(log_folder, "summary.json"), "w") as f:
+        json.dump({"summary": summary, "results": results}, f, indent=4)
+    return results
+
+
+def summarize(results, wall_seconds, workers):
+    runtimes = [x[1] for x in results.values()]
+    summary = {
+        "jobs": len(results),
+        "failed": len([x for x in results.values() if x[0] != 0]),
+        "workers": workers,
+        "wall_seconds": wall_seconds,
+        "jobs_per_minute": 60.0 * len(results) / wall_seconds if wall_seconds else None,
+        "median_job_seconds": statistics.median(runtimes) if runtimes else None,
+    }
+    print(
+        "%(jobs)d jobs (%(failed)d failed) on %(workers)d workers" % summary,
+        "in %.0fs" % wall_seconds,
+    )
+    return summary
@@ -0,0 +1,295 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+import streaming
+
+# Drives a whole batch through steps 1-9 from one place, instead of each step's
+# lambda being triggered by the previous step's output landing on S3.
+
+WAITING = "WAITING"
+LAUNCHED = "LAUNCHED"
+RUNNING = "RUNNING"
+DONE = "DONE"
+FAILED = "FAILED"
+
+# Painting (1-4) and barcoding (5-8) run side by side and only meet at analysis
+STEP_DEPENDENCIES = {
+    "1": [],
+    "2": ["1"],
+    "3": ["2"],
+    "4": ["3"],
+    "5": [],
+    "6": ["5"],
+    "7": ["6"],
+    "8": ["7"],
+    "9": ["4", "8"],
+}
+STEP_FUNCTIONS = {
+    "1": "PCP-1-CP-IllumCorr",
+    "2": "PCP-2-CP-ApplyIllum",
+    "3": "PCP-3-CP-SegmentCheck",
+    "4": "PCP-4-CP-Stitching",
+    "5": "PCP-5-BC-IllumCorr",
+    "6": "PCP-6-BC-ApplyIllum",
+    "7": "PCP-7-BC-Preprocess",
+    "8": "PCP-8-BC-Stitching",
+    "9": "PCP-9-Analysis",
+}
+STEP_APP_SUFFIXES = {
+    "1": "_IllumPainting",
+    "2": "_ApplyIllumPainting",
+    "3": "_PaintingSegmentationCheck",
+    "4": "_PaintingStitching",
+    "5": "_IllumBarcoding",
+    "6": "_ApplyIllumBarcoding",
+    "7": "_PreprocessBarcoding",
+    "8": "_BarcodingStitching",
+    "9": "_Analysis",
+}
+# An S3 key, relative to the project prefix, shaped like the one each step's
+# lambda is normally triggered by, so it can parse the batch out of it as usual
+STEP_TRIGGER_KEYS = {
+    "1": "workspace/pipelines/{batch}/1_CP_Illum.cppipe",
+    "2": "{batch}/illum/orchestrator/orchestrator.npy",
+    "3": "workspace/metadata/{batch}/metadata.json",
+    "4": "{batch}/images_segmentation/orchestrator/orchestrator.csv",
+    "5": "workspace/pipelines/{batch}/5_BC_Illum.cppipe",
+    "6": "{batch}/illum/orchestrator/orchestrator.npy",
+    "7": "workspace/pipelines/{batch}/7_BC_Preprocess.cppipe",
+    "8": "{batch}/images_corrected/barcoding/orchestrator/orchestrator.csv",
+    "9": "workspace/metadata/{batch}/metadata.json",
+}
+
+# A launched step that hasn't written its monitor file by then is launched again
+LAUNCH_TIMEOUT_SECONDS = 1800
+MAX_LAUNCH_ATTEMPTS = 3
+ORCHESTRATOR_POLL_TIME = 60
+
+
+def state_file_key(prefix, batch):
+    return os.path.join(prefix, "orchestrator", batch, "PipelineState.json")
+
+
+def step_app_name(app_prefix, step):
+    return app_prefix + STEP_APP_SUFFIXES[step]
+
+
+def step_event(bucket_name, image_prefix, batch, step, ready=None):
+    key = image_prefix + STEP_TRIGGER_KEYS[step].format(batch=batch)
+    event = {
+        "Records": [{"s3": {"bucket": {"name": bucket_name}, "object": {"key": key}}}],
+        "orchestrated": True,
+        "bucket": bucket_name,
+        "image_prefix": image_prefix,
+        "batch": batch,
+    }
+    if ready is not None:
+        # Start (or add to) the step with just these [plate, well]s
+        event["streaming"] = True
+        event["ready"] = ready
+    return event
+
+
+def new_pipeline_state(steps=None):
+    if steps is None:
+        steps = list(STEP_DEPENDENCIES.keys())
+    return {
+        "steps": {
+            step: {
+                "state": WAITING,
+                "attempts": 0,
+                "launched": None,
+                "finished": None,
+                "sent": [],
+                "stream_closed": False,
+            }
+            for step in steps
+        },
+        "history": [],
+    }
+
+
+class AWSStepLauncher:
+    def __init__(self, s3, lambda_client, bucket_name, image_prefix, batch, app_prefix):
+        self.s3 = s3
+        self.lambda_client = lambda_client
+        self.bucket_name = bucket_name
+        self.image_prefix = image_prefix
+        self.prefix = os.path.join(image_prefix, "workspace/")
+        self.batch = batch
+        self.app_prefix = app_prefix
+
+    def _monitor_key(self, step, file_name):
+        return os.path.join(self.prefix, "monitors", self.batch, step, file_name)
+
+    def _exists(self, key):
+        return self.s3.head(self.bucket_name, key) is not None
+
+    def _load(self, key):
+        try:
+            return json.loads(self.s3.get(self.bucket_name, key))
+        except storage.NoSuchKey:
+            return None
+
+    def launch(self, step, ready=None):
+        response = self.lambda_client.invoke(
+            FunctionName=STEP_FUNCTIONS[step],
+            InvocationType="RequestResponse",
+            Payload=json.dumps(
+                step_event(
+                    self.bucket_name, self.image_prefix, self.batch, step, ready
+                )
+            ),
+        )
+        result = response["Payload"].read().decode()
+        if "FunctionError" in response:
+            print("Step", step, "failed to launch:", result)
+            return False
+        print("Step", step, "returned", result)
+        return True
+
+    def step_started(self, step):
+        app_name = step_app_name(self.app_prefix, step)
+        return self._exists(
+            self._monitor_key(step, app_name + "SpotFleetRequestId.json")
+        )
+
+    def step_finished(self, step):
+        app_name = step_app_name(self.app_prefix, step)
+        state = self._load(self._monitor_key(step, app_name + "MonitorState.json"))
+        return state is not None and state["state"] == DONE
+
+    def step_progress(self, step):
+        # [manifest, finished job ids], or None if the step has no manifest
+        app_name = step_app_name(self.app_prefix, step)
+        manifest = self._load(self._monitor_key(step, app_name + "Jobs.json"))
+        state = self._load(self._monitor_key(step, app_name + "MonitorState.json"))
+        if manifest is None or state is None:
+            return None
+        return [manifest, state["finished"]]
+
+    def close_stream(self, step):
+        app_name = step_app_name(self.app_prefix, step)
+        self.s3.delete(
+            self.bucket_name,
+            self._monitor_key(step, streaming.stream_marker_name(app_name)),
+        )
+
+
+class PipelineOrchestrator:
+    # launcher needs launch(step, ready), step_started(step) and step_finished(step),
+    # plus step_progress(step) and close_stream(step) to stream;
+    # state_file is an event_monitor.LocalStateFile or S3StateFile
+    def __init__(self, launcher, state_file, steps=None, stream=False):
+        self.launcher = launcher
+        self.state_file = state_file
+        self.steps = steps
+        self.stream = stream
+
+    def _record(self, state, step, new_step_state, now):
+        print("Step", step, state["steps"][step]["state"], "->", new_step_state)
+        state["steps"][step]["state"] = new_step_state
+        state["history"].append([now, step, new_step_state])
+
+    def _ready(self, state, step):
+        # Dependencies outside the steps we were asked to run count as done
+        for dependency in STEP_DEPENDENCIES[step]:
+            if dependency in state["steps"]:
+                if state["steps"][dependency]["state"] != DONE:
+                    return False
+        return True
+
+    def _streamed_sends(self, state, now):
+        # [[step, new ready groups]] for every streamed step its sources have
+        # moved along since the last check
+        steps = state["steps"]
+        sends = []
+        for step in streaming.STREAM_SOURCES:
+            if step not in steps:
+                continue
+            info = steps[step]
+            if info["state"] in (LAUNCHED, DONE, FAILED) or info["stream_closed"]:
+                continue
+            if info["state"] == RUNNING and not info["sent"]:
+                # Started in one go, or outside the orchestrator; nothing to stream into
+                continue
+            sources = [x for x in streaming.STREAM_SOURCES[step] if x in steps]
+            if not sources or any(
+                steps[x]["state"] not in (RUNNING, DONE) for x in sources
+            ):
+                continue
+            progress = [self.launcher.step_progress(x) for x in sources]
+            if None in progress:
+                # No manifest to go on; the step waits for its sources as usual
+                continue
+            ready = streaming.ready_groups_all(progress)
+            new = [x for x in ready if x not in info["sent"]]
+            if new:
+                sends.append([step, new])
+            elif info["state"] == RUNNING and all(
+                steps[x]["state"] == DONE for x in sources
+            ):
+                self.launcher.close_stream(step)
+                info["stream_closed"] = True
+                state["history"].append([now, step, "STREAM_CLOSED"])
+        return sends
+
+    def advance(self, now):
+        state = self.state_file.load()
+        if state is None:
+            state = new_pipeline_state(self.steps)
+        steps = state["steps"]
+
+        for step, info in steps.items():
+            if info["state"] in (WAITING, LAUNCHED):
+                # Also picks up steps started or finished outside the orchestrator
+                if self.launcher.step_started(step):
+                    self._record(state, step, RUNNING, now)
+                elif info["state"] == LAUNCHED:
+                    if now - info["launched"] > LAUNCH_TIMEOUT_SECONDS:
+                        if info["attempts"] >= MAX_LAUNCH_ATTEMPTS:
+                            self._record(state, step, FAILED, now)
+                        else:
+                            self._record(state, step, WAITING, now)
+            if info["state"] == RUNNING and self.launcher.step_finished(step):
+                info["finished"] = now
+                self._record(state, step, DONE, now)
+
+        sends = self._streamed_sends(state, now) if self.stream else []
+        launches = [
+            [x, None]
+            for x in steps
+            if steps[x]["state"] == WAITING
+            and self._ready(state, x)
+            and x not in [y[0] for y in sends]
+        ]
+        for step, ready in launches + sends:
+            if steps[step]["state"] == WAITING:
+                steps[step]["attempts"] += 1
+                steps[step]["launched"] = now
+                self._record(state, step, LAUNCHED, now)
+        # Saved before launching, so a crash mid-launch can't start a step twice
+        self.state_file.save(state)
+
+        if launches or sends:
+            with ThreadPoolExecutor(max_workers=len(launches + sends)) as pool:
+                launched = list(
+                    pool.map(lambda x: self.launcher.launch(*x), launches + sends)
+                )
+            for [step, ready], success in zip(launches + sends, launched):
+                if not success:
+                    # Retried once the launch times out, or on the next check for sends
+                    state["history"].append([now, step, "LAUNCH_FAILED"])
+                elif ready is not None:
+                    steps[step]["sent"] += ready
+                    print("Sent", len(ready), "ready wells on to step", step)
+            self.state_file.save(state)
+
+        states = [x["state"] for x in steps.values()]
+        if all(x == DONE for x in states):
+            return DONE
+        if FAILED in states:
+            return FAILED
+        return RUNNING
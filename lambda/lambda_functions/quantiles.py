@@ -0,0 +1,116 @@
+import math
+
+# A t-digest: a small summary of a stream of numbers that answers percentile
+# queries closely (most closely near the tails, where the thresholds we want are)
+# in the same memory however many numbers went in. Two digests merge into one, so
+# each file, plate or batch can be summarized apart and combined later, and a digest
+# round-trips through JSON so it can be kept on the bucket between triggers.
+
+COMPRESSION = 100
+# Values held unsorted before being folded into the centroids
+BUFFER_SIZE = 500
+
+
+class TDigest:
+    def __init__(self, compression=COMPRESSION):
+        self.compression = compression
+        # [mean, weight] pairs, sorted by mean
+        self.centroids = []
+        self.buffer = []
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, weight=1):
+        value = float(value)
+        if math.isnan(value):
+            return
+        self.buffer.append([value, weight])
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.buffer) >= BUFFER_SIZE:
+            self._compress()
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        self.buffer.extend([list(x) for x in other.centroids + other.buffer])
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        points = sorted(self.centroids + self.buffer)
+        self.buffer = []
+        merged = [list(points[0])]
+        weight_before = 0.0
+        for mean, weight in points[1:]:
+            current = merged[-1]
+            q_left = weight_before / self.count
+            q_right = min(1.0, (weight_before + current[1] + weight) / self.count)
+            # Centroids may only grow as big as the scale function allows at their
+            # place in the distribution, which keeps those in the tails small
+            if self._k(q_right) - self._k(q_left) <= 1:
+                current[0] += (mean - current[0]) * weight / (current[1] + weight)
+                current[1] += weight
+            else:
+                weight_before += current[1]
+                merged.append([mean, weight])
+        self.centroids = merged
+
+    def percentile(self, p):
+        # p from 0 to 100, like numpy.percentile
+        self._compress()
+        if not self.centroids:
+            return math.nan
+        # Centered so that, while every centroid is still a single value, this
+        # matches numpy's linear interpolation exactly
+        target = p / 100.0 * (self.count - 1) + 0.5
+        # Interpolate between the centers of neighbouring centroids, and out to the
+        # min and max at either end
+        previous_position = 0.0
+        previous_mean = self.min
+        position = 0.0
+        for mean, weight in self.centroids:
+            center = position + weight / 2.0
+            if target <= center:
+                if center == previous_position:
+                    return mean
+                fraction = (target - previous_position) / (center - previous_position)
+                return previous_mean + (mean - previous_mean) * fraction
+            previous_position = center
+            previous_mean = mean
+            position += weight
+        if self.count == previous_position:
+            return self.max
+        fraction = (target - previous_position) / (self.count - previous_position)
+        return previous_mean + (self.max - previous_mean) * fraction
+
+    def to_dict(self):
+        self._compress()
+        return {
+            "compression": self.compression,
+            "centroids": self.centroids,
+            "count": self.count,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+
+def from_dict(values):
+    digest = TDigest(values["compression"])
+    digest.centroids = [list(x) for x in values["centroids"]]
+    digest.count = values["count"]
+    if values["count"]:
+        digest.min = values["min"]
+        digest.max = values["max"]
+    return digest
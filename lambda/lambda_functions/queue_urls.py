@@ -0,0 +1,46 @@
+import time
+
+# Queue name -> URL, looked up by exact name and remembered briefly, so the
+# several checks a trigger makes on the same queues cost one call. Warm lambdas
+# keep the cache between triggers, and a monitor or a person may delete a queue
+# at any time, so a remembered URL is only trusted for about as long as one
+# trigger takes, and is forgotten as soon as SQS says the queue is gone. That a
+# queue doesn't exist is remembered for less, since another trigger or a step's
+# setup may create it at any moment.
+
+URL_TTL_SECONDS = 30
+MISSING_TTL_SECONDS = 10
+
+_cache = {}
+
+
+def is_missing_queue(error):
+    code = error.response.get("Error", {}).get("Code", "")
+    return code in ("AWS.SimpleQueueService.NonExistentQueue", "QueueDoesNotExist")
+
+
+def queue_url(sqs, queue_name):
+    # The queue's URL, or None if there is no queue by that name
+    cached = _cache.get(queue_name)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+    from botocore.exceptions import ClientError
+
+    try:
+        url = sqs.get_queue_url(QueueName=queue_name)["QueueUrl"]
+    except ClientError as error:
+        if not is_missing_queue(error):
+            raise
+        url = None
+    remember(queue_name, url)
+    return url
+
+
+def remember(queue_name, url):
+    ttl = URL_TTL_SECONDS if url is not None else MISSING_TTL_SECONDS
+    _cache[queue_name] = [url, time.time() + ttl]
+
+
+def forget(queue_name):
+    # For when we've just deleted a queue, or found a remembered URL is stale
+    _cache.pop(queue_name, None)
@@ -1,12 +1,19 @@
 import os
 import sys
-import boto3
+import storage
 
 sys.path.append("/tmp")
 
 
-def run_setup(bucket_name, prefix, batch, config_dict, cellprofiler=True):
+def run_setup(
+    bucket_name, prefix, batch, config_dict, cellprofiler=True, checkpoint=None
+):
     os.chdir("/tmp")
+    if checkpoint is not None and checkpoint.done("setup"):
+        # Still needed by the later phases
+        grab_batch_config(bucket_name, prefix, batch)
+        print("Step already set up")
+        return config_dict["APP_NAME"]
     if os.path.exists("/tmp/configAWS.py"):
         os.remove("/tmp/configAWS.py")
         print("removed previous config file")
@@ -14,42 +21,91 @@ def run_setup(bucket_name, prefix, batch, config_dict, cellprofiler=True):
     import boto3_setup
 
     app_name = boto3_setup.setup(config_dict, cellprofiler=cellprofiler)
+    if checkpoint is not None:
+        checkpoint.complete("setup")
     return app_name
 
 
-def run_cluster(bucket_name, prefix, batch, njobs, config_dict):
+def run_cluster(
+    bucket_name, prefix, batch, njobs, config_dict, step=None, checkpoint=None
+):
+    # Checkpointed launches need their step, to upload the monitor as soon as the
+    # fleet is requested
+    if checkpoint is not None and checkpoint.done("cluster"):
+        print("Cluster already started")
+        return
     os.chdir("/tmp")
     grab_fleet_file(bucket_name, prefix, batch)
     import boto3_setup
 
-    boto3_setup.startCluster("configFleet.json", njobs, config_dict)
+    if checkpoint is None:
+        boto3_setup.startCluster("configFleet.json", njobs, config_dict)
+        return
+
+    def fleet_requested(monitorInfo):
+        # Saved before waiting on the instances, which can outlast the lambda, so a
+        # resumed launch waits on this fleet rather than requesting a second one,
+        # and a monitor can tear it down even if the launch never finishes
+        checkpoint.fleet_requested(monitorInfo)
+        boto3_setup.upload_monitor_file(bucket_name, prefix, batch, step, config_dict)
+
+    boto3_setup.startCluster(
+        "configFleet.json",
+        njobs,
+        config_dict,
+        monitorInfo=checkpoint.requested_fleet(),
+        fleet_requested=fleet_requested,
+    )
+    checkpoint.complete("cluster")
+
+
+def run_monitor(
+    bucket_name,
+    prefix,
+    batch,
+    step,
+    config_dict,
+    streaming_step=False,
+    checkpoint=None,
+):
+    import boto3_setup
+
+    boto3_setup.upload_monitor(
+        bucket_name,
+        prefix,
+        batch,
+        step,
+        config_dict,
+        streaming_step=streaming_step,
+        monitor_uploaded=checkpoint is not None
+        and checkpoint.requested_fleet() is not None,
+    )
+    if checkpoint is not None:
+        checkpoint.finish()
 
 
-def run_monitor(bucket_name, prefix, batch, step, config_dict):
+def run_extend_monitor(bucket_name, prefix, batch, step, config_dict):
+    grab_batch_config(bucket_name, prefix, batch)
     import boto3_setup
 
-    boto3_setup.upload_monitor(bucket_name, prefix, batch, step, config_dict)
+    boto3_setup.extend_monitor(bucket_name, prefix, batch, step, config_dict)
 
 
 def grab_batch_config(bucket_name, prefix, batch):
-    s3 = boto3.client("s3")
+    s3 = storage.default_storage()
     our_config = prefix + "lambda/" + batch + "/configAWS.py"
-    import botocore
-
     try:
-        with open("/tmp/configAWS.py", "wb") as f:
-            s3.download_fileobj(bucket_name, our_config, f)
-    except botocore.exceptions.ClientError as error:
+        s3.download(bucket_name, our_config, "/tmp/configAWS.py")
+    except storage.NoSuchKey:
         print(f"Config files for this batch haven't been uploaded to S3. Looking at {our_config}")
         return
 
 
 def grab_fleet_file(bucket_name, prefix, batch):
-    s3 = boto3.client("s3")
+    s3 = storage.default_storage()
     our_fleet = prefix + "lambda/" + batch + "/configFleet.json"
     try:
-        with open("/tmp/configFleet.json", "wb") as f:
-            s3.download_fileobj(bucket_name, our_fleet, f)
-    except botocore.exceptions.ClientError as error:
+        s3.download(bucket_name, our_fleet, "/tmp/configFleet.json")
+    except storage.NoSuchKey:
         print("Error grabbing fleet file.")
         return
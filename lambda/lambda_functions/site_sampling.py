@@ -0,0 +1,120 @@
+import math
+
+# Step 3 checks segmentation on a sample of each well's sites. Taking every
+# range_skip-th site samples every well alike; instead, each well gets only as many
+# sites as it takes to pin down its threshold percentiles (judged from its step 2
+# thresholds, in threshold_stats) to within TOLERANCE of the batch's spread between
+# them, and never more than range_skip would have given it. Sites are spread over
+# rings from the center of the well out, since thresholds tend to change toward
+# the edge, and evenly over each ring.
+
+RINGS = 3
+MIN_SITES_PER_WELL = 4
+# Half width of the 95% confidence interval of a well's sampled percentiles, as a
+# fraction of the batch's spread between the lower and upper percentile
+TOLERANCE = 0.05
+Z_95 = 1.96
+# Percentile step either side used to estimate the slope of the quantile function
+SLOPE_STEP = 5
+
+
+def uniform_sites(num_series, range_skip):
+    return list(range(0, num_series, int(range_skip)))
+
+
+def site_rings(num_series, rows=None, columns=None):
+    # Sites grouped by distance from the center of the well, innermost ring first.
+    # Without a rows x columns grid (e.g. when imperwell is set), sites are taken
+    # to lie in a square grid in acquisition order.
+    if not rows or not columns or int(rows) * int(columns) != num_series:
+        columns = int(math.ceil(math.sqrt(num_series)))
+        rows = int(math.ceil(num_series / float(columns)))
+    rows = int(rows)
+    columns = int(columns)
+    center_row = (rows - 1) / 2.0
+    center_column = (columns - 1) / 2.0
+    farthest = math.hypot(center_row, center_column) or 1.0
+    rings = [[] for _ in range(RINGS)]
+    for site in range(num_series):
+        row, column = divmod(site, columns)
+        distance = math.hypot(row - center_row, column - center_column) / farthest
+        rings[min(RINGS - 1, int(distance * RINGS))].append(site)
+    return [x for x in rings if x]
+
+
+def spread_evenly(sites, count):
+    if count <= 0:
+        return []
+    if count >= len(sites):
+        return list(sites)
+    step = len(sites) / float(count)
+    return [sites[int(step * x + step / 2)] for x in range(count)]
+
+
+def pick_sites(rings, count):
+    # count sites in all, shared out between the rings by their size
+    total = sum(len(x) for x in rings)
+    shares = [len(x) * count / float(total) for x in rings]
+    counts = [int(x) for x in shares]
+    # Hand the remainder to the rings that lost the most to rounding down
+    by_remainder = sorted(
+        range(len(rings)), key=lambda x: shares[x] - counts[x], reverse=True
+    )
+    for eachring in by_remainder[: count - sum(counts)]:
+        counts[eachring] += 1
+    sites = []
+    for ring, ring_count in zip(rings, counts):
+        sites += spread_evenly(ring, ring_count)
+    return sorted(sites)
+
+
+def sites_needed(well_sketch, percentiles, spread, num_series, max_sites):
+    # Fewest sites whose percentiles' confidence interval is within tolerance, with
+    # the correction for sampling a good part of a finite well without replacement
+    if well_sketch.count == 0:
+        return max_sites
+    if spread <= 0:
+        return MIN_SITES_PER_WELL
+    needed = MIN_SITES_PER_WELL
+    for p in percentiles:
+        q = p / 100.0
+        low = max(0, p - SLOPE_STEP)
+        high = min(100, p + SLOPE_STEP)
+        slope = (well_sketch.percentile(high) - well_sketch.percentile(low)) / (
+            (high - low) / 100.0
+        )
+        half_width = Z_95 * math.sqrt(q * (1 - q)) * slope
+        n_infinite = (half_width / (TOLERANCE * spread)) ** 2
+        n_finite = n_infinite / (1 + (n_infinite - 1) / num_series)
+        needed = max(needed, int(math.ceil(n_finite)))
+    return min(needed, max_sites)
+
+
+def sample_sites(
+    well_list,
+    well_sketches,
+    batch_sketch,
+    percentiles,
+    num_series,
+    range_skip,
+    rows=None,
+    columns=None,
+):
+    # {well: [sites]}; wells without step 2 thresholds get range_skip's sites
+    if batch_sketch.count == 0:
+        return {x: uniform_sites(num_series, range_skip) for x in well_list}
+    max_sites = len(uniform_sites(num_series, range_skip))
+    spread = batch_sketch.percentile(max(percentiles)) - batch_sketch.percentile(
+        min(percentiles)
+    )
+    rings = site_rings(num_series, rows, columns)
+    sites = {}
+    for eachwell in well_list:
+        if eachwell not in well_sketches:
+            sites[eachwell] = uniform_sites(num_series, range_skip)
+            continue
+        count = sites_needed(
+            well_sketches[eachwell], percentiles, spread, num_series, max_sites
+        )
+        sites[eachwell] = pick_sites(rings, count)
+    return sites
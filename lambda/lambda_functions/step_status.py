@@ -0,0 +1,103 @@
+import datetime
+import time
+
+import fleet_scaling
+import job_manifest
+
+# A step counts as stalled if it has work in process but nothing finished in this long
+STALLED_SECONDS = 3600
+
+
+def status_file_name(app_name):
+    return app_name + "Status.json"
+
+
+def build_status(monitorInfo, state, manifest, now=None):
+    if now is None:
+        now = time.time()
+    tracker = fleet_scaling.ThroughputTracker(samples=state["samples"])
+    visible, nonvisible = state.get("last_load", [None, None])
+    active, target = state.get("last_fleet", [None, None])
+    instance_hours = state.get("instance_seconds", 0) / 3600.0
+    eta_seconds = tracker.eta_seconds()
+    status = {
+        "app_name": monitorInfo["MONITOR_APP_NAME"],
+        "state": state["state"],
+        "updated": now,
+        "started": float(monitorInfo["MONITOR_START_TIME"]) / 1000,
+        "pending": visible,
+        "in_process": nonvisible,
+        "jobs_per_minute": tracker.jobs_per_minute(),
+        "eta_seconds": eta_seconds,
+        "eta": None if eta_seconds is None else now + eta_seconds,
+        "active_instances": active,
+        "target_capacity": target,
+        "instance_hours": instance_hours,
+        # MACHINE_PRICE is the spot bid, so this is an upper bound on what was paid
+        "cost_so_far": instance_hours
+        * float(monitorInfo.get("MONITOR_MACHINE_PRICE") or 0),
+        "last_progress": state.get("last_progress"),
+        "speculative_copies": len(state.get("speculated", {})),
+        "plates": {},
+    }
+    if manifest is not None:
+        finished = state.get("finished", [])
+        for plate, counts in job_manifest.plate_completion(manifest, finished).items():
+            status["plates"][plate] = {"done": counts[0], "total": counts[1]}
+        status["jobs_total"] = len(manifest["jobs"])
+        status["jobs_done"] = sum(x["done"] for x in status["plates"].values())
+    return status
+
+
+def is_stalled(status, now=None):
+    if now is None:
+        now = time.time()
+    if status["state"] != "RUNNING" or not status["in_process"]:
+        return False
+    last_progress = status.get("last_progress") or status["started"]
+    return now - last_progress > STALLED_SECONDS
+
+
+def _format_duration(seconds):
+    if seconds is None:
+        return "-"
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def render_statuses(statuses, now=None):
+    # statuses is {step: status}; returns the text table the batch_status script prints
+    if now is None:
+        now = time.time()
+    lines = [
+        "%-5s %-45s %-15s %11s %9s %10s %9s %9s  %s"
+        % ("STEP", "APP", "STATE", "DONE/TOTAL", "JOBS/MIN", "ETA", "MACHINES", "COST", "")
+    ]
+    for step in sorted(statuses):
+        status = statuses[step]
+        if "jobs_total" in status:
+            done = "%d/%d" % (status["jobs_done"], status["jobs_total"])
+        else:
+            done = "-"
+        rate = status["jobs_per_minute"]
+        lines.append(
+            "%-5s %-45s %-15s %11s %9s %10s %9s %9s  %s"
+            % (
+                step,
+                status["app_name"],
+                status["state"],
+                done,
+                "-" if rate is None else "%.1f" % rate,
+                _format_duration(status["eta_seconds"]),
+                "-"
+                if status["active_instances"] is None
+                else status["active_instances"],
+                "$%.2f" % status["cost_so_far"],
+                "STALLED" if is_stalled(status, now=now) else "",
+            )
+        )
+        for plate in sorted(status["plates"]):
+            counts = status["plates"][plate]
+            lines.append(
+                "      %-44s %27s" % (plate, "%d/%d" % (counts["done"], counts["total"]))
+            )
+    return "\n".join(lines)
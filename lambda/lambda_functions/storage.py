@@ -0,0 +1,220 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Everything the lambdas read from or write to the bucket goes through one of these,
+# so the same code can run against S3, an S3-compatible stand-in (e.g. MinIO, via
+# PCP_S3_ENDPOINT_URL) or a local folder (PCP_STORAGE_ROOT) for benchmarking.
+# Both take the bucket name on every call, like the boto3 client they replace.
+
+# Parts moved at once by a single upload/download; aws_clients.MAX_POOL_CONNECTIONS
+# should be at least this
+MAX_CONCURRENCY = 10
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+
+_default_storage = None
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+def _error_code(error):
+    return error.response.get("Error", {}).get("Code", "")
+
+
+class S3Storage:
+    def __init__(self, client=None, endpoint_url=None, max_concurrency=MAX_CONCURRENCY):
+        from boto3.s3.transfer import TransferConfig
+        from botocore.exceptions import ClientError
+
+        import aws_clients
+
+        self.ClientError = ClientError
+        if client is None:
+            client = aws_clients.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNKSIZE,
+            max_concurrency=max_concurrency,
+        )
+
+    def _missing(self, error):
+        return _error_code(error) in ("404", "NoSuchKey", "NotFound")
+
+    def list(self, bucket_name, prefix):
+        paginator = self.client.get_paginator("list_objects_v2")
+        keys = []
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            keys += [x["Key"] for x in page.get("Contents", [])]
+        return keys
+
+    def head(self, bucket_name, key):
+        # {"size", "etag", "last_modified"}, or None if there's no such object
+        try:
+            response = self.client.head_object(Bucket=bucket_name, Key=key)
+        except self.ClientError as error:
+            if self._missing(error):
+                return None
+            raise
+        return {
+            "size": response["ContentLength"],
+            "etag": response["ETag"].strip('"'),
+            "last_modified": response["LastModified"].timestamp(),
+        }
+
+    def get(self, bucket_name, key):
+        try:
+            response = self.client.get_object(Bucket=bucket_name, Key=key)
+        except self.ClientError as error:
+            if self._missing(error):
+                raise NoSuchKey(key)
+            raise
+        return response["Body"].read()
+
+    def put(self, bucket_name, key, body):
+        # body is bytes, a str or an open file
+        self.client.put_object(Body=body, Bucket=bucket_name, Key=key)
+
+    def put_if_absent(self, bucket_name, key, body):
+        # Only writes if nothing is at key yet; returns whether it wrote
+        try:
+            self.client.put_object(
+                Body=body, Bucket=bucket_name, Key=key, IfNoneMatch="*"
+            )
+        except self.ClientError as error:
+            # Also lost if another conditional write to key was still in flight
+            code = _error_code(error)
+            if code in ("PreconditionFailed", "ConditionalRequestConflict"):
+                return False
+            raise
+        return True
+
+    def download(self, bucket_name, key, file_name):
+        # Multipart, with max_concurrency parts at once, for big objects
+        try:
+            self.client.download_file(
+                bucket_name, key, file_name, Config=self.transfer_config
+            )
+        except self.ClientError as error:
+            if self._missing(error):
+                raise NoSuchKey(key)
+            raise
+
+    def upload(self, bucket_name, file_name, key):
+        self.client.upload_file(
+            file_name, bucket_name, key, Config=self.transfer_config
+        )
+
+    def delete(self, bucket_name, key):
+        self.client.delete_object(Bucket=bucket_name, Key=key)
+
+
+class LocalStorage:
+    # Each bucket is a folder under root, laid out like the bucket
+    def __init__(self, root, max_concurrency=MAX_CONCURRENCY):
+        self.root = root
+        self.max_concurrency = max_concurrency
+
+    def _path(self, bucket_name, key):
+        return os.path.join(self.root, bucket_name, key)
+
+    def _temp_file(self, path):
+        # Written next to its final path, then moved in, so readers never see half
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temp_name = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".put_")
+        os.close(handle)
+        return temp_name
+
+    def _write_temp(self, path, body):
+        temp_name = self._temp_file(path)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        with open(temp_name, "wb") as f:
+            if isinstance(body, bytes):
+                f.write(body)
+            else:
+                shutil.copyfileobj(body, f)
+        return temp_name
+
+    def list(self, bucket_name, prefix):
+        bucket_folder = os.path.join(self.root, bucket_name)
+        # Only walk the deepest folder the prefix is sure to be in
+        start = os.path.join(bucket_folder, os.path.dirname(prefix))
+        keys = []
+        for folder, _, files in os.walk(start):
+            for eachfile in files:
+                if eachfile.startswith(".put_"):
+                    continue
+                key = os.path.relpath(os.path.join(folder, eachfile), bucket_folder)
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def head(self, bucket_name, key):
+        path = self._path(bucket_name, key)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            etag = hashlib.md5(f.read()).hexdigest()
+        return {
+            "size": os.path.getsize(path),
+            "etag": etag,
+            "last_modified": os.path.getmtime(path),
+        }
+
+    def get(self, bucket_name, key):
+        path = self._path(bucket_name, key)
+        if not os.path.isfile(path):
+            raise NoSuchKey(key)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def put(self, bucket_name, key, body):
+        path = self._path(bucket_name, key)
+        os.replace(self._write_temp(path, body), path)
+
+    def put_if_absent(self, bucket_name, key, body):
+        path = self._path(bucket_name, key)
+        temp_name = self._write_temp(path, body)
+        try:
+            # Linking fails if the path exists, so only one writer can win
+            os.link(temp_name, path)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temp_name)
+        return True
+
+    def download(self, bucket_name, key, file_name):
+        path = self._path(bucket_name, key)
+        if not os.path.isfile(path):
+            raise NoSuchKey(key)
+        shutil.copyfile(path, file_name)
+
+    def upload(self, bucket_name, file_name, key):
+        path = self._path(bucket_name, key)
+        with open(file_name, "rb") as f:
+            os.replace(self._write_temp(path, f), path)
+
+    def delete(self, bucket_name, key):
+        path = self._path(bucket_name, key)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def default_storage():
+    # One per process, so its connection pool is reused across warm invocations
+    global _default_storage
+    if _default_storage is None:
+        if os.environ.get("PCP_STORAGE_ROOT"):
+            _default_storage = LocalStorage(os.environ["PCP_STORAGE_ROOT"])
+        else:
+            _default_storage = S3Storage(
+                endpoint_url=os.environ.get("PCP_S3_ENDPOINT_URL")
+            )
+    return _default_storage
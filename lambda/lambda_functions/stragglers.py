@@ -0,0 +1,37 @@
+import statistics
+
+# A running job is a straggler once it has run this many times the step's median
+# runtime, and never before STRAGGLER_MIN_SECONDS.
+STRAGGLER_FACTOR = 3.0
+STRAGGLER_MIN_SECONDS = 600
+MIN_RUNTIME_SAMPLES = 10
+MAX_RUNTIME_SAMPLES = 500
+MAX_SPECULATIVE_PER_CHECK = 20
+
+
+def add_runtimes(runtimes, streams):
+    # streams is [[job id, first event ms, last event ms]] for finished jobs;
+    # runtimes is {job id: seconds}, capped to the most recent samples
+    for eachid, first, last in streams:
+        runtimes[eachid] = (last - first) / 1000.0
+    while len(runtimes) > MAX_RUNTIME_SAMPLES:
+        del runtimes[next(iter(runtimes))]
+    return runtimes
+
+
+def runtime_threshold(runtimes):
+    if len(runtimes) < MIN_RUNTIME_SAMPLES:
+        return None
+    median = statistics.median(list(runtimes.values()))
+    return max(STRAGGLER_MIN_SECONDS, STRAGGLER_FACTOR * median)
+
+
+def find_stragglers(start_times, threshold, now):
+    # start_times is {job id: first event ms}; returns ids, longest running first
+    if threshold is None:
+        return []
+    running_for = {
+        eachid: now - start / 1000.0 for eachid, start in start_times.items()
+    }
+    stragglers = [x for x in running_for if running_for[x] > threshold]
+    return sorted(stragglers, key=lambda x: -running_for[x])
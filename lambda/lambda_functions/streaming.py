@@ -0,0 +1,55 @@
+# In streaming mode a step doesn't wait for the whole batch: each well (or plate,
+# for illum steps) is sent on as soon as all of its jobs in the step(s) before
+# have finished, into a step that keeps running until the stream is closed.
+
+# Steps that can be streamed, and the steps whose finished jobs feed them. Step 3
+# isn't here since it sets its segmentation thresholds from all of step 2's
+# Image.csvs, and step 4 isn't since step 3 only checks a sample of the wells.
+STREAM_SOURCES = {
+    "2": ["1"],
+    "6": ["5"],
+    "7": ["6"],
+    "8": ["7"],
+    "9": ["4", "8"],
+}
+
+
+def stream_marker_name(app_name):
+    # Present next to the monitor file for as long as more jobs may still arrive
+    return app_name + "StreamOpen.json"
+
+
+def ready_groups(manifest, finished_ids):
+    # [plate, well] for every well whose jobs have all finished, or [plate, None]
+    # for steps that run per plate
+    finished_ids = set(finished_ids)
+    unfinished = {}
+    for eachid, job in manifest["jobs"].items():
+        group = (job["plate"], job["well"])
+        unfinished[group] = unfinished.get(group, 0) + (eachid not in finished_ids)
+    return [list(x) for x in unfinished if unfinished[x] == 0]
+
+
+def _covers(groups, group):
+    return tuple(group) in groups or (group[0], None) in groups
+
+
+def ready_groups_all(progress):
+    # progress is [[manifest, finished ids]] for each source step; a group is ready
+    # once every source has finished it
+    per_source = [
+        set(tuple(x) for x in ready_groups(manifest, finished))
+        for manifest, finished in progress
+    ]
+    ready = [x for x in per_source[0] if all(_covers(y, x) for y in per_source[1:])]
+    return sorted([list(x) for x in ready], key=lambda x: (x[0], x[1] or ""))
+
+
+def select_ready(plate_and_well_list, ready):
+    groups = set(tuple(x) for x in ready)
+    return [x for x in plate_and_well_list if _covers(groups, x)]
+
+
+def select_ready_plates(platelist, ready):
+    plates = set(x[0] for x in ready)
+    return [x for x in platelist if x in plates]
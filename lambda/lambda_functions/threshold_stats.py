@@ -0,0 +1,106 @@
+import json
+import os
+
+import helpful_functions
+import quantiles
+import storage
+
+# Step 3 sets its segmentation thresholds from percentiles of the thresholds step 2
+# found. Rather than read every step 2 Image.csv once step 2 is over, each one is
+# folded into its plate's sketch as it lands, and the plates' sketches into the
+# batch's, so by the time step 3 launches only the stragglers are left to read.
+# Every sketch lists the files in it, so a CSV is never counted twice and any a
+# trigger missed are picked up at launch. Plates keep a sketch per well as well, for
+# site_sampling to tell which wells' thresholds vary most.
+
+THRESHOLD_COLUMN = "Threshold_FinalThreshold_Cells"
+BATCH_FILE_NAME = "batch.json"
+
+
+def stats_folder(prefix, batch):
+    return os.path.join(prefix, "metadata", batch, "thresholds")
+
+
+def csv_plate(key):
+    # .../images_corrected/painting/<plate>-<well>/Image.csv
+    return os.path.basename(os.path.dirname(key)).split("-")[0]
+
+
+def csv_well(key):
+    return os.path.basename(os.path.dirname(key)).split("-", 1)[1]
+
+
+def load_stats(s3, bucket_name, key):
+    try:
+        return json.loads(s3.get(bucket_name, key))
+    except storage.NoSuchKey:
+        return {"files": [], "sketch": quantiles.TDigest().to_dict(), "wells": {}}
+
+
+def load_sketch(s3, bucket_name, key):
+    stats = load_stats(s3, bucket_name, key)
+    return quantiles.from_dict(stats["sketch"]), set(stats["files"])
+
+
+def save_sketch(s3, bucket_name, key, sketch, files, wells=None):
+    stats = {"files": sorted(files), "sketch": sketch.to_dict()}
+    if wells is not None:
+        stats["wells"] = wells
+    s3.put(bucket_name, key, json.dumps(stats))
+
+
+def well_sketches(s3, bucket_name, prefix, batch, plate):
+    # {well: quantiles.TDigest} for the wells of the plate summarized so far
+    plate_key = os.path.join(stats_folder(prefix, batch), plate + ".json")
+    wells = load_stats(s3, bucket_name, plate_key).get("wells", {})
+    return {well: quantiles.from_dict(x) for well, x in wells.items()}
+
+
+def load_batch_sketch(s3, bucket_name, prefix, batch):
+    batch_key = os.path.join(stats_folder(prefix, batch), BATCH_FILE_NAME)
+    return load_sketch(s3, bucket_name, batch_key)[0]
+
+
+def update(s3, bucket_name, prefix, batch, csv_keys):
+    # Folds any of the Image.csvs in csv_keys not already in their plate's sketch
+    # into it, and returns the batch's sketch, made from all the plates'
+    folder = stats_folder(prefix, batch)
+    batch_key = os.path.join(folder, BATCH_FILE_NAME)
+    changed = False
+    by_plate = {}
+    for eachkey in csv_keys:
+        if os.path.basename(eachkey) == "Image.csv":
+            by_plate.setdefault(csv_plate(eachkey), []).append(eachkey)
+    for plate, keys in by_plate.items():
+        plate_key = os.path.join(folder, plate + ".json")
+        stats = load_stats(s3, bucket_name, plate_key)
+        sketch = quantiles.from_dict(stats["sketch"])
+        files = set(stats["files"])
+        wells = stats.get("wells", {})
+        new_keys = [x for x in keys if x not in files]
+        if not new_keys:
+            continue
+        dfs = helpful_functions.read_some_csvs(
+            s3, bucket_name, new_keys, [THRESHOLD_COLUMN]
+        )
+        for eachkey, df in zip(new_keys, dfs):
+            well_sketch = quantiles.TDigest()
+            well_sketch.update(df[THRESHOLD_COLUMN])
+            sketch.merge(well_sketch)
+            wells[csv_well(eachkey)] = well_sketch.to_dict()
+        save_sketch(s3, bucket_name, plate_key, sketch, files.union(new_keys), wells)
+        changed = True
+        print("Added", len(new_keys), "Image.csvs to the thresholds of plate", plate)
+    # The batch's sketch only needs making again if a plate's sketch changed
+    if not changed and s3.head(bucket_name, batch_key) is not None:
+        return load_sketch(s3, bucket_name, batch_key)[0]
+    batch_sketch = quantiles.TDigest()
+    batch_files = set()
+    for plate_key in s3.list(bucket_name, folder + "/"):
+        if os.path.basename(plate_key) == BATCH_FILE_NAME:
+            continue
+        sketch, files = load_sketch(s3, bucket_name, plate_key)
+        batch_sketch.merge(sketch)
+        batch_files.update(files)
+    save_sketch(s3, bucket_name, batch_key, batch_sketch, batch_files)
+    return batch_sketch
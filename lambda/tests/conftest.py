@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The lambdas import the shared code as top-level modules, as the layer puts it on
+# the path, so do the same here
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda_functions")
+)
@@ -0,0 +1,89 @@
+import pytest
+
+import checkpoints
+import storage
+
+BUCKET = "bucket"
+PREFIX = "project/workspace/"
+
+
+class Context:
+    def __init__(self, seconds_left):
+        self.seconds_left = seconds_left
+        self.aws_request_id = "request"
+
+    def get_remaining_time_in_millis(self):
+        return self.seconds_left * 1000
+
+
+def new_checkpoint(s3):
+    return checkpoints.StepCheckpoint(s3, BUCKET, PREFIX, "batch", "Test_Step")
+
+
+def test_timed_out_invocation_is_resumed(tmp_path):
+    s3 = storage.LocalStorage(str(tmp_path))
+    checkpoint = new_checkpoint(s3)
+    assert not checkpoint.resuming()
+    # Stopped by Lambda as soon as it had claimed the run and set up
+    assert checkpoint.claim(Context(0))
+    checkpoint.complete("setup")
+    resumed = new_checkpoint(s3)
+    assert resumed.resuming()
+    assert resumed.claim(Context(900))
+    assert resumed.done("setup")
+
+
+def test_resumed_launch_keeps_its_requested_fleet(tmp_path):
+    s3 = storage.LocalStorage(str(tmp_path))
+    checkpoint = new_checkpoint(s3)
+    assert checkpoint.claim(Context(0))
+    assert checkpoint.requested_fleet() is None
+    # Timed out waiting on the instances, after the fleet was requested
+    checkpoint.fleet_requested({"MONITOR_FLEET_ID": "sfr-1"})
+    resumed = new_checkpoint(s3)
+    assert resumed.claim(Context(900))
+    assert not resumed.done("cluster")
+    assert resumed.requested_fleet() == {"MONITOR_FLEET_ID": "sfr-1"}
+
+
+def test_invocation_still_running_is_not_resumed(tmp_path):
+    s3 = storage.LocalStorage(str(tmp_path))
+    assert new_checkpoint(s3).claim(Context(900))
+    other = new_checkpoint(s3)
+    assert not other.resuming()
+    assert not other.claim(Context(900))
+
+
+def test_failed_invocation_is_not_resumed(tmp_path):
+    s3 = storage.LocalStorage(str(tmp_path))
+
+    @checkpoints.record_endings
+    def handler(event, context):
+        checkpoint = new_checkpoint(s3)
+        checkpoint.claim(context)
+        checkpoint.complete("setup")
+        raise RuntimeError("no such queue")
+
+    with pytest.raises(RuntimeError):
+        handler({}, Context(0))
+    after = new_checkpoint(s3)
+    assert after.state["invocations"][-1]["ended"] == "failed"
+    assert not after.resuming()
+    # The failed invocation's claim is let go, and the next launch keeps its phases
+    assert after.claim(Context(900))
+    assert after.done("setup")
+
+
+def test_finished_launch_leaves_no_checkpoint(tmp_path):
+    s3 = storage.LocalStorage(str(tmp_path))
+
+    @checkpoints.record_endings
+    def handler(event, context):
+        checkpoint = new_checkpoint(s3)
+        checkpoint.claim(context)
+        checkpoint.finish()
+        return "Cluster started"
+
+    assert handler({}, Context(900)) == "Cluster started"
+    assert s3.list(BUCKET, PREFIX + "metadata/") == []
+    assert new_checkpoint(s3).claim(Context(900))
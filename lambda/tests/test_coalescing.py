@@ -0,0 +1,50 @@
+import coalescing
+import storage
+
+BUCKET = "bucket"
+PREFIX = "project/workspace/"
+
+
+def event(*keys):
+    return {
+        "Records": [
+            {"s3": {"bucket": {"name": BUCKET}, "object": {"key": x}}} for x in keys
+        ]
+    }
+
+
+def record(s3, keys, now):
+    return coalescing.record_event(s3, BUCKET, PREFIX, "batch", "6", keys, now=now)
+
+
+def test_only_the_first_event_of_a_window_checks(tmp_path):
+    s3 = storage.LocalStorage(str(tmp_path))
+    assert record(s3, ["a"], 60) == 30
+    assert record(s3, ["b"], 75) is None
+    # The next window is checked separately
+    assert record(s3, ["c"], 95) == 25
+
+
+def test_counts_keep_a_total_and_only_the_new_keys(tmp_path):
+    s3 = storage.LocalStorage(str(tmp_path))
+    record(s3, ["a", "b"], 60)
+    record(s3, ["b"], 70)
+    counts = coalescing.update_counts(s3, BUCKET, PREFIX, "batch", "6", now=90)
+    assert counts == {"events": 2, "checks": 1, "outputs": 2, "new_keys": ["a", "b"]}
+    record(s3, ["c"], 95)
+    counts = coalescing.update_counts(s3, BUCKET, PREFIX, "batch", "6", now=120)
+    assert counts == {"events": 3, "checks": 2, "outputs": 3, "new_keys": ["c"]}
+    # Records and past claims are cleared, leaving just the counts
+    folder = coalescing.trigger_folder(PREFIX, "batch", "6")
+    assert s3.list(BUCKET, folder + "/") == [
+        folder + "/" + coalescing.COUNTS_FILE_NAME
+    ]
+
+
+def test_scheduled_check_folds_in_the_window(tmp_path):
+    s3 = storage.LocalStorage(str(tmp_path))
+    record(s3, ["a"], 60)
+    check = coalescing.check_event(event("project/batch/illum/plate/a"))
+    counts = coalescing.coalesce(s3, BUCKET, PREFIX, "batch", "6", check)
+    assert counts["outputs"] == 1
+    assert check["Records"][0]["s3"]["object"]["key"] == "project/batch/illum/plate/a"
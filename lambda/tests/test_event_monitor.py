@@ -0,0 +1,101 @@
+import time
+
+import event_monitor
+import local_aws
+
+
+def make_monitor(tmp_path, jobs=3, capacity=2):
+    monitorInfo = {
+        "MONITOR_APP_NAME": "Test_Step",
+        "MONITOR_START_TIME": str(int((time.time() - 60) * 1000)),
+        "MONITOR_LOG_GROUP_NAME": "Test_Step",
+        "MONITOR_JOBS_PER_MACHINE": "1",
+        "MONITOR_TASKS_PER_MACHINE": "1",
+    }
+    queue = local_aws.LocalQueue()
+    for x in range(jobs):
+        queue.scheduleBatch({"Metadata": "Metadata_Site=" + str(x)})
+    fleet = local_aws.LocalFleet(capacity)
+    backend = local_aws.LocalMonitorBackend(monitorInfo, queue, fleet)
+    state_file = event_monitor.LocalStateFile(str(tmp_path / "state.json"))
+    return event_monitor.MonitorStateMachine(backend, state_file), backend
+
+
+def run_all_jobs(queue):
+    while True:
+        handle, _ = queue.receive()
+        if handle is None:
+            return
+        queue.complete(handle)
+
+
+def test_stays_running_while_jobs_are_queued(tmp_path):
+    machine, backend = make_monitor(tmp_path)
+    assert machine.check() == event_monitor.RUNNING
+    backend.queue.receive()
+    assert machine.check() == event_monitor.RUNNING
+    assert ("cancel_fleet",) not in backend.actions
+
+
+def test_runs_through_teardown_and_log_exports_to_done(tmp_path):
+    machine, backend = make_monitor(tmp_path)
+    assert machine.check() == event_monitor.RUNNING
+    run_all_jobs(backend.queue)
+
+    # The service is stopped and everything torn down in the one check, but only one
+    # log export may run at a time and neither has finished
+    assert machine.check() == event_monitor.EXPORTING_LOGS
+    history = [x[1] for x in machine.state_file.load()["history"]]
+    assert history == [event_monitor.TEARING_DOWN, event_monitor.EXPORTING_LOGS]
+    for action in ("cancel_fleet", "remove_queue", "delete_service", "deregister_task"):
+        assert (action,) in backend.actions
+    assert ("set_service_count", 0) in backend.actions
+    assert backend.exports == {"Test_Step": "RUNNING"}
+
+    # The first export finishing lets the second start
+    backend.finish_log_exports()
+    assert machine.check() == event_monitor.EXPORTING_LOGS
+    assert ("start_log_export", "Test_Step_perInstance") in backend.actions
+
+    # The cluster has to wait for the cancelled fleet's instances to go
+    backend.finish_log_exports()
+    assert ("remove_cluster",) not in backend.actions
+    backend.fleet.settle()
+    assert machine.check() == event_monitor.DONE
+    assert ("remove_cluster",) in backend.actions
+    assert machine.check() == event_monitor.DONE
+
+
+def test_failed_teardown_step_is_retried(tmp_path):
+    machine, backend = make_monitor(tmp_path)
+    run_all_jobs(backend.queue)
+    remove_queue = backend.remove_queue
+    calls = []
+
+    def flaky_remove_queue(monitorInfo):
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("queue busy")
+        remove_queue(monitorInfo)
+
+    backend.remove_queue = flaky_remove_queue
+    assert machine.check() == event_monitor.TEARING_DOWN
+    assert ("remove_queue",) not in backend.actions
+    # Steps that already succeeded aren't run again
+    assert machine.check() == event_monitor.EXPORTING_LOGS
+    assert backend.actions.count(("cancel_fleet",)) == 1
+    assert ("remove_queue",) in backend.actions
+
+
+def test_state_survives_between_checks(tmp_path):
+    machine, backend = make_monitor(tmp_path)
+    run_all_jobs(backend.queue)
+    assert machine.check() == event_monitor.EXPORTING_LOGS
+    # A new monitor, e.g. the next scheduled invocation, carries on from the state file
+    fresh = event_monitor.MonitorStateMachine(backend, machine.state_file)
+    backend.finish_log_exports()
+    fresh.check()
+    backend.finish_log_exports()
+    backend.fleet.settle()
+    assert fresh.check() == event_monitor.DONE
+    assert backend.actions.count(("cancel_fleet",)) == 1
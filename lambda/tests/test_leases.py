@@ -0,0 +1,33 @@
+import leases
+import storage
+
+BUCKET = "bucket"
+LEASE_KEY = leases.launch_lease_key("project/workspace/", "Test_Step")
+
+
+def test_only_one_owner_acquires(tmp_path):
+    s3 = storage.LocalStorage(str(tmp_path))
+    assert leases.acquire(s3, BUCKET, LEASE_KEY, "first", 60, now=0)
+    assert not leases.acquire(s3, BUCKET, LEASE_KEY, "second", 60, now=30)
+    # Acquiring again is fine for the owner
+    assert leases.acquire(s3, BUCKET, LEASE_KEY, "first", 60, now=30)
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    s3 = storage.LocalStorage(str(tmp_path))
+    assert leases.acquire(s3, BUCKET, LEASE_KEY, "first", 60, now=0)
+    assert leases.acquire(s3, BUCKET, LEASE_KEY, "second", 60, now=61)
+    assert not leases.acquire(s3, BUCKET, LEASE_KEY, "third", 60, now=90)
+    # The first owner's release doesn't free the lease it lost
+    leases.release(s3, BUCKET, LEASE_KEY, "first")
+    assert not leases.acquire(s3, BUCKET, LEASE_KEY, "third", 60, now=90)
+
+
+def test_released_lease_can_be_acquired(tmp_path):
+    s3 = storage.LocalStorage(str(tmp_path))
+    assert leases.acquire(s3, BUCKET, LEASE_KEY, "first", 60, now=0)
+    leases.release(s3, BUCKET, LEASE_KEY, "first")
+    assert leases.acquire(s3, BUCKET, LEASE_KEY, "second", 60, now=10)
+    # Releasing a lease that isn't held does nothing
+    leases.release(s3, BUCKET, LEASE_KEY, "first")
+    assert not leases.acquire(s3, BUCKET, LEASE_KEY, "third", 60, now=20)
@@ -0,0 +1,51 @@
+import os
+import sys
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda/lambda_functions")
+)
+
+import cppipe
+
+# Writes a lean variant next to each of steps 6, 7 and 9's pipelines in a folder,
+# saving only the images a later step reads, for production runs. Upload them along
+# with the full pipelines and set "pipeline_variant" to "lean" in the metadata to
+# run them. WIDTH and HEIGHT are the size of the input images, to report how much
+# less each image set writes out.
+# Use: python lean_pipelines.py PIPELINE_FOLDER [WIDTH HEIGHT]
+
+args = sys.argv[1:]
+if len(args) not in (1, 3):
+    print("Use: lean_pipelines.py PIPELINE_FOLDER [WIDTH HEIGHT]")
+    sys.exit()
+
+width = height = None
+if len(args) == 3:
+    width, height = int(args[1]), int(args[2])
+
+for pipeline_name, kept_images in cppipe.LEAN_KEPT_IMAGES.items():
+    full_file = os.path.join(args[0], pipeline_name)
+    if not os.path.exists(full_file):
+        print("No", pipeline_name, "in", args[0])
+        continue
+    pipeline = cppipe.load(full_file)
+    full_cost = cppipe.static_cost(pipeline, width, height)
+    removed = cppipe.lean(pipeline, kept_images)
+    lean_file = os.path.join(args[0], cppipe.lean_name(pipeline_name))
+    cppipe.save(pipeline, lean_file)
+    lean_cost = cppipe.static_cost(pipeline, width, height)
+    print(
+        "Wrote",
+        lean_file,
+        "-",
+        len(removed),
+        "modules removed,",
+        full_cost["save_images"],
+        "SaveImages down to",
+        lean_cost["save_images"],
+    )
+    if full_cost["output_bytes"] is not None:
+        print(
+            "Output per image set: %.1f MB down to %.1f MB"
+            % (full_cost["output_bytes"] / 1e6, lean_cost["output_bytes"] / 1e6)
+        )
@@ -0,0 +1,43 @@
+import json
+import os
+import sys
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda/lambda_functions")
+)
+
+import cppipe
+
+# Sums up what each image set of a pipeline costs before it is run: how many images
+# it saves and roughly how many bytes (uncompressed), its Resize factors, and its
+# Align and IdentifyPrimaryObjects modules. WIDTH and HEIGHT are the size of the
+# input images, for the byte estimate.
+# Use: python pipeline_cost.py PIPELINE [WIDTH HEIGHT] [--json]
+
+args = [x for x in sys.argv[1:] if x != "--json"]
+if len(args) not in (1, 3):
+    print("Use: pipeline_cost.py PIPELINE [WIDTH HEIGHT] [--json]")
+    sys.exit()
+
+width = height = None
+if len(args) == 3:
+    width, height = int(args[1]), int(args[2])
+cost = cppipe.static_cost(cppipe.load(args[0]), width, height)
+
+if "--json" in sys.argv:
+    print(json.dumps(cost, indent=4))
+    sys.exit()
+
+print(os.path.basename(args[0]), "-", cost["modules"], "modules enabled")
+print("SaveImages:", cost["save_images"], cost["saved_by_format"])
+if cost["output_bytes"] is not None:
+    print("Output per image set: %.1f MB" % (cost["output_bytes"] / 1e6))
+    by_folder = {}
+    for eachsave in cost["saved"]:
+        folder = eachsave["folder"]
+        by_folder[folder] = by_folder.get(folder, 0) + eachsave["bytes"]
+    for folder, folder_bytes in sorted(by_folder.items(), key=lambda x: -x[1]):
+        print("    %-60s %8.1f MB" % (folder, folder_bytes / 1e6))
+print("Resize factors:", cost["resize_factors"])
+print("Align:", cost["align"])
+print("IdentifyPrimaryObjects:", cost["identify_primary_objects"])
@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda/lambda_functions")
+)
+
+import event_monitor
+import orchestrator
+import storage
+
+# Runs a whole batch through steps 1-9, launching each step's lambda as soon as
+# the steps it depends on are done. Safe to stop and start again: progress is kept
+# in workspace/orchestrator/BATCH/PipelineState.json on the bucket.
+# Use: python run_batch.py BUCKET PROJECT_PREFIX BATCH APP_PREFIX [STEPS] [stream]
+# STEPS is e.g. 1,2,3,4 to only run the painting arm. With "stream", steps that
+# can start on part of the batch get each well as soon as it is ready for them
+# (see streaming.STREAM_SOURCES) instead of waiting for the whole previous step.
+
+args = [x for x in sys.argv[1:] if x != "stream"]
+if len(args) not in (4, 5):
+    print("Use: run_batch.py BUCKET PROJECT_PREFIX BATCH APP_PREFIX [STEPS] [stream]")
+    sys.exit()
+
+import boto3
+from botocore.config import Config
+
+bucket_name, image_prefix, batch, app_prefix = args[:4]
+steps = args[4].split(",") if len(args) == 5 else None
+stream = "stream" in sys.argv[1:]
+
+s3 = storage.default_storage()
+# Step lambdas can take minutes to start their cluster; a retry would launch twice
+lambda_client = boto3.client(
+    "lambda", config=Config(read_timeout=900, retries={"max_attempts": 0})
+)
+launcher = orchestrator.AWSStepLauncher(
+    s3, lambda_client, bucket_name, image_prefix, batch, app_prefix
+)
+state_file = event_monitor.S3StateFile(
+    s3,
+    bucket_name,
+    orchestrator.state_file_key(os.path.join(image_prefix, "workspace/"), batch),
+)
+machine = orchestrator.PipelineOrchestrator(launcher, state_file, steps, stream)
+
+result = machine.advance(time.time())
+while result == orchestrator.RUNNING:
+    time.sleep(orchestrator.ORCHESTRATOR_POLL_TIME)
+    result = machine.advance(time.time())
+print("Batch", batch, "finished as", result)
@@ -0,0 +1,30 @@
+import os
+import sys
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda/lambda_functions")
+)
+
+import job_manifest
+import local_runner
+
+# Runs every job of one step on this machine instead of on a spot fleet; handy for
+# small batches, or to benchmark a step before sizing its fleet.
+# LOCAL_ROOT is a folder laid out like the bucket (pipelines, images, CSVs) and
+# MANIFEST is the step's <APP_NAME>Jobs.json, either from monitors/ on S3 or made
+# without touching SQS by setting create_batch_jobs.record_only before a step's
+# create_batch_jobs_* call.
+# Use: python run_local_jobs.py MANIFEST LOCAL_ROOT [WORKERS]
+
+if len(sys.argv) not in (3, 4):
+    print("Use: run_local_jobs.py MANIFEST LOCAL_ROOT [WORKERS]")
+    sys.exit()
+
+manifest = job_manifest.load_manifest(sys.argv[1])
+if manifest is None:
+    print("No manifest at", sys.argv[1])
+    sys.exit(1)
+workers = int(sys.argv[3]) if len(sys.argv) == 4 else None
+results = local_runner.run_manifest(manifest, os.path.abspath(sys.argv[2]), workers)
+if any(x[0] != 0 for x in results.values()):
+    sys.exit(1)